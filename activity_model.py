@@ -0,0 +1,233 @@
+import numpy as np
+import pandas as pd
+
+# only the Strava fields the stats, media and map use, with compact dtypes
+ACTIVITY_COLUMNS = {
+    'id': 'int64',
+    'name': 'object',
+    'type': 'category',
+    'sport_type': 'category',
+    'gear_id': 'category',
+    'distance': 'float32',
+    'moving_time': 'int32',
+    'total_elevation_gain': 'float32',
+    'max_speed': 'float32',
+    'average_speed': 'float32',
+    'average_watts': 'float32',
+    'average_heartrate': 'float32',
+    'kudos_count': 'int32',
+    'total_photo_count': 'int32',
+    'commute': 'bool',
+    'trainer': 'bool'
+}
+
+class PolylineStore:
+    """
+    Encoded summary polylines for every activity, stored in one contiguous buffer
+
+    Polylines are addressed by row position, in the same order as the activities DataFrame.
+
+    Parameters:
+        polylines: iterable of string
+    """
+    def __init__(self, polylines):
+        encoded = [(polyline or '').encode('ascii') for polyline in polylines]
+        self._offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(polyline) for polyline in encoded], out=self._offsets[1:])
+        self._buffer = b''.join(encoded)
+
+    @classmethod
+    def from_buffer(cls, buffer, offsets):
+        """
+        Wraps an existing buffer and offsets without copying, e.g. memory mapped from a snapshot
+
+        Parameters:
+            buffer: bytes-like of ascii polylines
+            offsets: ndarray of int64, one more than the number of polylines
+
+        Returns:
+            polylines: PolylineStore
+        """
+        polylines = cls.__new__(cls)
+        polylines._offsets = offsets
+        polylines._buffer = buffer
+        return polylines
+
+    @classmethod
+    def concat(cls, stores):
+        """
+        Joins stores end to end, copying their buffers once
+
+        Parameters:
+            stores: list of PolylineStore
+
+        Returns:
+            polylines: PolylineStore
+        """
+        offsets = [np.zeros(1, dtype=np.int64)]
+        total = 0
+        for store in stores:
+            offsets.append(store._offsets[1:] - store._offsets[0] + total)
+            total += int(store._offsets[-1] - store._offsets[0])
+        buffer = b''.join(memoryview(store._buffer)[store._offsets[0]:store._offsets[-1]] for store in stores) # sliced without an intermediate copy
+        return cls.from_buffer(buffer, np.concatenate(offsets))
+
+    def view(self, start, stop):
+        """
+        Gets the polylines from start up to stop as a store sharing this store's buffer
+
+        Parameters:
+            start: int
+            stop: int
+
+        Returns:
+            polylines: PolylineStore
+        """
+        return PolylineStore.from_buffer(self._buffer, self._offsets[start:stop + 1])
+
+    def take(self, positions):
+        """
+        Gets the polylines at some positions as a new store, copying each run of polylines that are
+        next to each other in the buffer as one slice, so keeping all but a few rows is a few copies
+
+        Parameters:
+            positions: ndarray of int
+
+        Returns:
+            polylines: PolylineStore
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        if len(positions) == 0:
+            return PolylineStore([])
+        starts = self._offsets[positions]
+        ends = self._offsets[positions + 1]
+        offsets = np.zeros(len(positions) + 1, dtype=np.int64)
+        np.cumsum(ends - starts, out=offsets[1:])
+        breaks = np.flatnonzero(starts[1:] != ends[:-1]) + 1
+        run_starts = starts[np.concatenate(([0], breaks))].tolist()
+        run_ends = ends[np.concatenate((breaks, [len(positions)])) - 1].tolist()
+        return PolylineStore.from_buffer(b''.join(self._buffer[start:end] for start, end in zip(run_starts, run_ends)), offsets)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in range(*position.indices(len(self)))]
+        return str(self._buffer[self._offsets[position]:self._offsets[position + 1]], 'ascii')
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    @property
+    def nbytes(self):
+        return len(self._buffer) + self._offsets.nbytes
+
+def build_activity_frame(activities):
+    """
+    Builds the compact, start time sorted activities DataFrame from Strava activity dicts
+
+    Activities are consumed one at a time, so a generator over the activity store never holds
+    the whole history as dicts.
+
+    Parameters:
+        activities: iterable of dict
+
+    Returns:
+        data_frame: DataFrame
+        polylines: PolylineStore, aligned with the DataFrame rows
+    """
+    columns = {name: [] for name in ACTIVITY_COLUMNS}
+    start_dates = []
+    polylines = []
+    for activity in activities:
+        for name, values in columns.items():
+            values.append(activity.get(name))
+        start_dates.append(activity['start_date'])
+        polylines.append((activity.get('map') or {}).get('summary_polyline') or '')
+
+    data = {}
+    for name, dtype in ACTIVITY_COLUMNS.items():
+        values = columns[name]
+        if dtype in ('int32', 'int64'):
+            data[name] = np.array([value or 0 for value in values], dtype=dtype)
+        elif dtype == 'float32':
+            data[name] = np.array(values, dtype=np.float64).astype(np.float32) # None becomes nan
+        elif dtype == 'bool':
+            data[name] = np.array([bool(value) for value in values], dtype=bool)
+        elif dtype == 'category':
+            data[name] = pd.Categorical(values)
+        else:
+            data[name] = pd.Series(values, dtype=dtype)
+        columns[name] = None # release each column's python objects as soon as it is converted
+
+    data_frame = pd.DataFrame(data)
+    data_frame['start_date_formatted'] = pd.to_datetime(pd.Series(start_dates, dtype=object), format='%Y-%m-%dT%H:%M:%SZ', utc=True)
+    data_frame['start_epoch'] = (data_frame['start_date_formatted'] - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1)
+    data_frame['heart_beats'] = data_frame['average_heartrate'].astype(np.float64).round(1) * data_frame['moving_time'] # Strava reports one decimal, undo float32 error
+
+    # keep sorted by start time so date ranges can be found by binary search
+    order = np.argsort(data_frame['start_epoch'].to_numpy(), kind='stable')
+    data_frame = data_frame.iloc[order].reset_index(drop=True)
+    return data_frame, PolylineStore(polylines[i] for i in order)
+
+def replace_activities(data_frame, polylines, activities, removed_ids=()):
+    """
+    Builds a new activities DataFrame with some activities added, edited or removed, reusing the
+    converted rows of every other activity
+
+    Changed activities are spliced in where a binary search over start time puts them, so the
+    unchanged rows are copied as a few contiguous runs and nothing is sorted again. A new
+    activity, usually the newest, is appended after the last run.
+
+    Parameters:
+        data_frame: DataFrame sorted by start_epoch
+        polylines: PolylineStore, aligned with the DataFrame rows
+        activities: list of dict, new or edited activities
+        removed_ids: iterable of int
+
+    Returns:
+        data_frame: DataFrame
+        polylines: PolylineStore
+        sources: ndarray of int, each new row's position in the old DataFrame, -1 for rows built from activities
+    """
+    changed, changed_polylines = build_activity_frame(activities)
+    changed_order = np.lexsort((changed['id'].to_numpy(), changed['start_epoch'].to_numpy()))
+    ids = data_frame['id'].to_numpy()
+    replaced_ids = np.array(sorted(set(int(id) for id in removed_ids) | set(changed['id'].tolist())), dtype=np.int64)
+    removed_positions = np.flatnonzero(np.isin(ids, replaced_ids))
+    kept_positions = np.delete(np.arange(len(data_frame), dtype=np.int64), removed_positions)
+
+    # same order as a full rebuild from the activity store, by start time then id
+    kept_epochs = np.delete(data_frame['start_epoch'].to_numpy(), removed_positions)
+    kept_ids = np.delete(ids, removed_positions)
+    insert_at = []
+    for epoch, id in zip(changed['start_epoch'].to_numpy()[changed_order].tolist(), changed['id'].to_numpy()[changed_order].tolist()):
+        first, last = np.searchsorted(kept_epochs, epoch, side='left'), np.searchsorted(kept_epochs, epoch, side='right')
+        insert_at.append(first + int(np.searchsorted(kept_ids[first:last], id)))
+    sources = np.insert(kept_positions, np.array(insert_at, dtype=np.int64), -1)
+
+    for name, dtype in ACTIVITY_COLUMNS.items():
+        if dtype == 'category': # give both parts the same categories, so joining them keeps the column categorical
+            missing = changed[name].cat.categories.difference(data_frame[name].cat.categories)
+            if len(missing) > 0: # a new sport type or gear, the reused rows need it too
+                data_frame = data_frame.assign(**{name: data_frame[name].cat.add_categories(missing)})
+            changed[name] = changed[name].cat.set_categories(data_frame[name].cat.categories)
+
+    # runs of rows that were next to each other in the old DataFrame, and every changed row on its own
+    breaks = np.flatnonzero((sources[1:] != sources[:-1] + 1) | (sources[1:] < 0) | (sources[:-1] < 0)) + 1
+    frames, stores = [], []
+    changed_count = 0
+    for start, stop in zip(np.concatenate(([0], breaks)).tolist(), np.concatenate((breaks, [len(sources)])).tolist()):
+        if sources[start] < 0:
+            position = int(changed_order[changed_count])
+            changed_count += 1
+            frames.append(changed.iloc[position:position + 1])
+            stores.append(changed_polylines.view(position, position + 1))
+        else:
+            first, last = int(sources[start]), int(sources[stop - 1]) + 1
+            frames.append(data_frame.iloc[first:last])
+            stores.append(polylines.view(first, last))
+    if not frames:
+        return data_frame.iloc[:0].reset_index(drop=True), PolylineStore([]), sources
+    return pd.concat(frames, ignore_index=True), PolylineStore.concat(stores), sources
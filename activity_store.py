@@ -0,0 +1,149 @@
+import calendar
+import json
+import sqlite3
+import time
+from contextlib import closing
+
+def _connect(filename):
+    """
+    Opens a connection to the activity store and creates the schema if needed
+
+    Parameters:
+        filename: string
+
+    Returns:
+        conn: sqlite3.Connection
+    """
+    conn = sqlite3.connect(filename, timeout=30)
+    conn.execute('CREATE TABLE IF NOT EXISTS activities (id INTEGER PRIMARY KEY, start_epoch INTEGER NOT NULL, data TEXT NOT NULL)')
+    conn.execute('CREATE INDEX IF NOT EXISTS activities_start_epoch ON activities (start_epoch)')
+    conn.execute('CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+    return conn
+
+def start_date_to_epoch(start_date):
+    """
+    Converts a Strava start_date string to seconds since epoch
+
+    Parameters:
+        start_date: string
+
+    Returns:
+        epoch: int
+    """
+    return calendar.timegm(time.strptime(start_date, '%Y-%m-%dT%H:%M:%SZ'))
+
+def get_high_water_mark(filename):
+    """
+    Gets the start time of the newest activity seen by the last sync
+
+    Parameters:
+        filename: string
+
+    Returns:
+        high_water_mark: int, or None if the store has never been synced
+    """
+    with closing(_connect(filename)) as conn:
+        row = conn.execute("SELECT value FROM sync_state WHERE key = 'high_water_mark'").fetchone()
+    return int(row[0]) if row is not None else None
+
+def set_high_water_mark(filename, high_water_mark):
+    """
+    Records the start time of the newest activity seen by a sync
+
+    Parameters:
+        filename: string
+        high_water_mark: int
+
+    Returns:
+        none
+    """
+    with closing(_connect(filename)) as conn, conn:
+        conn.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES ('high_water_mark', ?)", (str(high_water_mark),))
+
+def upsert_activities(filename, activities):
+    """
+    Inserts new activities and overwrites existing ones with the same id
+
+    Parameters:
+        filename: string
+        activities: list of dict
+
+    Returns:
+        none
+    """
+    rows = [(activity['id'], start_date_to_epoch(activity['start_date']), json.dumps(activity)) for activity in activities]
+    with closing(_connect(filename)) as conn, conn:
+        conn.executemany('INSERT OR REPLACE INTO activities (id, start_epoch, data) VALUES (?, ?, ?)', rows)
+
+def delete_activities(filename, ids):
+    """
+    Removes activities from the store
+
+    Parameters:
+        filename: string
+        ids: list of int
+
+    Returns:
+        none
+    """
+    with closing(_connect(filename)) as conn, conn:
+        conn.executemany('DELETE FROM activities WHERE id = ?', [(int(id),) for id in ids])
+
+def get_activity_ids_after(filename, after):
+    """
+    Gets ids of all stored activities that started after a point in time
+
+    Parameters:
+        filename: string
+        after: int
+
+    Returns:
+        ids: set of int
+    """
+    with closing(_connect(filename)) as conn:
+        rows = conn.execute('SELECT id FROM activities WHERE start_epoch > ?', (after,)).fetchall()
+    return {row[0] for row in rows}
+
+def get_athlete_id(filename):
+    """
+    Gets the id of the athlete the stored activities belong to
+
+    Parameters:
+        filename: string
+
+    Returns:
+        athlete_id: int, or None if the store is empty
+    """
+    with closing(_connect(filename)) as conn:
+        row = conn.execute("SELECT json_extract(data, '$.athlete.id') FROM activities LIMIT 1").fetchone()
+    return int(row[0]) if row is not None and row[0] is not None else None
+
+def iter_activities(filename):
+    """
+    Streams all stored activities, oldest first, without holding them all in memory
+
+    Parameters:
+        filename: string
+
+    Returns:
+        activities: generator of dict
+    """
+    with closing(_connect(filename)) as conn:
+        for row in conn.execute('SELECT data FROM activities ORDER BY start_epoch, id'):
+            yield json.loads(row[0])
+
+def load_activities_between(filename, start_epoch, end_epoch):
+    """
+    Loads stored activities that started within a time range, inclusive, oldest first
+
+    Parameters:
+        filename: string
+        start_epoch: int
+        end_epoch: int
+
+    Returns:
+        activities: list of dict
+    """
+    with closing(_connect(filename)) as conn:
+        rows = conn.execute('SELECT data FROM activities WHERE start_epoch BETWEEN ? AND ? ORDER BY start_epoch, id', (start_epoch, end_epoch)).fetchall()
+    return [json.loads(row[0]) for row in rows]
@@ -0,0 +1,59 @@
+import os
+import threading
+from dataset import DatasetHolder
+from geometry import GeometryCache
+from heatmap import HeatmapTileCache
+from routes import RouteIndex
+from segment_explorer import SegmentCache
+
+ACTIVITY_STORE_FILENAME = 'activities.sqlite'
+MEDIA_FILENAME = 'activities_csv'
+STREAM_STORE_FILENAME = 'streams.sqlite'
+SEGMENT_STORE_FILENAME = 'segments.sqlite'
+HEATMAP_TILE_DIRECTORY = 'heatmap_tiles'
+SNAPSHOT_DIRECTORY = 'snapshot'
+
+class AthleteData:
+    """
+    Everything kept for one athlete: the local files their data is synced into, the caches built
+    from it and the dataset being served
+
+    Parameters:
+        athlete_id: int, or None for the athlete configured in config.py
+        directory: string, holding the athlete's activity store, media csv and heatmap tiles
+        athlete: dict, Strava athlete summary
+        writer: boolean, False in processes that only follow the snapshots the sync process writes
+    """
+    def __init__(self, athlete_id, directory, athlete=None, writer=True):
+        self.athlete_id = athlete_id
+        self.athlete = athlete
+        os.makedirs(directory, exist_ok=True)
+        self.store_filename = os.path.join(directory, ACTIVITY_STORE_FILENAME)
+        self.media_filename = os.path.join(directory, MEDIA_FILENAME)
+        self.streams_filename = os.path.join(directory, STREAM_STORE_FILENAME)
+        self.geometry = GeometryCache() # track bounds and simplified map lines, kept across syncs
+        self.routes = RouteIndex() # repeated routes, matched as activities are synced
+        self.heatmap_tiles = HeatmapTileCache(os.path.join(directory, HEATMAP_TILE_DIRECTORY), writer=writer)
+        self.segments = SegmentCache(os.path.join(directory, SEGMENT_STORE_FILENAME)) # details include the athlete's PRs
+        self.snapshot_directory = os.path.join(directory, SNAPSHOT_DIRECTORY) # memory mapped by every process serving the athlete
+        self.snapshot_version = None # version the served dataset was loaded from or written to
+        self.snapshot_checked_at = 0.0
+        self.snapshot_timer = None # pending write of changes from webhook events
+        self.holder = DatasetHolder()
+        self.lock = threading.Lock() # held while a sync or webhook event updates the stores and swaps the dataset
+        self.worker = None
+
+    @property
+    def nbytes(self):
+        dataset = self.holder.get()
+        return self.geometry.nbytes + (dataset.nbytes if dataset is not None else 0)
+
+    def close(self):
+        """
+        Stops the athlete's background sync, called when the athlete is evicted from memory.
+        Everything synced stays on disk, so coming back only needs an incremental sync.
+        """
+        if self.worker is not None:
+            self.worker.stop()
+        if self.snapshot_timer is not None: # the stores already hold the changes, the next sync writes them
+            self.snapshot_timer.cancel()
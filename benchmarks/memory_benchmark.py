@@ -0,0 +1,59 @@
+"""
+Memory held per activity by the original list of activity dicts plus DataFrame, compared with the
+compact columns built by activity_model.py, for generated activities
+
+Usage:
+    python benchmarks/memory_benchmark.py 10000 100000
+    python -m benchmarks.memory_benchmark 1000000
+"""
+import gc
+import json
+import os
+import sys
+import tracemalloc
+import pandas as pd
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY_DIRECTORY) # the repository modules, also when run as a script
+
+import fake_strava
+from activity_model import build_activity_frame
+
+def measure(build):
+    """
+    Measures the memory held by what build returns, and the peak while building it
+
+    Parameters:
+        build: callable
+
+    Returns:
+        retained_bytes: int
+        peak_bytes: int
+    """
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    retained_bytes, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return retained_bytes, peak_bytes
+
+def build_original(rows):
+    # the list of dicts kept for /api/all_activities, plus a DataFrame of every Strava field
+    activities_list = [json.loads(row) for row in rows]
+    return activities_list, pd.DataFrame(activities_list)
+
+def build_compact(rows):
+    return build_activity_frame(json.loads(row) for row in rows)
+
+def main(counts):
+    print('\nMeasuring Activity Memory...')
+    for count in counts:
+        # activities come out of the store as JSON text either way
+        rows = [json.dumps(activity) for activity in fake_strava.generate_activities(count)]
+        for label, build in (('list + DataFrame', build_original), ('compact columns', build_compact)):
+            retained_bytes, peak_bytes = measure(lambda: build(rows))
+            print(f'\t- {count} activities, {label}: {retained_bytes / count:,.0f} bytes/activity retained, {peak_bytes / count:,.0f} bytes/activity peak')
+
+if __name__ == '__main__':
+    main([int(count) for count in sys.argv[1:]] or [10000, 100000])
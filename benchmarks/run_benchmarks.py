@@ -0,0 +1,254 @@
+"""
+Timing and peak memory benchmarks for the sync, stats and page functions in main.py, run against
+a local fake Strava API serving generated activities
+
+Usage:
+    python -m benchmarks.run_benchmarks --sizes 1000 10000 100000 --output benchmark_results.json
+    python -m benchmarks.run_benchmarks --sizes 1000000 --repeat 1
+    python -m benchmarks.run_benchmarks --compare baseline.json --output benchmark_results.json
+"""
+import argparse
+import contextlib
+import datetime
+import gc
+import io
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.error
+import urllib.request
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SIZES = [1000, 10000, 100000]
+ATHLETE_ID = 1
+ACCESS_TOKEN = f'fake-access-token-{ATHLETE_ID}'
+
+def start_fake_strava(count, seed):
+    """
+    Starts the fake Strava API in its own process, so generating activities never competes with the
+    code being measured for the interpreter
+
+    Parameters:
+        count: int
+        seed: int
+
+    Returns:
+        process: subprocess.Popen
+        url: string
+    """
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    process = subprocess.Popen([sys.executable, os.path.join(REPOSITORY_DIRECTORY, 'fake_strava.py'), '--activities', str(count), '--seed', str(seed),
+                                '--port', str(port), '--rate-limit', '1000000000', '1000000000', '--cache-responses'],
+                               cwd=REPOSITORY_DIRECTORY, stdout=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    for _ in range(300):
+        try:
+            urllib.request.urlopen(url + '/api/v3/segments/0')
+        except urllib.error.HTTPError: # any response means the server is up
+            return process, url
+        except urllib.error.URLError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('Fake Strava API did not start')
+
+def measure(function, repeat, setup=None, warm_up=False, number=1):
+    """
+    Times a function over several runs, then measures its peak traced memory in one more run,
+    since tracing slows the code down
+
+    Parameters:
+        function: callable
+        repeat: int
+        setup: callable run untimed before every run
+        warm_up: boolean, run once untimed first, e.g. to fill the fake API's response cache
+        number: int, calls per timed run, so very fast functions are timed above clock noise
+
+    Returns:
+        result: dict with min, median, runs (seconds) and peak_bytes
+    """
+    def run(traced=False):
+        if setup is not None:
+            setup()
+        gc.collect()
+        if traced:
+            tracemalloc.start()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()): # main.py prints progress
+            for _ in range(1 if traced else number):
+                function()
+        elapsed = (time.perf_counter() - start) / number
+        peak_bytes = tracemalloc.get_traced_memory()[1] if traced else None
+        if traced:
+            tracemalloc.stop()
+        return elapsed, peak_bytes
+
+    if warm_up:
+        run()
+    runs = [run()[0] for _ in range(repeat)]
+    _, peak_bytes = run(traced=True)
+    return {'min': min(runs), 'median': statistics.median(runs), 'runs': runs, 'peak_bytes': peak_bytes}
+
+def remove_file(filename):
+    if os.path.exists(filename):
+        os.remove(filename)
+
+def run_size(main, size, seed, repeat, directory):
+    """
+    Runs every benchmark against one history size
+
+    Parameters:
+        main: module
+        size: int, activities
+        seed: int
+        repeat: int
+        directory: string, working directory for the athlete's stores
+
+    Returns:
+        results: list of dict
+    """
+    import token_store
+    from strava_client import StravaClient
+
+    os.makedirs(directory)
+    os.chdir(directory)
+    process, url = start_fake_strava(size, seed)
+    results = []
+    def record(name, result):
+        results.append(dict(benchmark=name, size=size, **result))
+        print(f"\t- {name}: {result['median'] * 1000:,.1f} ms median, {result['peak_bytes'] / 2 ** 20:,.1f} MiB peak", file=sys.stderr)
+
+    try:
+        main.strava = StravaClient(base_url=url)
+        token_store.save_token(main.TOKEN_STORE_FILENAME, ATHLETE_ID, {'access_token': ACCESS_TOKEN, 'refresh_token': f'fake-refresh-token-{ATHLETE_ID}',
+                                                                        'expires_at': int(time.time()) + 365 * 24 * 60 * 60, 'athlete': {'id': ATHLETE_ID}})
+        athlete_directory = os.path.join(main.ATHLETE_DIRECTORY, str(ATHLETE_ID))
+        os.makedirs(athlete_directory)
+        store_filename = os.path.join(athlete_directory, 'activities.sqlite')
+        media_filename = os.path.join(athlete_directory, 'activities_csv')
+
+        record('get_activity_data (full sync)', measure(lambda: main.get_activity_data(ACCESS_TOKEN, store_filename), repeat,
+                                                        setup=lambda: remove_file(store_filename), warm_up=True))
+        record('get_activity_data (incremental sync)', measure(lambda: main.get_activity_data(ACCESS_TOKEN, store_filename), repeat))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            all_activities, _ = main.get_activity_data(ACCESS_TOKEN, store_filename)
+        record('get_activity_media', measure(lambda: main.get_activity_media(all_activities, ACCESS_TOKEN, media_filename), repeat,
+                                             setup=lambda: remove_file(media_filename), warm_up=True))
+
+        start_date = all_activities['start_date_formatted'].iloc[0]
+        end_date = all_activities['start_date_formatted'].iloc[-1]
+        record('calculate_lifetime_stats', measure(lambda: main.calculate_lifetime_stats(all_activities, start_date, end_date), repeat, number=20))
+        record('calculate_activity_stats', measure(lambda: main.calculate_activity_stats(all_activities, start_date, end_date, 'Ride'), repeat, number=20))
+
+        record('load_athlete', measure(lambda: main.load_athlete(ATHLETE_ID, start_sync=False), repeat))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            app = main.create_app(start_sync=False)
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['athlete_id'] = ATHLETE_ID
+        def get(path):
+            response = client.get(path)
+            assert response.status_code == 200, (path, response.status_code)
+        with contextlib.redirect_stdout(io.StringIO()):
+            get('/') # loads the athlete and stores the date range in the session
+
+        record('/ render (uncached)', measure(lambda: get('/'), repeat, setup=main.response_cache.clear))
+        record('/ render (cached)', measure(lambda: get('/'), repeat, number=20))
+        record('/api/all_activities (uncached)', measure(lambda: get('/api/all_activities'), repeat, setup=main.response_cache.clear))
+        record('/api/all_activities (cached)', measure(lambda: get('/api/all_activities'), repeat, number=20))
+    finally:
+        process.kill()
+        process.wait()
+        os.chdir(REPOSITORY_DIRECTORY)
+    return results
+
+def compare(results, baseline, threshold):
+    """
+    Prints the change in median time of every benchmark also in the baseline
+
+    Parameters:
+        results: list of dict
+        baseline: list of dict
+        threshold: double, ratio of median times counted as a regression
+
+    Returns:
+        regressions: list of (benchmark, size, ratio)
+    """
+    baseline_medians = {(result['benchmark'], result['size']): result['median'] for result in baseline}
+    regressions = []
+    print('\nCompared to Baseline:')
+    for result in results:
+        baseline_median = baseline_medians.get((result['benchmark'], result['size']))
+        if baseline_median is None or baseline_median == 0:
+            continue
+        ratio = result['median'] / baseline_median
+        print(f"\t- {result['benchmark']} at {result['size']}: {ratio:.2f}x{'  REGRESSION' if ratio > threshold else ''}")
+        if ratio > threshold:
+            regressions.append((result['benchmark'], result['size'], ratio))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark main.py against a fake Strava API')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='activity history sizes, up to 1000000')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', help='earlier results file to compare median times against')
+    parser.add_argument('--threshold', type=float, default=1.2, help='slowdown counted as a regression')
+    args = parser.parse_args()
+    output_filename = os.path.abspath(args.output)
+    compare_filename = os.path.abspath(args.compare) if args.compare else None
+
+    # main.py creates its app on import, keep it off the real Strava API and out of the repository
+    working_directory = tempfile.mkdtemp(prefix='strava-benchmarks-')
+    os.environ['STRAVA_SYNC'] = '0'
+    sys.path.insert(0, REPOSITORY_DIRECTORY)
+    os.chdir(working_directory)
+    with contextlib.redirect_stdout(io.StringIO()):
+        import main as app_main
+    os.chdir(REPOSITORY_DIRECTORY)
+
+    results = []
+    try:
+        for size in args.sizes:
+            print(f'\nBenchmarking {size} Activities...', file=sys.stderr)
+            results.extend(run_size(app_main, size, args.seed, args.repeat, os.path.join(working_directory, str(size))))
+    finally:
+        shutil.rmtree(working_directory, ignore_errors=True)
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPOSITORY_DIRECTORY, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    output = {
+        'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'seed': args.seed,
+        'results': results
+    }
+    with open(output_filename, 'w') as file:
+        json.dump(output, file, indent=2)
+    print(f'\nSaved results to {output_filename}', file=sys.stderr)
+
+    if compare_filename:
+        with open(compare_filename) as file:
+            baseline = json.load(file)['results']
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
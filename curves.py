@@ -0,0 +1,238 @@
+import numpy as np
+
+# every second for the first minute, then roughly 12 durations per tenfold up to 6 hours, plus the usual round ones
+CURVE_DURATIONS = np.unique(np.concatenate((
+    np.arange(1, 61),
+    np.round(np.logspace(np.log10(60), np.log10(6 * 60 * 60), 30) / 5) * 5,
+    [300, 600, 1200, 1800, 3600, 7200]
+))).astype(np.int64)
+
+PAUSE_SECONDS = 10 # longer gaps between samples are stops rather than smart recording
+CURVE_VERSION = 2 # bumped when curves are calculated differently, so cached ones are calculated again
+
+# curve kind -> activity types it is calculated for
+CURVE_TYPES = {
+    'power': ('Ride', 'VirtualRide'),
+    'pace': ('Run', 'VirtualRun')
+}
+
+# durations shown on the dashboard cards, seconds -> label
+CURVE_CARD_DURATIONS = {
+    'power': {5: '5s', 60: '1min', 300: '5min', 1200: '20min', 3600: '1h'},
+    'pace': {60: '1min', 300: '5min', 1200: '20min', 3600: '1h'}
+}
+
+def resample(time, values, cumulative=False):
+    """
+    Resamples a stream to one value per second of elapsed time
+
+    Devices recording smart rather than every second leave gaps of a few seconds in the time
+    stream, which are interpolated across. Gaps longer than PAUSE_SECONDS are stops: values that
+    accumulate, like distance, are carried across them, other values, like power, are zero during them.
+
+    Parameters:
+        time: ndarray of seconds since the activity start
+        values: ndarray, same length as time
+        cumulative: boolean
+
+    Returns:
+        resampled: ndarray of float64, one value per second
+    """
+    time = np.asarray(time, dtype=np.int64)
+    time = time - time[0]
+    values = np.nan_to_num(np.asarray(values, dtype=np.float64))
+    resampled = np.interp(np.arange(time[-1] + 1), time, values)
+    if cumulative:
+        return resampled
+    stops = np.flatnonzero(np.diff(time) > PAUSE_SECONDS)
+    stopped = np.zeros(len(resampled) + 1, dtype=np.int64) # +1 at the first second of each stop, -1 after its last
+    np.add.at(stopped, time[stops] + 1, 1)
+    np.add.at(stopped, time[stops + 1], -1)
+    resampled[np.cumsum(stopped[:-1]) > 0] = 0.0
+    return resampled
+
+def best_window_means(cumulative, durations=CURVE_DURATIONS):
+    """
+    Finds the best mean over every window length, from the running total of a one second stream
+
+    The mean of every window of a given length comes from one vectorized difference of the running
+    total, so each duration costs a single pass over the stream.
+
+    Parameters:
+        cumulative: ndarray, running total starting at 0
+        durations: ndarray of int, seconds
+
+    Returns:
+        best: ndarray of float32, nan for durations longer than the stream
+    """
+    best = np.full(len(durations), np.nan, dtype=np.float32)
+    length = len(cumulative) - 1
+    for i, duration in enumerate(durations):
+        if duration > length:
+            break # durations are ascending
+        best[i] = (cumulative[duration:] - cumulative[:-duration]).max() / duration
+    return best
+
+def power_curve(time, watts):
+    """
+    Calculates best average power for every curve duration
+
+    Parameters:
+        time: ndarray
+        watts: ndarray
+
+    Returns:
+        curve: ndarray of float32, watts
+    """
+    power = resample(time, watts)
+    return best_window_means(np.concatenate(([0.0], np.cumsum(power))))
+
+def pace_curve(time, distance):
+    """
+    Calculates best average speed for every curve duration, from the distance covered in each window
+
+    Parameters:
+        time: ndarray
+        distance: ndarray, metres
+
+    Returns:
+        curve: ndarray of float32, metres per second
+    """
+    distance = resample(time, distance, cumulative=True)
+    return best_window_means(distance - distance[0])
+
+def activity_curve(kind, streams):
+    """
+    Calculates an activity's curve from its streams
+
+    Parameters:
+        kind: string, key of CURVE_TYPES
+        streams: dict of stream type -> ndarray
+
+    Returns:
+        curve: ndarray of float32, or None if the activity lacks the streams
+    """
+    time = streams.get('time')
+    if time is None or len(time) < 2:
+        return None
+    if kind == 'power' and streams.get('watts') is not None:
+        return power_curve(time, streams['watts'])
+    if kind == 'pace' and streams.get('distance') is not None:
+        return pace_curve(time, streams['distance'])
+    return None
+
+def activity_curves(activity_type, streams):
+    """
+    Calculates every curve that applies to an activity's type from its streams
+
+    Parameters:
+        activity_type: string
+        streams: dict of stream type -> ndarray
+
+    Returns:
+        curves: dict of curve kind -> ndarray of float32
+    """
+    found = {}
+    for kind, kind_types in CURVE_TYPES.items():
+        curve = activity_curve(kind, streams) if activity_type in kind_types else None
+        if curve is not None:
+            found[kind] = curve
+    return found
+
+class CurveMatrix:
+    """
+    The curves of one kind, with rows only for the activities that have one. Most activities have
+    no power or pace streams, so a row for every activity would mostly hold nan.
+
+    Parameters:
+        positions: ndarray of int64, ascending rows of the DataFrame the curves belong to
+        values: ndarray of float32 of shape (len(positions), len(CURVE_DURATIONS))
+    """
+    def __init__(self, positions, values):
+        self.positions = positions
+        self.values = values
+
+    def __len__(self):
+        return len(self.positions)
+
+    @property
+    def nbytes(self):
+        return self.positions.nbytes + self.values.nbytes
+
+    def rows(self, first, last):
+        """
+        Gets the curves of the DataFrame rows in a range
+
+        Parameters:
+            first: int
+            last: int, one past the last row
+
+        Returns:
+            positions: ndarray of int64, DataFrame rows
+            values: ndarray of float32, one curve per position
+        """
+        start, end = np.searchsorted(self.positions, [first, last])
+        return self.positions[start:end], self.values[start:end]
+
+    def rearrange(self, sources, added):
+        """
+        Moves the curves to the rows of a DataFrame rebuilt from the one they belong to
+
+        Parameters:
+            sources: ndarray of int, the previous row of each new row, -1 for rows that are new or changed
+            added: CurveMatrix of the new or changed rows, positions counted among them alone
+
+        Returns:
+            curves: CurveMatrix
+        """
+        kept_rows = np.flatnonzero(sources >= 0)
+        kept_sources = sources[kept_rows] # ascending, rows that are kept stay in the same order
+        found = np.minimum(np.searchsorted(kept_sources, self.positions), max(len(kept_sources) - 1, 0))
+        still_kept = kept_sources[found] == self.positions if len(kept_sources) > 0 else np.zeros(len(self.positions), dtype=bool)
+        positions = np.concatenate((kept_rows[found[still_kept]], np.flatnonzero(sources < 0)[added.positions])).astype(np.int64)
+        values = np.concatenate((self.values[still_kept], added.values))
+        order = np.argsort(positions, kind='stable')
+        return CurveMatrix(positions[order], values[order])
+
+def merge_curves(matrix, activity_ids):
+    """
+    Merges activity curves into the best value for every duration across all of them
+
+    Parameters:
+        matrix: ndarray of shape (activities, durations), nan where an activity has no value
+        activity_ids: ndarray of int, one per matrix row
+
+    Returns:
+        best: ndarray of float32, nan where no activity is long enough
+        best_ids: ndarray of int, the activity each best value comes from, 0 where there is none
+    """
+    if len(matrix) == 0:
+        return np.full(len(CURVE_DURATIONS), np.nan, dtype=np.float32), np.zeros(len(CURVE_DURATIONS), dtype=np.int64)
+    filled = np.where(np.isnan(matrix), -np.inf, matrix)
+    rows = filled.argmax(axis=0)
+    best = filled[rows, np.arange(matrix.shape[1])]
+    found = np.isfinite(best)
+    return np.where(found, best, np.nan).astype(np.float32), np.where(found, np.asarray(activity_ids)[rows], 0)
+
+def format_curve_card(kind, best):
+    """
+    Formats a merged curve at the dashboard card durations
+
+    Parameters:
+        kind: string, key of CURVE_TYPES
+        best: ndarray, from merge_curves
+
+    Returns:
+        card: list of (label, string) pairs, watts for power and min/km for pace
+    """
+    card = []
+    for duration, label in CURVE_CARD_DURATIONS[kind].items():
+        value = best[np.searchsorted(CURVE_DURATIONS, duration)]
+        if np.isnan(value) or value <= 0:
+            card.append((label, '-'))
+        elif kind == 'power':
+            card.append((label, f'{value:.0f} watts'))
+        else:
+            seconds_per_km = round(1000 / value)
+            card.append((label, f'{seconds_per_km // 60}:{seconds_per_km % 60:02d} /km'))
+    return card
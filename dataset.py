@@ -0,0 +1,186 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+_versions = itertools.count(1) # shared by every holder, so an athlete loaded again after an eviction never reuses a version that responses were cached under
+
+class Dataset:
+    """
+    Immutable bundle of everything the web pages are rendered from
+
+    Attributes:
+        activities: DataFrame
+        polylines: PolylineStore, aligned with the activities rows
+        photos: dict
+        segments: DataFrame
+        geometry: GeometryCache
+        curves: dict of curve kind -> CurveMatrix of best efforts, for the activities that have them
+        rollups: RollupTable of weekly, monthly and yearly totals per (sport_type, commute)
+        fingerprint: string, heatmap.tracks_fingerprint of the tracks
+        version: int, assigned when the dataset is swapped in, unique within the process
+        loaded_at: double
+    """
+    def __init__(self, activities, polylines, photos, segments, geometry, curves=None, rollups=None, fingerprint=None):
+        self.activities = activities
+        self.polylines = polylines
+        self.photos = photos
+        self.segments = segments
+        self.geometry = geometry
+        self.curves = curves or {}
+        self.rollups = rollups
+        self.fingerprint = fingerprint
+        self.version = None
+        self.loaded_at = time.time()
+        self._nbytes = None
+
+    @property
+    def nbytes(self):
+        """
+        Memory held by the activities, polylines, curves and rollups, measured once since the dataset never changes
+        """
+        if self._nbytes is None:
+            self._nbytes = int(self.activities.memory_usage(deep=True).sum()) + self.polylines.nbytes + sum(matrix.nbytes for matrix in self.curves.values())
+            if self.rollups is not None:
+                self._nbytes += self.rollups.nbytes
+        return self._nbytes
+
+class DatasetHolder:
+    """
+    Holds the current Dataset. Requests read a single reference, so swapping in a new dataset
+    never exposes a half-loaded one to requests already in flight.
+    """
+    def __init__(self):
+        self._dataset = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Gets the current dataset
+
+        Returns:
+            dataset: Dataset, or None if nothing has been loaded yet
+        """
+        return self._dataset
+
+    def swap(self, dataset):
+        """
+        Replaces the current dataset with a fully built one
+
+        Parameters:
+            dataset: Dataset
+
+        Returns:
+            none
+        """
+        with self._lock:
+            dataset.version = next(_versions)
+            self._dataset = dataset
+
+    def is_ready(self):
+        return self._dataset is not None
+
+class DatasetCache:
+    """
+    Least recently used cache of per-athlete data, bounded by the memory the athletes' datasets hold
+
+    Entries are loaded on first use and closed when evicted. The most recently used entry is never
+    evicted, however large it is.
+
+    Parameters:
+        load: callable taking a key and returning an entry with an nbytes property and a close method
+        max_bytes: int
+        max_entries: int
+    """
+    def __init__(self, load, max_bytes=512 * 1024 * 1024, max_entries=64):
+        self.load = load
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._loading = {} # key -> lock, so an entry is only loaded once when requests race
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def keys(self):
+        return list(self._entries)
+
+    def peek(self, key):
+        """
+        Gets an entry if it is loaded, without loading it or changing its recency
+
+        Parameters:
+            key: hashable
+
+        Returns:
+            entry: object, or None
+        """
+        return self._entries.get(key)
+
+    def get(self, key):
+        """
+        Gets an entry, loading it on a miss and evicting the least recently used entries over the limits
+
+        Parameters:
+            key: hashable
+
+        Returns:
+            entry: object
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                evicted = self._evict() # datasets grow as syncs complete
+            else:
+                loading = self._loading.setdefault(key, threading.Lock())
+        if entry is None:
+            with loading:
+                entry = self._entries.get(key)
+                if entry is None:
+                    entry = self.load(key)
+                with self._lock:
+                    self._entries[key] = entry
+                    self._entries.move_to_end(key)
+                    self._loading.pop(key, None)
+                    evicted = self._evict()
+        for evicted_entry in evicted:
+            evicted_entry.close()
+        return entry
+
+    def evict(self, key):
+        """
+        Removes an entry if it is loaded, closing it
+
+        Parameters:
+            key: hashable
+
+        Returns:
+            entry: object, or None if it was not loaded
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is not None:
+            entry.close()
+        return entry
+
+    def nbytes(self):
+        return sum(entry.nbytes for entry in list(self._entries.values()))
+
+    def _evict(self):
+        evicted = []
+        while len(self._entries) > 1 and (len(self._entries) > self.max_entries or self.nbytes() > self.max_bytes):
+            _, entry = self._entries.popitem(last=False)
+            evicted.append(entry)
+        return evicted
+
+    def clear(self):
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            entry.close()
@@ -0,0 +1,49 @@
+import json
+import sqlite3
+from contextlib import closing
+
+def _connect(filename):
+    """
+    Opens a connection to the queue of webhook events waiting for the sync process, and creates it if needed
+
+    Parameters:
+        filename: string
+
+    Returns:
+        conn: sqlite3.Connection
+    """
+    conn = sqlite3.connect(filename, timeout=30)
+    conn.execute('CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, data TEXT NOT NULL)')
+    return conn
+
+def append_event(filename, event):
+    """
+    Queues a push event for the sync process, which is the only process applying them
+
+    Parameters:
+        filename: string
+        event: dict, from webhook.parse_event
+
+    Returns:
+        pending_count: int, events queued and not yet taken
+    """
+    with closing(_connect(filename)) as conn, conn:
+        conn.execute('INSERT INTO events (data) VALUES (?)', (json.dumps(event),))
+        return conn.execute('SELECT COUNT(*) FROM events').fetchone()[0]
+
+def take_events(filename, limit=100):
+    """
+    Removes and returns the oldest queued events, in the order they arrived
+
+    Parameters:
+        filename: string
+        limit: int
+
+    Returns:
+        events: list of dict
+    """
+    with closing(_connect(filename)) as conn, conn:
+        rows = conn.execute('SELECT id, data FROM events ORDER BY id LIMIT ?', (limit,)).fetchall()
+        if rows:
+            conn.execute('DELETE FROM events WHERE id <= ?', (rows[-1][0],))
+    return [json.loads(row[1]) for row in rows]
@@ -0,0 +1,554 @@
+"""
+Local stand-in for the Strava API, for running and testing the app offline
+
+Usage:
+    python fake_strava.py --activities 1000 --port 8001
+    STRAVA_BASE_URL=http://127.0.0.1:8001 python main.py
+"""
+import argparse
+import datetime
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections.abc import Sequence
+from urllib.parse import urlparse, parse_qs, urlencode
+from geometry import encode_polyline
+
+SPORT_TYPES = [ # (type, sport_type, weight)
+    ('Ride', 'Ride', 30), ('Ride', 'MountainBikeRide', 8), ('VirtualRide', 'VirtualRide', 10),
+    ('Run', 'Run', 20), ('VirtualRun', 'VirtualRun', 3), ('Hike', 'Hike', 8), ('Swim', 'Swim', 6),
+    ('AlpineSki', 'AlpineSki', 5), ('NordicSki', 'NordicSki', 4), ('Workout', 'Workout', 3), ('Walk', 'Walk', 3)
+]
+STATS_TYPES = {'ride': ('Ride', 'VirtualRide', 'EBikeRide'), 'run': ('Run', 'VirtualRun'), 'swim': ('Swim',)} # totals in athlete stats
+SPEEDS = {'Ride': 7.5, 'MountainBikeRide': 5.0, 'VirtualRide': 9.0, 'Run': 3.0, 'VirtualRun': 3.2, 'Hike': 1.3, 'Swim': 0.8,
+          'AlpineSki': 8.0, 'NordicSki': 3.5, 'Workout': 0.0, 'Walk': 1.4}
+
+def generate_track(rng, start, length_m, points=60):
+    """
+    Generates a meandering GPS track as a list of (lat, lng) pairs
+
+    Parameters:
+        rng: random.Random
+        start: tuple of (lat, lng)
+        length_m: double
+        points: int
+
+    Returns:
+        coordinates: list of tuple
+    """
+    lat, lng = start
+    heading = rng.uniform(0, 2 * math.pi)
+    step = length_m / max(points - 1, 1)
+    coordinates = [(lat, lng)]
+    for _ in range(points - 1):
+        heading += rng.gauss(0, 0.35)
+        lat += step * math.cos(heading) / 111320
+        lng += step * math.sin(heading) / (111320 * math.cos(math.radians(lat)))
+        coordinates.append((lat, lng))
+    return coordinates
+
+WEIGHTED_TYPES = [(type, sport_type) for type, sport_type, weight in SPORT_TYPES for _ in range(weight)]
+
+def generate_activity(i, seed=0, center=(51.045, -114.07), start=datetime.datetime(2018, 1, 1), spacing=3600):
+    """
+    Generates one deterministic Strava summary activity. Each activity has its own random
+    generator, so any activity can be generated without the ones before it.
+
+    Parameters:
+        i: int, position in start time order
+        seed: int
+        center: tuple of (lat, lng)
+        start: datetime
+        spacing: double, average seconds between activities
+
+    Returns:
+        activity: dict
+    """
+    rng = random.Random(f'{seed}:{i}')
+    type, sport_type = rng.choice(WEIGHTED_TYPES)
+    start_date = start + datetime.timedelta(seconds=i * spacing + rng.uniform(0, spacing / 2))
+    speed = SPEEDS[sport_type] * rng.uniform(0.8, 1.2)
+    moving_time = rng.randint(20 * 60, 4 * 60 * 60)
+    distance = round(speed * moving_time, 1)
+    virtual = type.startswith('Virtual') or sport_type == 'Workout'
+    has_heartrate = rng.random() < 0.8
+    track_start = (center[0] + rng.gauss(0, 0.08), center[1] + rng.gauss(0, 0.12))
+    track = [] if virtual or distance == 0 else generate_track(rng, track_start, distance)
+    activity_id = 1000000000 + i
+    return {
+        'resource_state': 2,
+        'athlete': {'id': 1, 'resource_state': 1},
+        'name': f'{sport_type} {i}',
+        'distance': distance,
+        'moving_time': moving_time,
+        'elapsed_time': moving_time + rng.randint(0, 1800),
+        'total_elevation_gain': round(rng.uniform(0, 60) * distance / 10000, 1),
+        'type': type,
+        'sport_type': sport_type,
+        'id': activity_id,
+        'start_date': start_date.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'start_date_local': (start_date - datetime.timedelta(hours=7)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'timezone': '(GMT-07:00) America/Edmonton',
+        'utc_offset': -25200.0,
+        'achievement_count': rng.randint(0, 5),
+        'kudos_count': rng.randint(0, 30),
+        'comment_count': rng.randint(0, 3),
+        'athlete_count': 1,
+        'photo_count': 0,
+        'map': {'id': f'a{activity_id}', 'summary_polyline': encode_polyline(track), 'resource_state': 2},
+        'trainer': virtual,
+        'commute': sport_type == 'Ride' and rng.random() < 0.3,
+        'manual': False,
+        'private': False,
+        'visibility': 'everyone',
+        'flagged': False,
+        'gear_id': rng.choice(['b1234', 'b5678', 'g1111', None]),
+        'start_latlng': list(track[0]) if track else [],
+        'end_latlng': list(track[-1]) if track else [],
+        'average_speed': round(speed, 3),
+        'max_speed': round(speed * rng.uniform(1.3, 2.5), 3),
+        'average_watts': round(rng.uniform(120, 280), 1) if type in ('Ride', 'VirtualRide') else None,
+        'has_heartrate': has_heartrate,
+        'average_heartrate': round(rng.uniform(110, 165), 1) if has_heartrate else None,
+        'max_heartrate': round(rng.uniform(165, 195), 1) if has_heartrate else None,
+        'elev_high': round(1050 + rng.uniform(0, 600), 1),
+        'elev_low': round(1040 + rng.uniform(0, 50), 1),
+        'pr_count': rng.randint(0, 3),
+        'total_photo_count': 1 if not virtual and rng.random() < 0.15 else 0,
+        'has_kudoed': False
+    }
+
+def _activity_spacing(count, start=datetime.datetime(2018, 1, 1)):
+    return max((datetime.datetime(2024, 1, 1) - start).total_seconds() / max(count, 1), 60)
+
+def generate_activities(count, seed=0, center=(51.045, -114.07), start=datetime.datetime(2018, 1, 1)):
+    """
+    Generates deterministic Strava summary activities, newest first like /athlete/activities
+
+    Parameters:
+        count: int
+        seed: int
+        center: tuple of (lat, lng)
+        start: datetime
+
+    Returns:
+        activities: list of dict
+    """
+    spacing = _activity_spacing(count, start)
+    return [generate_activity(i, seed, center, start, spacing) for i in range(count - 1, -1, -1)]
+
+class GeneratedActivities(Sequence):
+    """
+    The activities generate_activities would return, generated on access instead of held in memory,
+    for serving histories too large to keep as dicts
+
+    Parameters:
+        count: int
+        seed: int
+        center: tuple of (lat, lng)
+        start: datetime
+    """
+    def __init__(self, count, seed=0, center=(51.045, -114.07), start=datetime.datetime(2018, 1, 1)):
+        self.count = count
+        self.seed = seed
+        self.center = center
+        self.start = start
+        self.spacing = _activity_spacing(count, start)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in range(*position.indices(self.count))]
+        if position < 0:
+            position += self.count
+        if not 0 <= position < self.count:
+            raise IndexError(position)
+        return generate_activity(self.count - 1 - position, self.seed, self.center, self.start, self.spacing)
+
+    def position(self, activity_id):
+        """
+        Finds an activity's position without generating any activities
+
+        Parameters:
+            activity_id: int
+
+        Returns:
+            position: int, or None if there is no such activity
+        """
+        i = activity_id - 1000000000
+        return self.count - 1 - i if 0 <= i < self.count else None
+
+def generate_streams(activity):
+    """
+    Generates deterministic one second streams for an activity, keyed by type like /activities/{id}/streams
+
+    Parameters:
+        activity: dict, summary activity
+
+    Returns:
+        streams: dict of stream type -> list
+    """
+    rng = random.Random(activity['id'])
+    moving_time = activity['moving_time']
+    time, elapsed = [], 0
+    for _ in range(moving_time):
+        time.append(elapsed)
+        elapsed += 1 if rng.random() > 0.002 else rng.randint(10, 120) # occasional pause
+    effort = [1.0]
+    for _ in range(moving_time - 1): # slowly wandering effort around the average
+        effort.append(min(max(effort[-1] + rng.gauss(0, 0.02) - 0.01 * (effort[-1] - 1), 0.3), 2.0))
+    velocity = [round(activity['average_speed'] * value, 2) for value in effort]
+    distance, total = [], 0.0
+    for value in velocity:
+        distance.append(round(total, 1))
+        total += value
+    streams = {'time': time, 'distance': distance, 'velocity_smooth': velocity}
+    if activity.get('average_watts'):
+        streams['watts'] = [round(activity['average_watts'] * value ** 1.5) for value in effort]
+    if activity.get('has_heartrate'):
+        streams['heartrate'] = [round(activity['average_heartrate'] * value ** 0.3) for value in effort]
+    return streams
+
+def generate_segments(count, seed=0, center=(51.045, -114.07)):
+    """
+    Generates deterministic Strava segment details
+
+    Parameters:
+        count: int
+        seed: int
+        center: tuple of (lat, lng)
+
+    Returns:
+        segments: list of dict
+    """
+    rng = random.Random(seed)
+    segments = []
+    for i in range(count):
+        distance = round(rng.uniform(200, 5000), 1)
+        track = generate_track(rng, (center[0] + rng.gauss(0, 0.05), center[1] + rng.gauss(0, 0.08)), distance, points=20)
+        pr = rng.randint(int(distance / 12), int(distance / 4)) if rng.random() < 0.6 else None
+        segments.append({
+            'id': 2000000 + i,
+            'resource_state': 3,
+            'name': f'Segment {i}',
+            'climb_category': rng.randint(0, 3),
+            'avg_grade': round(rng.uniform(-3, 12), 1),
+            'average_grade': round(rng.uniform(-3, 12), 1),
+            'distance': distance,
+            'elev_difference': round(rng.uniform(0, 150), 1),
+            'start_latlng': list(track[0]),
+            'end_latlng': list(track[-1]),
+            'points': encode_polyline(track),
+            'map': {'id': f's{2000000 + i}', 'polyline': encode_polyline(track), 'resource_state': 3},
+            'athlete_segment_stats': {'pr_elapsed_time': pr, 'effort_count': rng.randint(1, 50) if pr else 0},
+            'xoms': {'kom': f'{int(distance / 14) // 60}:{int(distance / 14) % 60:02d}', 'overall': f'{int(distance / 14) // 60}:{int(distance / 14) % 60:02d}'}
+        })
+    return segments
+
+class FakeStrava:
+    """
+    In-process fake Strava API server serving a fixed set of activities and segments
+
+    Rate limit headers are reported like the real API, and 429s are returned once the 15 minute
+    or daily limit is used up. Failures can be injected with fail_next.
+
+    /oauth/authorize approves straight away and redirects back with a code for the athlete_id query
+    parameter, the first athlete by default. Tokens encode the athlete id, so each athlete's
+    requests only see their own activities.
+
+    Parameters:
+        activities: list of dict or GeneratedActivities, newest first
+        segments: list of dict
+        rate_limits: tuple of (15 minute, daily)
+        explore_cap: int, max segments returned by /segments/explore
+        latency: double, seconds added to every response
+        cache_responses: boolean, serve repeated GET requests from the first response, so generating
+            activities is not timed as part of benchmarks after a warm up
+        athletes: dict of athlete id -> list of activity dicts, newest first, instead of activities for athlete 1
+    """
+    def __init__(self, activities=(), segments=(), rate_limits=(200, 2000), explore_cap=10, latency=0.0, host='127.0.0.1', port=0, athletes=None, cache_responses=False):
+        self.athletes = {int(id): _as_sequence(athlete_activities) for id, athlete_activities in athletes.items()} if athletes else {1: _as_sequence(activities)}
+        self.activities = next(iter(self.athletes.values()))
+        self.segments = list(segments)
+        self.rate_limits = rate_limits
+        self.explore_cap = explore_cap
+        self.latency = latency
+        self.request_log = []
+        self.cache_responses = cache_responses
+        self._response_cache = {}
+        self._stats_cache = {}
+        self.usage = [0, 0]
+        self._failures = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self.url = f'http://{host}:{self._server.server_address[1]}'
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def fail_next(self, status, count=1, headers=None):
+        """
+        Makes the next requests fail with the given status code
+
+        Parameters:
+            status: int
+            count: int
+            headers: dict
+
+        Returns:
+            none
+        """
+        with self._lock:
+            self._failures.extend([(status, headers or {})] * count)
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                fake._handle(self, 'GET')
+
+            def do_POST(self):
+                fake._handle(self, 'POST')
+
+        return Handler
+
+    def _handle(self, handler, method):
+        url = urlparse(handler.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path == '/oauth/authorize': # the browser login page, not an api request
+            athlete_id = int(params.get('athlete_id', next(iter(self.athletes))))
+            query = urlencode({'state': params.get('state', ''), 'code': f'fake-code-{athlete_id}', 'scope': params.get('scope', 'read')})
+            return self._respond(handler, 302, {}, {'Location': params['redirect_uri'] + '?' + query})
+        if method == 'POST':
+            length = int(handler.headers.get('Content-Length') or 0)
+            params.update({key: values[0] for key, values in parse_qs(handler.rfile.read(length).decode()).items()})
+
+        with self._lock:
+            self.request_log.append((method, url.path, params))
+            self.usage[0] += 1
+            self.usage[1] += 1
+            failure = self._failures.pop(0) if self._failures else None
+            over_limit = self.usage[0] > self.rate_limits[0] or self.usage[1] > self.rate_limits[1]
+            rate_headers = {
+                'X-RateLimit-Limit': f'{self.rate_limits[0]},{self.rate_limits[1]}',
+                'X-RateLimit-Usage': f'{self.usage[0]},{self.usage[1]}'
+            }
+
+        if self.latency:
+            time.sleep(self.latency)
+        if failure is not None:
+            return self._respond(handler, failure[0], {'message': 'Injected failure'}, {**rate_headers, **failure[1]})
+        if over_limit:
+            return self._respond(handler, 429, {'message': 'Rate Limit Exceeded'}, rate_headers)
+
+        athlete_id = _token_athlete_id(handler.headers.get('Authorization', ''), next(iter(self.athletes)))
+        key = (url.path, tuple(sorted(params.items())), athlete_id)
+        cached = self._response_cache.get(key) if self.cache_responses and method == 'GET' else None
+        if cached is not None:
+            return self._respond(handler, cached[0], cached[1], rate_headers)
+        status, body = self._route(method, url.path, params, athlete_id)
+        body = json.dumps(body).encode()
+        if self.cache_responses and method == 'GET':
+            self._response_cache[key] = (status, body)
+        self._respond(handler, status, body, rate_headers)
+
+    def _respond(self, handler, status, body, headers):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(data)))
+        for key, value in headers.items():
+            handler.send_header(key, value)
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def reset_usage(self, short_only=True):
+        with self._lock:
+            self.usage[0] = 0
+            if not short_only:
+                self.usage[1] = 0
+
+    def _route(self, method, path, params, athlete_id):
+        if method == 'POST' and path == '/oauth/token':
+            return self._token(params)
+        if path == '/api/v3/athlete/activities':
+            return 200, self._list_activities(self.athletes.get(athlete_id, []), params)
+        if path == '/api/v3/athlete':
+            return 200, {'id': athlete_id, 'resource_state': 2, 'firstname': 'Fake', 'lastname': f'Athlete {athlete_id}'}
+        match = re.fullmatch(r'/api/v3/athletes/(\d+)/stats', path)
+        if match:
+            if int(match.group(1)) != athlete_id: # only the authenticated athlete's stats can be read
+                return 403, {'message': 'Authorization Error'}
+            return 200, self._athlete_stats(athlete_id)
+        match = re.fullmatch(r'/api/v3/activities/(\d+)', path)
+        if match:
+            return self._get_activity(self.athletes.get(athlete_id, []), int(match.group(1)))
+        match = re.fullmatch(r'/api/v3/activities/(\d+)/streams', path)
+        if match:
+            return self._get_streams(self.athletes.get(athlete_id, []), int(match.group(1)), params)
+        if path == '/api/v3/segments/explore':
+            return 200, self._explore_segments(params)
+        match = re.fullmatch(r'/api/v3/segments/(\d+)', path)
+        if match:
+            segment = next((segment for segment in self.segments if segment['id'] == int(match.group(1))), None)
+            return (200, segment) if segment is not None else (404, {'message': 'Record Not Found'})
+        return 404, {'message': 'Record Not Found'}
+
+    def _token(self, params):
+        if params.get('grant_type') == 'authorization_code':
+            athlete_id = _token_athlete_id(params.get('code', ''), None)
+        else:
+            athlete_id = _token_athlete_id(params.get('refresh_token', ''), next(iter(self.athletes)))
+        if athlete_id not in self.athletes:
+            return 400, {'message': 'Bad Request', 'errors': [{'resource': 'AuthorizationCode', 'code': 'invalid'}]}
+        token = {'token_type': 'Bearer', 'access_token': f'fake-access-token-{athlete_id}', 'refresh_token': f'fake-refresh-token-{athlete_id}',
+                 'expires_at': int(time.time()) + 6 * 60 * 60, 'expires_in': 6 * 60 * 60}
+        if params.get('grant_type') == 'authorization_code': # only the code exchange includes the athlete
+            token['athlete'] = {'id': athlete_id, 'firstname': 'Fake', 'lastname': f'Athlete {athlete_id}'}
+        return 200, token
+
+    def _list_activities(self, activities, params):
+        per_page = min(int(params.get('per_page', 30)), 200)
+        page = int(params.get('page', 1))
+        # activities are newest first, so after selects a prefix and before a suffix, found by binary search
+        end = _count_newer(activities, int(params['after'])) if 'after' in params else len(activities)
+        begin = _count_newer(activities, int(params['before']) - 1) if 'before' in params else 0
+        if 'after' in params: # Strava returns activities oldest first when after is given
+            positions = range(end - 1, begin - 1, -1)
+        else:
+            positions = range(begin, end)
+        return [activities[position] for position in positions[(page - 1) * per_page:page * per_page]]
+
+    def _athlete_stats(self, athlete_id):
+        # like Strava, only rides, runs and swims are counted, so other sport types are missing from the totals
+        activities = self.athletes.get(athlete_id, [])
+        stats = self._stats_cache.get(athlete_id) if isinstance(activities, GeneratedActivities) else None
+        if stats is not None:
+            return stats
+        now = time.time()
+        year_start = datetime.datetime(datetime.datetime.now(datetime.timezone.utc).year, 1, 1, tzinfo=datetime.timezone.utc).timestamp()
+        stats = {f'{period}_{kind}_totals': {'count': 0, 'distance': 0.0, 'moving_time': 0, 'elapsed_time': 0, 'elevation_gain': 0.0}
+                 for period in ('recent', 'ytd', 'all') for kind in STATS_TYPES}
+        for activity in activities:
+            kind = next((kind for kind, types in STATS_TYPES.items() if activity['type'] in types), None)
+            if kind is None:
+                continue
+            epoch = _epoch(activity['start_date'])
+            periods = ['all'] + (['ytd'] if epoch >= year_start else []) + (['recent'] if epoch >= now - 28 * 24 * 60 * 60 else [])
+            for period in periods:
+                totals = stats[f'{period}_{kind}_totals']
+                totals['count'] += 1
+                totals['distance'] += activity['distance']
+                totals['moving_time'] += activity['moving_time']
+                totals['elapsed_time'] += activity['elapsed_time']
+                totals['elevation_gain'] += activity['total_elevation_gain']
+        if isinstance(activities, GeneratedActivities): # never changes, and slow to count for large histories
+            self._stats_cache[athlete_id] = stats
+        return stats
+
+    def _find_activity(self, activities, activity_id):
+        if isinstance(activities, GeneratedActivities): # found without generating the others
+            position = activities.position(activity_id)
+            return activities[position] if position is not None else None
+        return next((activity for activity in activities if activity['id'] == activity_id), None)
+
+    def _get_activity(self, activities, activity_id):
+        activity = self._find_activity(activities, activity_id)
+        if activity is None:
+            return 404, {'message': 'Record Not Found'}
+        detail = dict(activity, resource_state=3, description='')
+        if activity.get('total_photo_count', 0) > 0:
+            detail['photos'] = {'count': activity['total_photo_count'], 'primary': {
+                'unique_id': f'p{activity_id}',
+                'urls': {'100': f'https://example.com/photos/{activity_id}-100.jpg', '600': f'https://example.com/photos/{activity_id}-600.jpg'}
+            }}
+        else:
+            detail['photos'] = {'count': 0, 'primary': None}
+        return 200, detail
+
+    def _get_streams(self, activities, activity_id, params):
+        activity = self._find_activity(activities, activity_id)
+        if activity is None:
+            return 404, {'message': 'Record Not Found'}
+        keys = set(params.get('keys', '').split(',')) | {'time', 'distance'} # time and distance always come back
+        streams = {key: {'data': data, 'series_type': 'distance', 'original_size': len(data), 'resolution': 'high'}
+                   for key, data in generate_streams(activity).items() if key in keys}
+        if params.get('key_by_type') not in ('true', '1'):
+            return 200, [dict(stream, type=key) for key, stream in streams.items()]
+        return 200, streams
+
+    def _explore_segments(self, params):
+        south, west, north, east = (float(value) for value in params['bounds'].split(','))
+        found = []
+        for segment in self.segments:
+            lat, lng = segment['start_latlng']
+            if south <= lat <= north and west <= lng <= east:
+                found.append({key: segment[key] for key in ('id', 'resource_state', 'name', 'climb_category', 'avg_grade', 'start_latlng', 'end_latlng', 'elev_difference', 'distance', 'points')})
+            if len(found) == self.explore_cap:
+                break
+        return {'segments': found}
+
+def _as_sequence(activities):
+    return activities if isinstance(activities, GeneratedActivities) else list(activities)
+
+def _count_newer(activities, epoch):
+    low, high = 0, len(activities)
+    while low < high:
+        middle = (low + high) // 2
+        if _epoch(activities[middle]['start_date']) > epoch:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+def _token_athlete_id(token, default):
+    match = re.search(r'-(\d+)$', token)
+    return int(match.group(1)) if match else default
+
+def _epoch(start_date):
+    return int(datetime.datetime.strptime(start_date, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=datetime.timezone.utc).timestamp())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a fake Strava API server')
+    parser.add_argument('--activities', type=int, default=1000)
+    parser.add_argument('--segments', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--rate-limit', type=int, nargs=2, default=[200, 2000], metavar=('SHORT', 'DAILY'))
+    parser.add_argument('--cache-responses', action='store_true')
+    args = parser.parse_args()
+
+    server = FakeStrava(GeneratedActivities(args.activities, args.seed), generate_segments(args.segments, args.seed), tuple(args.rate_limit),
+                        port=args.port, cache_responses=args.cache_responses)
+    print(f'Fake Strava API listening on {server.url}', flush=True)
+    server.start()
+    try:
+        while True:
+            time.sleep(900)
+            server.reset_usage()
+    except KeyboardInterrupt:
+        server.stop()
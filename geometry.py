@@ -0,0 +1,376 @@
+import threading
+import numpy as np
+from spatial_index import GridIndex, PackedGridIndex
+
+GEOMETRY_ZOOM_LEVELS = [6, 9, 12, 15] # zoom levels a simplified line is precomputed for
+SIMPLIFY_TOLERANCE_PIXELS = 1.0
+
+def decode_polyline(encoded):
+    """
+    Decodes a Google encoded polyline with vectorized NumPy operations
+
+    Parameters:
+        encoded: string
+
+    Returns:
+        coordinates: ndarray of shape (n, 2), (lat, lng) pairs
+    """
+    if not isinstance(encoded, str) or len(encoded) == 0:
+        return np.empty((0, 2))
+    data = np.frombuffer(encoded.encode('ascii'), dtype=np.uint8).astype(np.int64) - 63
+    end_positions = np.flatnonzero((data & 0x20) == 0) # last 5-bit chunk of each value has no continuation bit
+    if len(end_positions) < 2:
+        return np.empty((0, 2))
+    data = data[:end_positions[-1] + 1] # ignore a truncated trailing value
+    starts = np.concatenate(([0], end_positions[:-1] + 1))
+    chunk_number = np.arange(len(data)) - np.repeat(starts, end_positions - starts + 1)
+    values = np.add.reduceat((data & 0x1f) << (5 * chunk_number), starts)
+    values = np.where(values & 1, ~(values >> 1), values >> 1) # undo zigzag sign encoding
+    deltas = values[:len(values) // 2 * 2].reshape(-1, 2)
+    return np.cumsum(deltas, axis=0) / 1e5
+
+def encode_polyline(coordinates):
+    """
+    Encodes (lat, lng) pairs with the Google encoded polyline algorithm using vectorized NumPy operations
+
+    Parameters:
+        coordinates: ndarray of shape (n, 2) or list of tuple
+
+    Returns:
+        encoded: string
+    """
+    points = np.round(np.asarray(coordinates, dtype=np.float64).reshape(-1, 2) * 1e5).astype(np.int64)
+    if len(points) == 0:
+        return ''
+    deltas = np.diff(points, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+    values = np.where(deltas < 0, ~(deltas << 1), deltas << 1) # zigzag sign encoding
+    bit_lengths = np.zeros(len(values), dtype=np.int64)
+    nonzero = values > 0
+    bit_lengths[nonzero] = np.floor(np.log2(values[nonzero])).astype(np.int64) + 1
+    chunk_counts = np.maximum(1, (bit_lengths + 4) // 5)
+    value_index = np.repeat(np.arange(len(values)), chunk_counts)
+    chunk_number = np.arange(len(value_index)) - np.repeat(np.cumsum(chunk_counts) - chunk_counts, chunk_counts)
+    chunks = (values[value_index] >> (5 * chunk_number)) & 0x1f
+    chunks |= np.where(chunk_number < chunk_counts[value_index] - 1, 0x20, 0) # continuation bit on all but the last chunk
+    return (chunks + 63).astype(np.uint8).tobytes().decode('ascii')
+
+def simplify_polyline(points, tolerance):
+    """
+    Simplifies a line with the Douglas-Peucker algorithm
+
+    Parameters:
+        points: ndarray of shape (n, 2), (lat, lng) pairs
+        tolerance: double, degrees of latitude
+
+    Returns:
+        simplified: ndarray of shape (m, 2)
+    """
+    if len(points) < 3:
+        return points
+    # scale longitude so distances are roughly isotropic at this latitude
+    scale = np.array([1.0, np.cos(np.radians(points[:, 0].mean()))])
+    scaled = points * scale
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start = scaled[first]
+        direction = scaled[last] - start
+        offsets = scaled[first + 1:last] - start
+        length = np.hypot(direction[0], direction[1])
+        if length == 0:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = np.abs(direction[0] * offsets[:, 1] - direction[1] * offsets[:, 0]) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = first + 1 + farthest
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return points[keep]
+
+def zoom_tolerance(zoom):
+    """
+    Gets the simplification tolerance for a map zoom level, one pixel of a 256 pixel tile
+
+    Parameters:
+        zoom: int
+
+    Returns:
+        tolerance: double, degrees
+    """
+    return SIMPLIFY_TOLERANCE_PIXELS * 360 / (256 * 2 ** zoom)
+
+def zoom_level(zoom):
+    """
+    Picks the precomputed zoom level to serve for a map zoom
+
+    Parameters:
+        zoom: int
+
+    Returns:
+        level: int
+    """
+    levels = [level for level in GEOMETRY_ZOOM_LEVELS if level <= zoom]
+    return levels[-1] if levels else GEOMETRY_ZOOM_LEVELS[0]
+
+def _entry_nbytes(entry):
+    # approximate memory held by the encoded lines, plus a fixed overhead for each entry's objects
+    polyline, _, lines = entry
+    return len(polyline) + sum(len(line) for line in (lines or {}).values()) + 200
+
+class MappedGeometry:
+    """
+    Track bounds and simplified map lines restored from a snapshot, read from its memory maps in
+    place so processes serving the same snapshot share them
+
+    Parameters:
+        activity_ids: ndarray of int
+        polylines: PolylineStore, aligned with activity_ids
+        boxes: ndarray of shape (n, 4), nan for activities without a track
+        lines: dict of zoom level -> PolylineStore, empty where not simplified yet
+        grid: dict of name -> ndarray, from spatial_index.pack_grid over the boxes
+    """
+    def __init__(self, activity_ids, polylines, boxes, lines, grid):
+        self.activity_ids = np.asarray(activity_ids, dtype=np.int64)
+        self.polylines = polylines
+        self.boxes = boxes
+        self.lines = lines
+        self.grid = PackedGridIndex(grid, boxes)
+        self._order = np.argsort(self.activity_ids, kind='stable') # lookups by id with a binary search
+        self._sorted_ids = self.activity_ids[self._order]
+
+    @property
+    def nbytes(self):
+        # only the lookup arrays are private to the process, the rest is shared through the page cache
+        return self._order.nbytes + self._sorted_ids.nbytes
+
+    def position(self, activity_id):
+        index = int(np.searchsorted(self._sorted_ids, activity_id))
+        if index < len(self._sorted_ids) and self._sorted_ids[index] == activity_id:
+            return int(self._order[index])
+        return None
+
+    def query(self, bounds):
+        return set(self.activity_ids[self.grid.query(bounds)].tolist())
+
+class GeometryCache:
+    """
+    Decoded track bounds and simplified map lines per activity, kept across syncs so each activity
+    is only processed once. Track bounds are kept in a spatial index for viewport queries.
+
+    Geometry restored from a snapshot is read in place, and only copied into entries the first
+    time it is updated, which only the process syncing the athlete does.
+    """
+    def __init__(self):
+        self._entries = {} # activity id -> (summary polyline, bounding box, {zoom level: encoded} or None)
+        self._mapped = None # MappedGeometry restored from a snapshot, used instead of the entries until the next update
+        self._lock = threading.Lock()
+        self.index = GridIndex()
+        self.nbytes = 0
+
+    def update(self, activity_ids, polylines, simplify=True):
+        """
+        Processes activities that are new or whose polyline changed, and drops removed activities
+
+        Decoding and indexing is cheap, so it is always done. Simplification can be left for a
+        later update, e.g. while loading cached data at startup.
+
+        Parameters:
+            activity_ids: iterable of int
+            polylines: iterable of string
+            simplify: boolean
+
+        Returns:
+            processed_count: int
+            changed_polylines: list of string, previous and new polylines of every added, edited or removed track
+        """
+        current = {id: polyline for id, polyline in zip(activity_ids, polylines) if polyline}
+        self._copy_mapped()
+        with self._lock:
+            entries = dict(self._entries)
+        changed_polylines = []
+        for id in [id for id in entries if id not in current]:
+            changed_polylines.append(entries.pop(id)[0])
+            self.index.remove(id)
+
+        processed_count = 0
+        for id, polyline in current.items():
+            entry = entries.get(id)
+            if entry is not None and entry[0] == polyline and (entry[2] is not None or not simplify):
+                continue
+            if entry is None or entry[0] != polyline:
+                changed_polylines.extend([polyline] if entry is None else [entry[0], polyline])
+            points = decode_polyline(polyline)
+            if len(points) == 0:
+                continue
+            box = (points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max())
+            lines = {level: encode_polyline(simplify_polyline(points, zoom_tolerance(level))) for level in GEOMETRY_ZOOM_LEVELS} if simplify else None
+            entries[id] = (polyline, box, lines)
+            self.index.insert(id, box)
+            processed_count += 1
+
+        with self._lock:
+            self._entries = entries
+            self.nbytes = sum(_entry_nbytes(entry) for entry in entries.values())
+        return processed_count, changed_polylines
+
+    def update_activity(self, activity_id, polyline, simplify=True):
+        """
+        Processes one added, edited or removed activity, without checking every other activity like update
+
+        Parameters:
+            activity_id: int
+            polyline: string, empty if the activity was removed or has no track
+            simplify: boolean
+
+        Returns:
+            changed_polylines: list of string, previous and new polyline if the track changed
+        """
+        activity_id = int(activity_id)
+        self._copy_mapped()
+        entry = self._entries.get(activity_id)
+        previous = entry[0] if entry is not None else ''
+        if previous == (polyline or '') and (entry is None or entry[2] is not None or not simplify):
+            return []
+        points = decode_polyline(polyline)
+        new_entry = None
+        if len(points) > 0:
+            box = (points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max())
+            lines = {level: encode_polyline(simplify_polyline(points, zoom_tolerance(level))) for level in GEOMETRY_ZOOM_LEVELS} if simplify else None
+            new_entry = (polyline, box, lines)
+
+        with self._lock:
+            if entry is not None:
+                del self._entries[activity_id]
+                self.index.remove(activity_id)
+                self.nbytes -= _entry_nbytes(entry)
+            if new_entry is not None:
+                self._entries[activity_id] = new_entry
+                self.index.insert(activity_id, new_entry[1])
+                self.nbytes += _entry_nbytes(new_entry)
+        return [line for line in (previous, polyline) if line] if previous != (polyline or '') else []
+
+    def export(self, activity_ids):
+        """
+        Gets the track bounds and simplified lines of activities, for writing a snapshot
+
+        Parameters:
+            activity_ids: iterable of int
+
+        Returns:
+            boxes: ndarray of shape (n, 4), nan for activities without a track
+            lines: dict of zoom level -> list of encoded line, None where not simplified yet
+        """
+        self._copy_mapped()
+        entries = self._entries
+        activity_ids = list(activity_ids)
+        boxes = np.full((len(activity_ids), 4), np.nan)
+        lines = {level: [None] * len(activity_ids) for level in GEOMETRY_ZOOM_LEVELS}
+        for position, id in enumerate(activity_ids):
+            entry = entries.get(id)
+            if entry is None:
+                continue
+            boxes[position] = entry[1]
+            for level, line in (entry[2] or {}).items():
+                lines[level][position] = line
+        return boxes, lines
+
+    def restore(self, activity_ids, polylines, boxes, lines, grid):
+        """
+        Replaces every entry with the geometry exported to a snapshot, read from the snapshot in
+        place so nothing is decoded or copied
+
+        Parameters:
+            activity_ids: iterable of int
+            polylines: PolylineStore
+            boxes: ndarray of shape (n, 4), from export
+            lines: dict of zoom level -> PolylineStore, empty where not simplified yet
+            grid: dict of name -> ndarray, from spatial_index.pack_grid over the boxes
+
+        Returns:
+            none
+        """
+        mapped = MappedGeometry(activity_ids, polylines, boxes, lines, grid)
+        with self._lock:
+            self._entries = {}
+            self.index = GridIndex()
+            self._mapped = mapped
+            self.nbytes = mapped.nbytes
+
+    def _copy_mapped(self):
+        # entries are updated in place, so geometry restored from a snapshot is copied into them first
+        mapped = self._mapped
+        if mapped is None:
+            return
+        entries = {}
+        index = GridIndex()
+        simplified = [level for level in GEOMETRY_ZOOM_LEVELS if level in mapped.lines]
+        for position in np.flatnonzero(~np.isnan(mapped.boxes[:, 0])).tolist():
+            id = int(mapped.activity_ids[position])
+            box = tuple(mapped.boxes[position].tolist())
+            entry_lines = {level: mapped.lines[level][position] for level in simplified}
+            complete = len(simplified) == len(GEOMETRY_ZOOM_LEVELS) and all(entry_lines.values())
+            entries[id] = (mapped.polylines[position], box, entry_lines if complete else None)
+            index.insert(id, box)
+
+        with self._lock:
+            self._entries = entries
+            self.index = index
+            self._mapped = None
+            self.nbytes = sum(_entry_nbytes(entry) for entry in entries.values())
+
+    def tracks(self, activity_ids):
+        """
+        Decodes the tracks of activities
+
+        Parameters:
+            activity_ids: iterable of int
+
+        Returns:
+            tracks: list of ndarray of shape (n, 2)
+        """
+        mapped = self._mapped
+        if mapped is not None:
+            positions = [mapped.position(id) for id in activity_ids]
+            return [decode_polyline(mapped.polylines[position]) for position in positions if position is not None]
+        entries = self._entries
+        return [decode_polyline(entries[id][0]) for id in activity_ids if id in entries]
+
+    def get(self, activity_id, zoom):
+        """
+        Gets the simplified line for an activity at a map zoom
+
+        Parameters:
+            activity_id: int
+            zoom: int
+
+        Returns:
+            encoded: string, or None if the activity has not been simplified yet
+        """
+        mapped = self._mapped
+        if mapped is not None:
+            position = mapped.position(activity_id)
+            level_lines = mapped.lines.get(zoom_level(zoom))
+            return (level_lines[position] or None) if position is not None and level_lines is not None else None
+        entry = self._entries.get(activity_id)
+        return entry[2][zoom_level(zoom)] if entry is not None and entry[2] is not None else None
+
+    def query_bounds(self, bounds):
+        """
+        Finds activities whose track bounding box intersects an area
+
+        Parameters:
+            bounds: list of double, [south, west, north, east] as passed to /segments/explore
+
+        Returns:
+            activity_ids: set of int
+        """
+        mapped = self._mapped
+        if mapped is not None:
+            return mapped.query(bounds)
+        return self.index.query(bounds)
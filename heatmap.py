@@ -0,0 +1,424 @@
+import hashlib
+import json
+import os
+import shutil
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+import numpy as np
+
+TILE_SIZE = 256
+HEATMAP_MAX_ZOOM = 16
+HEATMAP_SATURATION = 25 # activities through a pixel for full intensity
+TILE_FINGERPRINTS_KEPT = 16 # newest sets of tracks whose tiles stay on disk, for processes still serving an older snapshot
+
+_LINEAGE_FILENAME = 'LINEAGE'
+
+def project(points, zoom):
+    """
+    Projects (lat, lng) pairs to global web mercator pixel coordinates at a zoom level
+
+    Parameters:
+        points: ndarray of shape (n, 2)
+        zoom: int
+
+    Returns:
+        pixels: ndarray of shape (n, 2), (x, y) pairs
+    """
+    world_size = TILE_SIZE * 2 ** zoom
+    lat = np.radians(np.clip(points[:, 0], -85.05112878, 85.05112878))
+    x = (points[:, 1] + 180) / 360 * world_size
+    y = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2 * world_size
+    return np.column_stack((x, y))
+
+def tile_bounds(zoom, x, y):
+    """
+    Gets the lat/lng bounding box of a slippy map tile
+
+    Parameters:
+        zoom: int
+        x: int
+        y: int
+
+    Returns:
+        box: tuple of (south, west, north, east)
+    """
+    n = 2 ** zoom
+    def lat(tile_y):
+        return float(np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * tile_y / n)))))
+    return (lat(y + 1), x / n * 360 - 180, lat(y), (x + 1) / n * 360 - 180)
+
+def rasterize(tracks, pixel_box=None):
+    """
+    Draws every segment of every track as one pixel wide lines, vectorized across all tracks
+
+    Parameters:
+        tracks: list of ndarray of shape (n, 2), pixel coordinates
+        pixel_box: tuple of (min x, min y, max x, max y), segments entirely outside it are skipped
+
+    Returns:
+        track_ids: ndarray of int, which track each sampled pixel belongs to
+        pixels: ndarray of shape (m, 2) of int, (x, y) pairs
+    """
+    tracks = [track for track in tracks if len(track) > 0]
+    if not tracks:
+        return np.empty(0, dtype=np.int64), np.empty((0, 2), dtype=np.int64)
+    points = np.concatenate(tracks)
+    ids = np.repeat(np.arange(len(tracks)), [len(track) for track in tracks])
+
+    # segments join consecutive points of the same track, single point tracks get a zero length segment
+    same_track = ids[:-1] == ids[1:]
+    starts = np.concatenate((points[:-1][same_track], points[np.flatnonzero(np.diff(ids, append=-1) != 0)]))
+    ends = np.concatenate((points[1:][same_track], points[np.flatnonzero(np.diff(ids, append=-1) != 0)]))
+    segment_ids = np.concatenate((ids[:-1][same_track], ids[np.flatnonzero(np.diff(ids, append=-1) != 0)]))
+
+    if pixel_box is not None:
+        min_x, min_y, max_x, max_y = pixel_box
+        inside = ((np.maximum(starts[:, 0], ends[:, 0]) >= min_x) & (np.minimum(starts[:, 0], ends[:, 0]) < max_x) &
+                  (np.maximum(starts[:, 1], ends[:, 1]) >= min_y) & (np.minimum(starts[:, 1], ends[:, 1]) < max_y))
+        starts, ends, segment_ids = starts[inside], ends[inside], segment_ids[inside]
+
+    steps = np.maximum(np.ceil(np.abs(ends - starts).max(axis=1)).astype(np.int64), 1) if len(starts) else np.empty(0, dtype=np.int64)
+    segment = np.repeat(np.arange(len(starts)), steps)
+    fraction = (np.arange(len(segment)) - np.repeat(np.cumsum(steps) - steps, steps)) / steps[segment]
+    samples = starts[segment] + (ends - starts)[segment] * fraction[:, None]
+    return segment_ids[segment], np.floor(samples).astype(np.int64)
+
+def render_tile(tracks, zoom, x, y):
+    """
+    Renders a heatmap tile of how many tracks pass through each pixel
+
+    Parameters:
+        tracks: list of ndarray of shape (n, 2), (lat, lng) pairs
+        zoom: int
+        x: int
+        y: int
+
+    Returns:
+        png: bytes
+    """
+    origin = np.array([x * TILE_SIZE, y * TILE_SIZE])
+    track_ids, pixels = rasterize([project(track, zoom) for track in tracks], (origin[0], origin[1], origin[0] + TILE_SIZE, origin[1] + TILE_SIZE))
+    pixels = pixels - origin
+    in_tile = (pixels >= 0).all(axis=1) & (pixels < TILE_SIZE).all(axis=1)
+    # each track counts once per pixel however many of its samples land there
+    keys = np.unique(track_ids[in_tile] * TILE_SIZE * TILE_SIZE + pixels[in_tile, 1] * TILE_SIZE + pixels[in_tile, 0])
+    density = np.bincount(keys % (TILE_SIZE * TILE_SIZE), minlength=TILE_SIZE * TILE_SIZE).reshape(TILE_SIZE, TILE_SIZE)
+    return encode_png(colorize(density))
+
+def colorize(density):
+    """
+    Maps track counts to RGBA colours, log scaled from translucent red through yellow to white
+
+    Parameters:
+        density: ndarray of shape (height, width)
+
+    Returns:
+        rgba: ndarray of shape (height, width, 4) of uint8
+    """
+    intensity = np.clip(np.log1p(density) / np.log1p(HEATMAP_SATURATION), 0, 1)
+    rgba = np.zeros(density.shape + (4,), dtype=np.uint8)
+    rgba[..., 0] = 255
+    rgba[..., 1] = np.clip(intensity * 2 * 255, 0, 255)
+    rgba[..., 2] = np.clip((intensity - 0.5) * 2 * 255, 0, 255)
+    rgba[..., 3] = np.where(density > 0, 120 + intensity * 135, 0)
+    return rgba
+
+def encode_png(rgba):
+    """
+    Encodes an RGBA image as PNG
+
+    Parameters:
+        rgba: ndarray of shape (height, width, 4) of uint8
+
+    Returns:
+        png: bytes
+    """
+    height, width = rgba.shape[:2]
+    raw = np.concatenate((np.zeros((height, 1), dtype=np.uint8), rgba.reshape(height, width * 4)), axis=1) # filter type 0 per row
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)) +
+            chunk(b'IEND', b''))
+
+def touched_tiles(track, max_zoom=HEATMAP_MAX_ZOOM):
+    """
+    Finds every tile at every zoom level that a track is drawn on
+
+    Parameters:
+        track: ndarray of shape (n, 2), (lat, lng) pairs
+        max_zoom: int
+
+    Returns:
+        tiles: set of (zoom, x, y)
+    """
+    if len(track) == 0:
+        return set()
+    _, pixels = rasterize([project(track, max_zoom)])
+    tiles = np.unique(pixels // TILE_SIZE, axis=0)
+    touched = set()
+    for zoom in range(max_zoom, -1, -1):
+        touched.update((zoom, int(x), int(y)) for x, y in tiles)
+        tiles = np.unique(tiles // 2, axis=0) # parent tiles at the next zoom out
+    return touched
+
+_FINGERPRINT_MODULUS = 1 << 128
+
+def _track_hash(activity_id, polyline):
+    return int.from_bytes(hashlib.blake2b(f'{int(activity_id)}:{polyline}'.encode(), digest_size=16).digest(), 'big')
+
+def tracks_fingerprint(activity_ids, polylines):
+    """
+    Hashes the set of tracks, so tiles cached on disk are kept apart by the tracks they were drawn from
+
+    The fingerprint is a sum of a hash of every track, so it does not depend on their order and
+    update_fingerprint can change it one track at a time.
+
+    Parameters:
+        activity_ids: iterable of int
+        polylines: iterable of string
+
+    Returns:
+        fingerprint: string
+    """
+    return update_fingerprint(None, [], zip(activity_ids, polylines))
+
+def update_fingerprint(fingerprint, removed_tracks, added_tracks):
+    """
+    Updates a fingerprint from tracks_fingerprint for tracks that were removed or added, without
+    hashing every other track again
+
+    Parameters:
+        fingerprint: string, or None for the fingerprint of no tracks
+        removed_tracks: iterable of (activity id, polyline)
+        added_tracks: iterable of (activity id, polyline)
+
+    Returns:
+        fingerprint: string
+    """
+    total = int(fingerprint, 16) if fingerprint is not None else 0
+    total -= sum(_track_hash(id, polyline) for id, polyline in removed_tracks if polyline)
+    total += sum(_track_hash(id, polyline) for id, polyline in added_tracks if polyline)
+    return f'{total % _FINGERPRINT_MODULUS:032x}'
+
+class HeatmapTileCache:
+    """
+    Disk-backed cache of rendered heatmap tiles with least recently used eviction
+
+    Tiles are stored under the fingerprint of the tracks they were drawn from, so every process
+    serving the athlete can share the directory, and one still serving an older snapshot never
+    mixes its tiles with those of newer tracks. When the tracks change, the writer records which
+    tiles changed, and every other tile is carried over from the previous fingerprint on its next
+    request instead of being rendered again.
+
+    Parameters:
+        directory: string
+        max_tiles: int
+        writer: boolean, the one process recording track changes and removing the tiles of old fingerprints
+    """
+    def __init__(self, directory, max_tiles=20000, writer=True):
+        self.directory = directory
+        self.max_tiles = max_tiles
+        self.writer = writer
+        self._lock = threading.Lock()
+        self._tiles = OrderedDict() # (fingerprint, zoom, x, y) -> path of the tiles this process saved, least recently used first
+        self._lineage = OrderedDict() # fingerprint -> (previous fingerprint, changed tiles), as the writer recorded them
+        self._fingerprint = None # of the tracks being served, rendered tiles are only saved for them
+        self._changing = False # the tracks are being changed, tiles rendered now may mix old and new ones
+        self._generation = 0 # bumped by every change of the tracks, tiles rendered across one are not saved
+        os.makedirs(directory, exist_ok=True)
+        existing = []
+        for root, _, files in os.walk(directory):
+            parts = os.path.relpath(root, directory).split(os.sep)
+            if len(parts) != 3: # not a fingerprint/zoom/x directory of tiles
+                continue
+            for name in files:
+                if name.endswith('.png'):
+                    path = os.path.join(root, name)
+                    existing.append((os.path.getmtime(path), (parts[0], int(parts[1]), int(parts[2]), int(name[:-4])), path))
+        for _, key, path in sorted(existing):
+            self._tiles[key] = path
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[0], str(key[1]), str(key[2]), f'{key[3]}.png')
+
+    def get(self, fingerprint, zoom, x, y, render):
+        """
+        Gets a tile from disk, carrying it over from an earlier fingerprint or rendering it on a
+        miss. A tile rendered while the tracks were changing, or for tracks no longer served, is
+        returned but not saved.
+
+        Parameters:
+            fingerprint: string, of the tracks render draws
+            zoom: int
+            x: int
+            y: int
+            render: callable returning png bytes
+
+        Returns:
+            png: bytes
+        """
+        key = (fingerprint, zoom, x, y)
+        with self._lock:
+            generation = self._generation
+            if key in self._tiles:
+                self._tiles.move_to_end(key)
+        png = _read_file(self._path(key)) # saved by this or any other process serving the athlete
+        if png is not None:
+            return png
+        png = self._carry_over(key)
+        if png is not None:
+            self._save(key, png)
+            return png
+        png = render()
+        self._save(key, png, generation)
+        return png
+
+    def _carry_over(self, key):
+        # the tile of the newest earlier fingerprint it did not change since
+        fingerprint, tile = key[0], key[1:]
+        for _ in range(TILE_FINGERPRINTS_KEPT):
+            lineage = self._read_lineage(fingerprint)
+            if lineage is None:
+                return None
+            fingerprint, changed_tiles = lineage
+            if fingerprint is None or tile in changed_tiles:
+                return None
+            png = _read_file(self._path((fingerprint, *tile)))
+            if png is not None:
+                return png
+        return None
+
+    def _read_lineage(self, fingerprint):
+        with self._lock:
+            lineage = self._lineage.get(fingerprint)
+        if lineage is not None:
+            return lineage
+        try:
+            with open(os.path.join(self.directory, fingerprint, _LINEAGE_FILENAME)) as file:
+                recorded = json.load(file)
+        except FileNotFoundError: # predates the writer recording it, or already removed
+            return None
+        lineage = (recorded['previous'], {tuple(tile) for tile in recorded['changed_tiles']} if recorded['changed_tiles'] is not None else None)
+        if lineage[1] is None: # nothing is known to be the same as before
+            lineage = (None, set())
+        with self._lock:
+            self._lineage[fingerprint] = lineage
+            while len(self._lineage) > 2 * TILE_FINGERPRINTS_KEPT:
+                self._lineage.popitem(last=False)
+        return lineage
+
+    def _save(self, key, png, generation=None):
+        # a carried over tile is saved whatever the tracks are now, a rendered one only if they did not change while it was drawn
+        fingerprint_directory = os.path.join(self.directory, key[0])
+        if not os.path.isdir(fingerprint_directory): # removed by the writer, nothing serves these tracks anymore
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporary_path, 'wb') as file:
+            file.write(png)
+        with self._lock:
+            if generation is not None and (self._generation != generation or self._changing or key[0] != self._fingerprint):
+                _remove_file(temporary_path)
+                return
+            os.replace(temporary_path, path) # readers never see a partly written tile
+            self._tiles[key] = path
+            self._tiles.move_to_end(key)
+            while len(self._tiles) > self.max_tiles:
+                _, evicted_path = self._tiles.popitem(last=False)
+                _remove_file(evicted_path)
+
+    def has_tiles(self):
+        """
+        Checks whether any tile is saved for the tracks being served, by any process
+
+        Returns:
+            has_tiles: boolean
+        """
+        if self._fingerprint is None:
+            return False
+        try:
+            with os.scandir(os.path.join(self.directory, self._fingerprint)) as entries:
+                return any(entry.is_dir() for entry in entries)
+        except (FileNotFoundError, NotADirectoryError):
+            return False
+
+    def begin_change(self):
+        """
+        Stops saving rendered tiles until finish_change, called before the tracks they are drawn from change
+        """
+        with self._lock:
+            self._changing = True
+            self._generation += 1
+
+    def finish_change(self, fingerprint, changed_tiles=None):
+        """
+        Saves rendered tiles under the fingerprint of the tracks now served. The writer also
+        records which tiles changed since the previous fingerprint, so every other tile is carried
+        over, and removes the tiles of fingerprints older than the newest TILE_FINGERPRINTS_KEPT.
+
+        Parameters:
+            fingerprint: string
+            changed_tiles: set of (zoom, x, y) drawn differently than for the previous fingerprint,
+                or None if unknown, which carries nothing over
+
+        Returns:
+            none
+        """
+        if self.writer:
+            fingerprint_directory = os.path.join(self.directory, fingerprint)
+            lineage_path = os.path.join(fingerprint_directory, _LINEAGE_FILENAME)
+            if os.path.exists(lineage_path): # tracks changed back, their tiles are still right
+                os.utime(lineage_path)
+            else:
+                os.makedirs(fingerprint_directory, exist_ok=True)
+                previous = self._fingerprint if changed_tiles is not None and self._fingerprint != fingerprint else None
+                temporary_path = f'{lineage_path}.{os.getpid()}.tmp'
+                with open(temporary_path, 'w') as file:
+                    json.dump({'previous': previous, 'changed_tiles': sorted(changed_tiles) if previous is not None else None}, file)
+                os.replace(temporary_path, lineage_path)
+            self._remove_old_fingerprints()
+        with self._lock:
+            self._fingerprint = fingerprint
+            self._changing = False
+            self._generation += 1
+
+    def _remove_old_fingerprints(self):
+        recorded = []
+        for entry in os.scandir(self.directory):
+            try:
+                recorded.append((os.stat(os.path.join(entry.path, _LINEAGE_FILENAME)).st_mtime_ns, entry.name))
+            except (FileNotFoundError, NotADirectoryError):
+                recorded.append((-1, entry.name)) # tiles from before fingerprint directories, or a stray file
+        recorded.sort(reverse=True)
+        removed = {name for _, name in recorded[TILE_FINGERPRINTS_KEPT:]} | {name for mtime, name in recorded if mtime < 0}
+        if not removed:
+            return
+        for name in removed:
+            path = os.path.join(self.directory, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                _remove_file(path)
+        with self._lock:
+            self._tiles = OrderedDict((key, path) for key, path in self._tiles.items() if key[0] not in removed)
+
+def _read_file(path):
+    try:
+        with open(path, 'rb') as file:
+            return file.read()
+    except FileNotFoundError: # not saved, or evicted or removed since
+        return None
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
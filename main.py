@@ -1,12 +1,76 @@
-from flask import Flask, render_template, jsonify, session, request
-import requests
+from flask import Flask, Blueprint, Response, render_template, jsonify, session, request, current_app, abort, redirect, url_for, g
+import contextlib
+import csv
+import math
+import os
+import secrets
+import shutil
+import threading
+import time
 import urllib3
+import requests
 import pandas as pd
 import numpy as np
-import pytz
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from config import SECRET_KEY, CLIENT_ID, CLIENT_SECRET, REFRESH_TOKEN 
+import activity_store
+import event_store
+import token_store
+import stream_store
+import rollup_store
+import rollups
+import routes
+import snapshot
+import curves
+import stats
+from activity_model import build_activity_frame, replace_activities
+from dataset import Dataset, DatasetCache
+from athlete_data import AthleteData
+from sync_worker import SyncWorker
+import webhook
+from webhook import WebhookWorker
+from strava_client import StravaClient, HIGH_PRIORITY, LOW_PRIORITY, RateLimitExceeded, RateLimitDeferred
+from geometry import decode_polyline, zoom_level, GEOMETRY_ZOOM_LEVELS
+from spatial_index import parse_bounds, snap_bounds, split_antimeridian
+import segment_explorer
+import heatmap
+import metrics
+from metrics import timed_stage
+from response_cache import ResponseCache, dumps
+
+TOKEN_STORE_FILENAME = 'tokens.sqlite'
+EVENT_STORE_FILENAME = 'webhook_events.sqlite' # push events received by web workers, applied by the sync process
+ATHLETE_DIRECTORY = 'athletes' # one directory of synced data per logged in athlete
+DATASET_CACHE_MAX_BYTES = 512 * 1024 * 1024 # memory for the datasets of recently active athletes
+SYNC_RECHECK_DAYS = 7 # days before the high water mark re-checked for edited and deleted activities
+SYNC_INTERVAL_SECONDS = 15 * 60
+ACTIVITY_PAGE_SIZE = 200 # most activities Strava returns per page
+ACTIVITY_PAGE_CONCURRENCY = 8 # simultaneous page requests on a full sync
+ACTIVITY_CRAWL_ATTEMPTS = 3 # full crawls tried before settling for one that saw activities change
+MEDIA_CONCURRENCY = 8 # simultaneous activity requests when getting media
+MEDIA_CHECKPOINT_SIZE = 25 # new media rows fetched between saves to the csv file
+STREAMS_PER_SYNC = 100 # activities whose streams are fetched each sync, newest first, so backfilling spreads over many syncs
+STREAM_KEYS = 'time,watts,heartrate,velocity_smooth,distance'
+WEBHOOK_VERIFY_TOKEN = os.environ.get('STRAVA_WEBHOOK_VERIFY_TOKEN') # chosen when creating the push subscription, the webhook is off without it
+WEBHOOK_SUBSCRIPTION_ID = os.environ.get('STRAVA_WEBHOOK_SUBSCRIPTION_ID') # events from any other subscription are rejected when set
+WEBHOOK_EVENT_LOG = os.environ.get('STRAVA_WEBHOOK_EVENT_LOG') # json lines file received events are appended to, for replay_webhook_events.py
+SNAPSHOT_POLL_SECONDS = 1.0 # how often processes that do not sync check for a newer snapshot
+SYNC_POLL_SECONDS = 2.0 # how often the sync process checks for queued webhook events and athletes who logged in
+SYNC_MAX_ATHLETES = 64 # athletes the sync process keeps loaded and syncing, the most recently active
+ATHLETE_ACTIVE_DAYS = 14 # athletes who used the app or got a push event this recently are kept syncing by the sync process
+ACTIVE_MARK_SECONDS = 60 * 60 # how often a process records that an athlete is still active
+SNAPSHOT_DEBOUNCE_SECONDS = 5.0 # webhook events applied this soon after one another are written in one snapshot
+ACTIVITY_DETAIL_FIELDS = ['description', 'photos', 'segment_efforts', 'splits_metric', 'splits_standard', 'laps', 'best_efforts', 'similar_activities'] # only in activity details, not kept in the store
+
+# To be updated as dynamic for user input 
+bounds = [51.036047, -114.150184, 51.054738, -114.111313]
 
-app = Flask(__name__)
+bp = Blueprint('dashboard', __name__)
+strava = StravaClient() # shared by every request to the Strava API
+response_cache = ResponseCache() # rendered pages and api payloads, keyed by dataset version
+configured_token = {} # token response of the athlete in config.py, reused until shortly before it expires
+configured_token_lock = threading.Lock()
+active_marked_at = {} # athlete id -> when this process last recorded them as active
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 def save_data_to_csv(data, filename):
@@ -49,73 +113,271 @@ def request_access_token(client_id, client_secret, refresh_token):
         refresh_token: string
     
     Returns:
-        access_token: string
+        token: dict, Strava token response json with access_token, refresh_token and expires_at
     """
-    auth_url = "https://www.strava.com/oauth/token"
-    payload = {
-        'client_id': client_id,
-        'client_secret': client_secret,
-        'refresh_token': refresh_token,
-        'grant_type': 'refresh_token',
-        'f': 'json'
-    }
     print("\nRequesting Access Token...")
-    res = requests.post(auth_url, data=payload, verify=False)
-    access_token = res.json()['access_token']
-    print(f"\nAccess Token = {access_token}")
+    return strava.request_access_token(client_id, client_secret, refresh_token)
+
+def get_athlete_access_token(athlete):
+    """
+    Gets an access token for an athlete, from config.py for the configured athlete, otherwise from the
+    token store, refreshed shortly before it expires
+
+    Parameters:
+        athlete: AthleteData
+
+    Returns:
+        access_token: string
+    """
+    if athlete.athlete_id is None:
+        with configured_token_lock:
+            if configured_token.get('expires_at', 0) - time.time() <= token_store.TOKEN_REFRESH_MARGIN:
+                configured_token.update(request_access_token(CLIENT_ID, CLIENT_SECRET, configured_token.get('refresh_token', REFRESH_TOKEN))) # Strava may rotate the refresh token
+            return configured_token['access_token']
+    access_token = token_store.get_access_token(TOKEN_STORE_FILENAME, athlete.athlete_id,
+        lambda refresh_token: strava.request_access_token(CLIENT_ID, CLIENT_SECRET, refresh_token))
+    if access_token is None:
+        raise RuntimeError(f'No Strava tokens stored for athlete {athlete.athlete_id}, they need to log in again')
     return access_token
 
-def get_activity_data(access_token):
+def save_activity_page(store_filename, page, seen_ids):
     """
-    Get request for Strava user activity data 
+    Saves a page of activities to the store as soon as it arrives, keeping only their ids
 
     Parameters:
-        client_id: string
-        client_secret: string
-        refresh_token: string
-    
+        store_filename: string
+        page: list of dict
+        seen_ids: set of int, the page's activity ids are added
+
     Returns:
-        all_activities_df: DataFrame
-        all_activities_list: list
+        newest: int, start time of the newest activity on the page, or None if it is empty
+    """
+    if not page:
+        return None
+    activity_store.upsert_activities(store_filename, page)
+    seen_ids.update(activity['id'] for activity in page)
+    return max(activity_store.start_date_to_epoch(activity['start_date']) for activity in page)
+
+def get_activity_pages(access_token, store_filename, after):
+    """
+    Get request for every page of Strava user activities after a point in time, saving each page as it arrives
+
+    Parameters:
+        access_token: string
+        store_filename: string
+        after: int
+
+    Returns:
+        seen_ids: set of int
+        newest: int, start time of the newest activity, or None if there were none
     """
-    print("\nGetting Activity Data...")
-    activities_url = "https://www.strava.com/api/v3/athlete/activities"
-    header = {'Authorization': 'Bearer ' + access_token}
     request_page_num = 1
-    all_activities_list = []
-    
+    seen_ids = set()
+    newest = None
+
     while True: # since max 200 activities can be accessed per request, while loop runs until all activities are loaded
-        param = {'per_page': 200, 'page': request_page_num}
-        get_activities = requests.get(activities_url, headers=header,params=param).json()
+        get_activities = strava.get('/athlete/activities', access_token, {'per_page': ACTIVITY_PAGE_SIZE, 'page': request_page_num, 'after': after}, wait=True)
         if len(get_activities) == 0: # exit condition
             break
-        all_activities_list.extend(get_activities)
-        print(f'\t- Activities: {len(all_activities_list) - len(get_activities)} to {len(all_activities_list)}')
+        newest = max(newest or 0, save_activity_page(store_filename, get_activities, seen_ids)) # the page is not empty
+        print(f'\t- Activities: {len(seen_ids) - len(get_activities)} to {len(seen_ids)}')
         request_page_num += 1
+
+    return seen_ids, newest
+
+def get_activity_count(access_token):
+    """
+    Get request for the number of activities the athlete has, from their stats
+
+    Strava only totals rides, runs and swims, so athletes with other sport types have more.
+
+    Parameters:
+        access_token: string
+
+    Returns:
+        count: int
+    """
+    athlete_id = strava.get('/athlete', access_token, wait=True)['id']
+    athlete_stats = strava.get(f'/athletes/{athlete_id}/stats', access_token, wait=True)
+    return sum((athlete_stats.get(f'all_{kind}_totals') or {}).get('count', 0) for kind in ('ride', 'run', 'swim'))
+
+def pages_consistent(page_bounds, page_count, unique_count):
+    """
+    Checks the pages of a crawl fit together, newest activity first, as they would if nothing
+    changed while they were fetched. An activity added or removed mid-crawl shifts every later
+    page, so one page repeats activities of the next, the pages overlap in time or a page before
+    the end comes back short.
+
+    Parameters:
+        page_bounds: dict of page number -> (activity count, first start time, last start time)
+        page_count: int, pages up to and including the first that was not full
+        unique_count: int, activities on the pages after de-duplicating by id
+
+    Returns:
+        consistent: boolean
+    """
+    if sum(count for count, _, _ in page_bounds.values()) != unique_count:
+        return False
+    previous_last = None
+    for page_num, (count, first, last) in sorted(page_bounds.items()):
+        if page_num > page_count:
+            if count > 0: # nothing comes after the end
+                return False
+            continue
+        if count < ACTIVITY_PAGE_SIZE and page_num < page_count:
+            return False
+        if count > 0 and previous_last is not None and first > previous_last:
+            return False
+        previous_last = last if count > 0 else previous_last
+    return True
+
+def crawl_activity_pages(access_token, store_filename, concurrency=ACTIVITY_PAGE_CONCURRENCY):
+    """
+    Get request for every page of Strava user activities, fetched concurrently, saving each page as it arrives
+
+    The athlete's activity count says how many pages to request at once. It leaves out some sport
+    types, so pages past it are requested a few at a time until one comes back short. If the
+    pages do not fit together, or the count changed by the end, activities were added or removed
+    mid-crawl and the history is crawled again.
+
+    Parameters:
+        access_token: string
+        store_filename: string
+        concurrency: int
+
+    Returns:
+        seen_ids: set of int, activities on the first consistent crawl, or on any crawl if none was
+        newest: int, start time of the newest activity, or None if there were none
+    """
+    all_seen_ids = set()
+    newest = None
+    for attempt in range(1, ACTIVITY_CRAWL_ATTEMPTS + 1):
+        activity_count = get_activity_count(access_token)
+        expected_pages = max(1, math.ceil(activity_count / ACTIVITY_PAGE_SIZE))
+        print(f'\t- Expecting at least {activity_count} activities on {expected_pages} pages')
+        seen_ids = set()
+        page_bounds = {}
+        page_count = None # first page that was not full
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            def request_page(page_num):
+                return executor.submit(strava.get, '/athlete/activities', access_token, {'per_page': ACTIVITY_PAGE_SIZE, 'page': page_num}, wait=True)
+            futures = {request_page(page_num): page_num for page_num in range(1, expected_pages + 1)}
+            next_page_num = expected_pages + 1
+            try:
+                while futures:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        page_num = futures.pop(future)
+                        page = future.result()
+                        epochs = [activity_store.start_date_to_epoch(activity['start_date']) for activity in page]
+                        page_bounds[page_num] = (len(page), epochs[0] if page else None, epochs[-1] if page else None)
+                        page_newest = save_activity_page(store_filename, page, seen_ids)
+                        if page_newest is not None:
+                            newest = max(newest or 0, page_newest)
+                        if len(page) < ACTIVITY_PAGE_SIZE:
+                            page_count = min(page_count or page_num, page_num)
+                        else:
+                            print(f'\t- Activities: page {page_num}, {len(seen_ids)} so far')
+                    while page_count is None and len(futures) < concurrency: # more activities than the count, keep going
+                        futures[request_page(next_page_num)] = next_page_num
+                        next_page_num += 1
+            except Exception: # don't wait for pages still queued
+                for future in futures:
+                    future.cancel()
+                raise
+
+        all_seen_ids |= seen_ids
+        if pages_consistent(page_bounds, page_count, len(seen_ids)) and get_activity_count(access_token) == activity_count:
+            return seen_ids, newest
+        if attempt < ACTIVITY_CRAWL_ATTEMPTS:
+            print('\t- Activities changed during the crawl, crawling again')
+
+    print('\t- Activities kept changing, keeping every activity seen')
+    return all_seen_ids, newest
+
+@timed_stage('get_activity_data')
+def get_activity_data(access_token, store_filename, recheck_days=SYNC_RECHECK_DAYS):
+    """
+    Syncs Strava user activity data into the local activity store and loads it
+
+    The first sync crawls the whole history. Later syncs only request activities newer than the 
+    high water mark, minus a window of recent days that is re-checked for edits and deletions.
+
+    Parameters:
+        access_token: string
+        store_filename: string
+        recheck_days: int
     
-    all_activities_df = pd.DataFrame(all_activities_list)
-    return all_activities_df, all_activities_list
+    Returns:
+        all_activities_df: DataFrame
+        polylines: PolylineStore
+    """
+    print("\nGetting Activity Data...")
+    high_water_mark = activity_store.get_high_water_mark(store_filename)
+
+    if high_water_mark is None:
+        print('\t- Full Sync')
+        after = None
+        seen_ids, newest = crawl_activity_pages(access_token, store_filename)
+    else:
+        after = high_water_mark - recheck_days * 24 * 60 * 60
+        print(f'\t- Incremental Sync, re-checking last {recheck_days} days')
+        seen_ids, newest = get_activity_pages(access_token, store_filename, after)
+
+    # stored activities Strava no longer returns were deleted, on a full sync these were only seen by an earlier crawl
+    deleted_ids = activity_store.get_activity_ids_after(store_filename, after if after is not None else -1) - seen_ids
+    if deleted_ids:
+        print(f'\t- Removing {len(deleted_ids)} deleted activities')
+        activity_store.delete_activities(store_filename, deleted_ids)
+
+    if newest is not None:
+        activity_store.set_high_water_mark(store_filename, max(newest, high_water_mark or 0))
 
-def get_activity_media(data_frame, access_token, filename):
+    all_activities_df, polylines = build_activity_frame(activity_store.iter_activities(store_filename))
+    return all_activities_df, polylines
+
+def get_activity_photo(activity_id, access_token):
+    """
+    Get request for the primary photo of a single Strava activity
+
+    Parameters:
+        activity_id: int
+        access_token: string
+
+    Returns:
+        media_row: dict
+    """
+    recent_act = strava.get('/activities/' + str(activity_id), access_token, priority=LOW_PRIORITY)
+    photo = recent_act['photos']['primary']['urls']['600']
+    name = recent_act['name']
+    return {'id': activity_id, 'photo': photo, 'name': name}
+
+@timed_stage('get_activity_media')
+def get_activity_media(data_frame, access_token, filename, concurrency=MEDIA_CONCURRENCY):
     """
     Get request for Strava activity media
 
+    Activities are fetched concurrently. New rows are saved to the csv file every 
+    MEDIA_CHECKPOINT_SIZE activities so an interrupted run resumes where it stopped.
+
     Parameters:
         data_frame: DataFrame
         access_token: string
         filename: string
+        concurrency: int
 
     Returns:
-        photo_activity_mapping: dict
+        photos: dict of activity id -> (photo url, activity name)
     """
 
     print('\nGetting Activity Media...')
 
-    photo_activity_mapping = {}
-    existing_data = load_data_from_csv(filename)
+    recorded_data = load_data_from_csv(filename)
+    existing_data = latest_media_rows(recorded_data)
+    existing_ids = existing_data['id'] if 'id' in existing_data else []
 
     new_media_rows = data_frame[ # cross reference all activities with existing data to check for new media
-        (data_frame['id'].isin(existing_data['id']) == False) & 
+        (data_frame['id'].isin(existing_ids) == False) & 
         (data_frame['total_photo_count'] > 0) & 
         (data_frame['type'] != 'VirtualRide') & 
         (data_frame['type'] != 'VirtualRun')
@@ -123,51 +385,216 @@ def get_activity_media(data_frame, access_token, filename):
     
     if(new_media_rows.empty == True):
         print('\t- No New Media')
-    else: 
-        print('\t- Getting New Media')
-        new_media_rows_formatted = pd.DataFrame(columns=['id', 'photo', 'name'])
-        for index, row in new_media_rows.iterrows(): # initiate get request for all activities with new media and add to dictionary 
-            id = row['id']
-            activity_url = "https://www.strava.com/api/v3/activities/" + str(id)
-            header = {'Authorization': 'Bearer ' + access_token}
-            recent_act = requests.get(activity_url, headers=header).json()
-            photo = recent_act['photos']['primary']['urls']['600']
-            name = recent_act['name']
-            print(f'\t\t{name}')
-            photo_activity_mapping[photo] = name
-            new_media_rows_formatted = pd.concat([new_media_rows_formatted, pd.DataFrame({'id': id, 'photo': photo, 'name': name}, index=[0])])
-    
-        updated_data = pd.concat([new_media_rows_formatted, existing_data])
-        save_data_to_csv(updated_data, filename) # save new data to csv in order to minimize future get requests
+        if len(existing_data) < len(recorded_data): # fold in the rows webhook events appended
+            save_data_to_csv(existing_data, filename)
+        return load_activity_media(filename)
+
+    print(f'\t- Getting New Media for {len(new_media_rows)} activities')
+    fetched_rows = []
+    saved_count = 0
+    deferred_count = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor: # initiate get requests for all activities with new media
+        futures = {executor.submit(get_activity_photo, id, access_token): id for id in new_media_rows['id']}
+        for future in as_completed(futures):
+            try:
+                fetched_rows.append(future.result())
+            except RateLimitDeferred: # rate limit budget is low, remaining media is fetched on a later sync
+                deferred_count += 1
+                continue
+            except Exception as e: # skip this activity, it is retried on the next sync
+                print(f'\t\tFailed to get media for activity {futures[future]}: {e!r}')
+                continue
+            print(f"\t\t{fetched_rows[-1]['name']}")
+            if len(fetched_rows) - saved_count >= MEDIA_CHECKPOINT_SIZE:
+                save_data_to_csv(pd.concat([pd.DataFrame(fetched_rows), existing_data]), filename) # save progress so far
+                saved_count = len(fetched_rows)
+
+    if deferred_count > 0:
+        print(f'\t- Deferred media for {deferred_count} activities to save rate limit budget')
+    if len(fetched_rows) > saved_count:
+        save_data_to_csv(pd.concat([pd.DataFrame(fetched_rows), existing_data]), filename) # save new data to csv in order to minimize future get requests
+
+    return load_activity_media(filename)
+
+def save_activity_media_row(filename, activity_id, media_row):
+    """
+    Records one activity's media row, or that it has none, at the end of the media csv file
 
-    for index, row in existing_data.iterrows(): # load all saved media into dictionary 
-        photo = row['photo']
-        name = row['name']
-        photo_activity_mapping[photo] = name
-    
-    return photo_activity_mapping
+    The file is not rewritten, latest_media_rows keeps the last row recorded for every activity
+    and the next sync folds the appended rows in.
+
+    Parameters:
+        filename: string
+        activity_id: int
+        media_row: dict, or None to remove the activity's row
+
+    Returns:
+        none
+    """
+    try:
+        with open(filename, newline='') as file:
+            columns = next(csv.reader(file), None)
+    except FileNotFoundError:
+        columns = None
+    if columns is None and media_row is None: # no media recorded, nothing to remove
+        return
+    row = media_row if media_row is not None else {'id': activity_id, 'photo': None, 'name': None}
+    pd.DataFrame([row], columns=columns or list(row)).to_csv(filename, mode='a', header=columns is None, index=False)
+
+def latest_media_rows(data):
+    """
+    Keeps the last row recorded for every activity in the media csv data, and drops activities whose media was removed
+
+    Parameters:
+        data: DataFrame
+
+    Returns:
+        data: DataFrame
+    """
+    if data.empty:
+        return data
+    data = data.drop_duplicates('id', keep='last')
+    return data[data['photo'].notna()]
+
+def load_activity_media(filename):
+    """
+    Loads previously fetched activity media from csv file without any requests
+
+    Parameters:
+        filename: string
+
+    Returns:
+        photos: dict of activity id -> (photo url, activity name)
+    """
+    existing_data = latest_media_rows(load_data_from_csv(filename))
+    if existing_data.empty:
+        return {}
+    return dict(zip(existing_data['id'].tolist(), zip(existing_data['photo'], existing_data['name'])))
+
+def get_activity_streams(activity_id, access_token):
+    """
+    Get request for the time series streams of a single Strava activity
+
+    Parameters:
+        activity_id: int
+        access_token: string
+
+    Returns:
+        streams: dict of stream type -> ndarray, empty for activities without streams
+    """
+    try:
+        streams = strava.get(f'/activities/{activity_id}/streams', access_token, {'keys': STREAM_KEYS, 'key_by_type': 'true'}, priority=LOW_PRIORITY)
+    except requests.HTTPError as e:
+        if e.response is not None and e.response.status_code == 404: # manual activities have no streams
+            return {}
+        raise
+    return {stream_type: np.asarray(stream['data']) for stream_type, stream in streams.items() if stream_type in stream_store.STREAM_DTYPES}
+
+@timed_stage('get_new_activity_streams')
+def get_new_activity_streams(data_frame, access_token, filename, concurrency=MEDIA_CONCURRENCY, limit=STREAMS_PER_SYNC):
+    """
+    Fetches streams for activities that have none stored yet, and caches their best effort curves
+
+    Parameters:
+        data_frame: DataFrame
+        access_token: string
+        filename: string
+        concurrency: int
+        limit: int, activities fetched in this sync
+
+    Returns:
+        none
+    """
+    print('\nGetting Activity Streams...')
+    fetched_ids = stream_store.get_fetched_ids(filename)
+    removed_ids = fetched_ids - set(data_frame['id'].tolist())
+    if removed_ids:
+        stream_store.delete_streams(filename, removed_ids)
+
+    recalculated_count = stream_store.recalculate_curves(filename, dict(zip(data_frame['id'].tolist(), data_frame['type'].astype(str))), curves.activity_curves)
+    if recalculated_count > 0:
+        print(f'\t- Recalculated Curves for {recalculated_count} activities')
+
+    curve_types = {type for types in curves.CURVE_TYPES.values() for type in types}
+    new_stream_rows = data_frame[(data_frame['type'].isin(curve_types)) & (data_frame['id'].isin(fetched_ids) == False)]
+    if new_stream_rows.empty:
+        print('\t- No New Streams')
+        return
+    new_ids = new_stream_rows['id'].iloc[::-1][:limit].tolist() # newest first
+    types = dict(zip(new_stream_rows['id'], new_stream_rows['type']))
+    print(f'\t- Getting Streams for {len(new_ids)} of {len(new_stream_rows)} activities')
+
+    deferred_count = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(get_activity_streams, id, access_token): id for id in new_ids}
+        for future in as_completed(futures):
+            id = futures[future]
+            try:
+                streams = future.result()
+            except RateLimitDeferred: # rate limit budget is low, remaining streams are fetched on a later sync
+                deferred_count += 1
+                continue
+            except Exception as e: # skip this activity, it is retried on the next sync
+                print(f'\t\tFailed to get streams for activity {id}: {e!r}')
+                continue
+            stream_store.save_activity_streams(filename, id, streams, curves.activity_curves(types[id], streams))
+
+    if deferred_count > 0:
+        print(f'\t- Deferred streams for {deferred_count} activities to save rate limit budget')
+
+def load_curves(filename, data_frame):
+    """
+    Loads the cached best effort curves of the DataFrame's activities
+
+    Parameters:
+        filename: string
+        data_frame: DataFrame
+
+    Returns:
+        curve_matrices: dict of curve kind -> CurveMatrix, positions are DataFrame rows
+    """
+    return {kind: stream_store.load_curve_matrix(filename, kind, data_frame['id'].to_numpy()) for kind in curves.CURVE_TYPES}
+
+@timed_stage('update_rollups')
+def load_rollups(filename, data_frame):
+    """
+    Brings the weekly, monthly and yearly rollups up to date with the activities and loads them
+
+    Only new, edited and removed activities are applied, so this is cheap after the first time.
+
+    Parameters:
+        filename: string
+        data_frame: DataFrame
+
+    Returns:
+        rollups: RollupTable
+    """
+    changed_count, _ = rollup_store.update_rollups(filename, data_frame)
+    if changed_count > 0:
+        print(f'\t- Rolled up {changed_count} new, edited or removed activities')
+    return rollups.RollupTable(rollup_store.load_rollups(filename))
 
-def get_segments(bounds, access_token):
+@timed_stage('get_segments')
+def get_segments(bounds, access_token, segment_cache, priority=LOW_PRIORITY):
     """
-    Get request for Strava segment data within defined area
+    Explores Strava segments within an area and fetches their details into the segment cache
 
     Paramaters:
         bounds: list of type double
         access_token: string
+        segment_cache: SegmentCache
+        priority: HIGH_PRIORITY or LOW_PRIORITY
 
     Returns:
-        all_segments_df: DataFrame
+        all_segments_df: DataFrame, PR and KOM comparison of every segment in the area
     """
     print("\nGetting Segment Data...")
-    segments_url = "https://www.strava.com/api/v3/segments/explore"
-    header = {'Authorization': 'Bearer ' + access_token}
-    param = {'bounds': ','.join(str(coord) for coord in bounds)}
-    get_segments = requests.get(segments_url, headers=header, params=param).json()
-    all_segments = pd.DataFrame(get_segments)
-    normalized_data = pd.json_normalize(all_segments['segments'])
-    all_segments_df = pd.concat([all_segments, normalized_data], axis=1)
-    all_segments_df.drop(columns=['segments'], inplace=True)
-    return all_segments_df
+    def get(path, params):
+        return strava.get(path, access_token, params, priority=priority)
+    segment_ids, request_count = segment_cache.explore(get, bounds)
+    fetched_count = segment_cache.fetch_details(get, segment_ids)
+    print(f'\t- {len(segment_ids)} segments from {request_count} explore requests, {fetched_count} details fetched')
+    return segment_explorer.compare_segments(segment_cache.query(bounds))
 
 def get_start_end_dates(data_frame):
     """
@@ -185,49 +612,39 @@ def get_start_end_dates(data_frame):
     end_date = request.args.get('end_date')
 
     # processing and fomratting dates
+    today = pd.Timestamp.now(tz='UTC').normalize() # the range shown before an athlete has any activities
     if start_date != None:
         start_date = pd.to_datetime(start_date).tz_localize('UTC')
+    elif len(data_frame) > 0:
+        start_date = data_frame['start_date_formatted'].iloc[0] # activities are sorted by start time
     else:
-        start_date = data_frame['start_date_formatted'].min()
+        start_date = today
 
     if end_date != None:
         end_date = pd.to_datetime(end_date).tz_localize('UTC')
+    elif len(data_frame) > 0:
+        end_date = data_frame['start_date_formatted'].iloc[-1]
     else:
-        end_date = data_frame['start_date_formatted'].max()
+        end_date = today + pd.Timedelta(days=1) - pd.Timedelta(seconds=1)
 
     return start_date, end_date
 
-def calculate_recent_activity_stats(data_frame):
+def get_map_date_range(data_frame):
     """
-    Calculates basic stats from most recent activity
+    Get date range for map requests, from the query string if given, otherwise the range the page was last rendered with
 
-    Parameters:
+    Paramaters:
         data_frame: DataFrame
 
     Returns:
-        date: string
-        name: string
-        type: string
-        distance: double
+        start_date: Timestamp
+        end_date: Timestamp
     """
-    date = data_frame.loc[0, 'start_date']
-    date_formatted = pd.to_datetime(date)
-    mt_timezone = pytz.timezone('US/Mountain')
-    date_mt = date_formatted.astimezone(mt_timezone)
-    date_formatted = date_mt.strftime("%B %d, %Y at %I:%M%p")
-
-
-    name = data_frame.loc[0, 'name']
-    type = data_frame.loc[0, 'type']
-    distance = round(data_frame.loc[0, 'distance'] / 1000, 1)
-
-    return(
-        date_formatted,
-        name,
-        type,
-        distance,
-    )
+    if request.args.get('start_date') is None and session.get('start_date') is not None:
+        return pd.to_datetime(session['start_date'], utc=True), pd.to_datetime(session['end_date'], utc=True)
+    return get_start_end_dates(data_frame)
 
+@timed_stage('calculate_lifetime_stats')
 def calculate_lifetime_stats(data_frame, start_date, end_date):
     """
     Calculates basic cumulative stats from all activities within date range
@@ -246,44 +663,10 @@ def calculate_lifetime_stats(data_frame, start_date, end_date):
         times_around_earth: double
         times_up_everest: double
     """
-    data_frame['heart_beats'] = data_frame['average_heartrate'] * data_frame['moving_time']
-    filtered_activities = data_frame.loc[(data_frame['start_date_formatted'] >= start_date) & (data_frame['start_date_formatted'] <= end_date)]
-    kudos_received = filtered_activities['kudos_count'].sum()
-    heart_beats = filtered_activities['heart_beats'].sum()
-    distance_travelled = filtered_activities['distance'].sum() / 1000
-    filtered_activities_elevation = filtered_activities.loc[(filtered_activities['type'] != 'AlpineSki') & (filtered_activities['type'] != 'VirtualRide')]
-    elevation_gained = filtered_activities_elevation['total_elevation_gain'].sum()
-
-    times_around_earth = distance_travelled / 40075 # circumference of earth
-    blood_pumped = heart_beats * 0.07 # average volume of blood pumped per beat
-    times_up_everest = elevation_gained / 8848 # height of Mt Everest
-
-    return(
-        kudos_received,
-        '{:,}'.format(round(heart_beats)),
-        '{:,}'.format(round(distance_travelled)),
-        '{:,}'.format(round(elevation_gained)),
-        '{:,}'.format(round(blood_pumped)),
-        round(times_around_earth, 2),
-        round(times_up_everest, 1)
-    )
-
-def format_speed(avg_speed):
-    """
-    Formats speed in min/distance from decimal to min:sec form
-
-    Parameters:
-        avg_speed: double
-
-    Returns:
-        avg_speed_formatted: string
-    """
-    integer_part = int(avg_speed)
-    decimal_part = avg_speed - integer_part
-    seconds = int(decimal_part * 60)
-    avg_speed_formatted = f"{integer_part}:{seconds}"
-    return avg_speed_formatted
+    filtered_activities = stats.filter_date_range(data_frame, start_date, end_date)
+    return tuple(stats.calculate_lifetime_totals(filtered_activities).values())
 
+@timed_stage('calculate_activity_stats')
 def calculate_activity_stats(data_frame, start_date, end_date, type, sport_type=None, commute=False):
     """
     Calculates detailed stats for different activity types within date range
@@ -309,198 +692,826 @@ def calculate_activity_stats(data_frame, start_date, end_date, type, sport_type=
     if sport_type is None:
         sport_type = type
 
-    filtered_activities_date = data_frame.loc[(data_frame['start_date_formatted'] >= start_date) & (data_frame['start_date_formatted'] <= end_date)]
+    filtered_activities_date = stats.filter_date_range(data_frame, start_date, end_date)
     filtered_activities = filtered_activities_date[(filtered_activities_date['sport_type'] == sport_type) & (filtered_activities_date['commute'] == commute)]
+    sport_metrics = stats.aggregate_sport_metrics(filtered_activities)
+    group = sport_metrics.iloc[0] if len(sport_metrics) > 0 else None
+    return tuple(stats.format_sport_stats(type, group).values())
 
-    # calculating relevant stats
-    total_count = len(filtered_activities)
-    total_distance = filtered_activities['distance'].sum() / 1000 # conversion to km
-    total_elevation = filtered_activities['total_elevation_gain'].sum()
-    max_speed_kmh = filtered_activities['max_speed'].max() * 3.6 # conversion to km/h
-    avg_speed_kmh = filtered_activities['average_speed'].mean() * 3.6 # conversion to km/h
-    avg_speed_minkm = (1 / 0.06) / filtered_activities['average_speed'].mean() # conversion to min/km
-    avg_speed_min100m = (1 / 0.6) / filtered_activities['average_speed'].mean() # conversion to min/100m
-    avg_power = filtered_activities['average_watts'].mean()
-    avg_distance = filtered_activities['distance'].mean() / 1000 # conversion to km
-    avg_elevation = filtered_activities['total_elevation_gain'].mean()
-    avg_hr = filtered_activities['average_heartrate'].mean()
-
-    # converting any nan values to 0
-    total_count = np.nan_to_num(total_count)
-    total_distance = np.nan_to_num(total_distance)
-    total_elevation = np.nan_to_num(total_elevation)
-    max_speed_kmh = np.nan_to_num(max_speed_kmh)
-    avg_speed_kmh = np.nan_to_num(avg_speed_kmh)
-    avg_speed_minkm = np.nan_to_num(avg_speed_minkm)
-    avg_speed_min100m = np.nan_to_num(avg_speed_min100m)
-    avg_power = np.nan_to_num(avg_power)
-    avg_distance = np.nan_to_num(avg_distance)
-    avg_elevation = np.nan_to_num(avg_elevation)
-    avg_hr = np.nan_to_num(avg_hr)
-
-    # formatting speed of run/hike/swim activities
-    avg_speed_minkm_formatted = format_speed(avg_speed_minkm)
-    avg_speed_min100m_formatted = format_speed(avg_speed_min100m)
-
-    if (type == 'Ride') or (type == 'VirtualRide'):
-        return(
-        total_count, 
-        round(total_distance, 1), 
-        round(total_elevation, 1),
-        round(max_speed_kmh, 1), 
-        round(avg_speed_kmh, 1), 
-        round(avg_power, 1), 
-        round(avg_distance, 1), 
-        round(avg_elevation, 1),
-        round(avg_hr, 1)
-    )
-    elif (type == 'Run') or (type == 'VirtualRun'):
-         return(
-        total_count, 
-        round(total_distance, 1), 
-        round(total_elevation, 1), 
-        avg_speed_minkm_formatted, 
-        round(avg_power, 1), 
-        round(avg_distance, 1), 
-        round(avg_elevation, 1),
-        round(avg_hr, 1)
-    )
-    elif type == 'Hike':
-        return(
-        total_count, 
-        round(total_distance, 1), 
-        round(total_elevation, 1), 
-        avg_speed_minkm_formatted, 
-        round(avg_distance, 1), 
-        round(avg_elevation, 1),
-        round(avg_hr, 1)
-    )
-    elif type == 'Swim':
-        return(
-        total_count,
-        round(total_distance, 1), 
-        avg_speed_min100m_formatted, 
-        round(avg_distance, 1), 
-        round(avg_hr, 1)
-    )
-    elif (type == 'AlpineSki') or (type == 'NordicSki'):
-        return(
-        total_count, 
-        round(total_distance, 1), 
-        round(total_elevation, 1), 
-        round(max_speed_kmh, 1),
-        round(avg_speed_kmh, 1), 
-        round(avg_distance, 1), 
-        round(avg_elevation, 1),
-        round(avg_hr, 1)
-    )
-
-def count_other_sport_types(data_frame):
-    """
-    Prints string of other activites not inlcuded in calculate_activity_stats function
+@timed_stage('load_cached_dataset')
+def load_cached_dataset(athlete):
+    """
+    Builds a dataset from the athlete's snapshot, or their local activity store and media csv if
+    there is none, without contacting Strava
 
     Parameters:
-        data_frame: DataFrame
-    
+        athlete: AthleteData
+
     Returns:
-        formatted_other_sport_types: string
+        dataset: Dataset, or None if nothing has been synced yet
     """
-    standard_sport_types = ['Ride', 'MountainBikeRide', 'VirtualRide', 'Run', 'VirtualRun', 'Hike', 'Swim', 'AlpineSki', 'NordicSki']
-    filtered_activities = data_frame[(data_frame['sport_type'].isin(standard_sport_types) == False)]
-    sport_type_counts = filtered_activities['sport_type'].value_counts().to_dict()
-    formatted_other_sport_types = '<br><br>'.join([f"{key}: {value}" for key, value in sport_type_counts.items()])
-    return formatted_other_sport_types
+    loaded = load_snapshot(athlete)
+    if loaded is not None:
+        return loaded
+    all_activities, polylines = build_activity_frame(activity_store.iter_activities(athlete.store_filename))
+    if len(all_activities) == 0:
+        return None
+    print(f'\nLoaded {len(all_activities)} Cached Activities')
+    photos = load_activity_media(athlete.media_filename)
+    athlete.geometry.update(all_activities['id'], polylines, simplify=False) # index track bounds now, simplify on the next sync
+    fingerprint = heatmap.tracks_fingerprint(all_activities['id'], polylines)
+    athlete.heatmap_tiles.finish_change(fingerprint)
+    all_segments = segment_explorer.compare_segments(athlete.segments.query(bounds))
+    return Dataset(all_activities, polylines, photos, all_segments, athlete.geometry, load_curves(athlete.streams_filename, all_activities),
+                   load_rollups(athlete.store_filename, all_activities), fingerprint)
+
+@timed_stage('sync_dataset')
+def sync_dataset(athlete):
+    """
+    API requests, getting and formatting Activity data and Segment data from Strava API
 
-# Introduction
-print("\nWelcome to the Strava API Test App")
+    Parameters:
+        athlete: AthleteData
 
-# Constant variables  
-app.secret_key = SECRET_KEY
-client_id = CLIENT_ID
-client_secret = CLIENT_SECRET
-refresh_token = REFRESH_TOKEN
+    Returns:
+        dataset: Dataset
+    """
+    access_token = get_athlete_access_token(athlete) # string
+    all_activities, polylines = get_activity_data(access_token, athlete.store_filename) # DataFrame, PolylineStore
+    all_segments = get_segments(bounds, access_token, athlete.segments) # DataFrame
+    photos = get_activity_media(all_activities, access_token, athlete.media_filename) # Dictionary
+    get_new_activity_streams(all_activities, access_token, athlete.streams_filename)
+    print('\nSimplifying Map Lines...')
+    athlete.heatmap_tiles.begin_change()
+    processed_count, changed_polylines = athlete.geometry.update(all_activities['id'], polylines)
+    print(f'\t- Processed {processed_count} new or changed activities')
+    print('\nMatching Routes...')
+    matched_count = athlete.routes.update(all_activities['id'], polylines, all_activities['sport_type'].astype(str))
+    print(f'\t- Matched {matched_count} new or changed activities to {len(athlete.routes)} routes')
+    fingerprint = heatmap.tracks_fingerprint(all_activities['id'], polylines)
+    invalidate_heatmap_tiles(athlete.heatmap_tiles, changed_polylines, fingerprint)
+    dataset = Dataset(all_activities, polylines, photos, all_segments, athlete.geometry, load_curves(athlete.streams_filename, all_activities),
+                      load_rollups(athlete.store_filename, all_activities), fingerprint)
+    save_snapshot(athlete, dataset)
+    return dataset
+
+@timed_stage('write_snapshot')
+def save_snapshot(athlete, dataset):
+    """
+    Writes a dataset as the athlete's newest snapshot, for processes that serve it without syncing.
+    Called holding athlete.lock, it replaces any snapshot scheduled by schedule_snapshot.
 
-# To be updated as dynamic for user input 
-bounds = [51.036047, -114.150184, 51.054738, -114.111313]
+    Parameters:
+        athlete: AthleteData
+        dataset: Dataset
+
+    Returns:
+        none
+    """
+    if athlete.snapshot_timer is not None: # this snapshot includes the changes it was scheduled for
+        athlete.snapshot_timer.cancel()
+        athlete.snapshot_timer = None
+    try:
+        athlete.snapshot_version = snapshot.write_snapshot(athlete.snapshot_directory, dataset.activities, dataset.polylines, dataset.curves,
+                                                           dataset.rollups.rows, athlete.geometry, athlete.routes, dataset.fingerprint)
+    except OSError as e: # keep serving, other processes stay on the previous snapshot
+        print(f'\nSnapshot Not Written: {e}')
+
+def schedule_snapshot(athlete):
+    """
+    Writes the athlete's dataset as a snapshot SNAPSHOT_DEBOUNCE_SECONDS from now, so a burst of
+    webhook events is written once. Called holding athlete.lock.
+
+    Parameters:
+        athlete: AthleteData
+
+    Returns:
+        none
+    """
+    if athlete.snapshot_timer is None:
+        athlete.snapshot_timer = threading.Timer(SNAPSHOT_DEBOUNCE_SECONDS, write_scheduled_snapshot, (athlete,))
+        athlete.snapshot_timer.daemon = True
+        athlete.snapshot_timer.start()
+
+def write_scheduled_snapshot(athlete):
+    with athlete.lock:
+        if athlete.snapshot_timer is threading.current_thread(): # not written by a sync in the meantime
+            save_snapshot(athlete, athlete.holder.get())
+
+@timed_stage('load_snapshot')
+def load_snapshot(athlete, version=None):
+    """
+    Builds a dataset from a memory mapped snapshot of the athlete's data, restoring their track
+    bounds and simplified map lines without decoding any polyline
+
+    Parameters:
+        athlete: AthleteData
+        version: string, or None for the current snapshot
+
+    Returns:
+        dataset: Dataset, or None if there is no snapshot
+    """
+    loaded = snapshot.load_snapshot(athlete.snapshot_directory, version)
+    if loaded is None:
+        return None
+    print(f'\nMapped {len(loaded.activities)} Activities From Snapshot {loaded.version}')
+    athlete.heatmap_tiles.begin_change()
+    athlete.geometry.restore(loaded.activities['id'], loaded.polylines, loaded.boxes, loaded.lines, loaded.grid)
+    athlete.routes.restore(loaded.routes, loaded.route_sport_types)
+    athlete.heatmap_tiles.finish_change(loaded.fingerprint)
+    photos = load_activity_media(athlete.media_filename)
+    all_segments = segment_explorer.compare_segments(athlete.segments.query(bounds))
+    athlete.snapshot_version = loaded.version
+    return Dataset(loaded.activities, loaded.polylines, photos, all_segments, athlete.geometry, dict(loaded.curves), rollups.RollupTable(loaded.rollups),
+                   loaded.fingerprint)
+
+def follow_snapshot(athlete):
+    """
+    Swaps in a newer snapshot written by the process syncing the athlete, checking the pointer at
+    most every SNAPSHOT_POLL_SECONDS
+
+    Parameters:
+        athlete: AthleteData
+
+    Returns:
+        removed: boolean, True if the snapshot being followed was removed, e.g. after the athlete revoked access
+    """
+    now = time.monotonic()
+    if now - athlete.snapshot_checked_at < SNAPSHOT_POLL_SECONDS:
+        return False
+    athlete.snapshot_checked_at = now
+    version = snapshot.current_version(athlete.snapshot_directory)
+    if version is None or version == athlete.snapshot_version:
+        return version is None and athlete.snapshot_version is not None
+    with athlete.lock:
+        if version != athlete.snapshot_version:
+            dataset = load_snapshot(athlete, version)
+            if dataset is not None:
+                athlete.holder.swap(dataset)
+    return False
+
+def invalidate_heatmap_tiles(heatmap_tiles, changed_polylines, fingerprint):
+    """
+    Moves the cached heatmap tiles on to the changed tracks, only the tiles changed tracks are
+    drawn on are rendered again
+
+    Parameters:
+        heatmap_tiles: HeatmapTileCache
+        changed_polylines: list of string
+        fingerprint: string, of all tracks after the change
+
+    Returns:
+        none
+    """
+    changed_tiles = None # nothing is carried over if no tile was saved for the previous tracks
+    if heatmap_tiles.has_tiles():
+        changed_tiles = set()
+        for polyline in changed_polylines:
+            changed_tiles.update(heatmap.touched_tiles(decode_polyline(polyline)))
+        if changed_tiles:
+            print(f'\t- Invalidated {len(changed_tiles)} heatmap tiles')
+    heatmap_tiles.finish_change(fingerprint, changed_tiles)
+
+def get_activity_summary(activity_id, access_token):
+    """
+    Get request for a single Strava activity, trimmed to the fields the activity list returns
+
+    Parameters:
+        activity_id: int
+        access_token: string
+
+    Returns:
+        activity: dict, or None if the activity is gone or no longer visible
+        media_row: dict, or None if the activity has no photo
+    """
+    try:
+        detail = strava.get(f'/activities/{activity_id}', access_token)
+    except requests.HTTPError as e:
+        if e.response is not None and e.response.status_code in (403, 404):
+            return None, None
+        raise
+    photo_urls = ((detail.get('photos') or {}).get('primary') or {}).get('urls') or {}
+    has_media = '600' in photo_urls and detail.get('type') not in ('VirtualRide', 'VirtualRun')
+    media_row = {'id': activity_id, 'photo': photo_urls['600'], 'name': detail['name']} if has_media else None
+    activity = {key: value for key, value in detail.items() if key not in ACTIVITY_DETAIL_FIELDS}
+    activity['map'] = {key: value for key, value in (detail.get('map') or {}).items() if key != 'polyline'} # the full resolution line is large
+    return activity, media_row
+
+@timed_stage('apply_activity_event')
+def apply_activity_event(athlete, event):
+    """
+    Applies one activity push event to an athlete's stores and the dataset being served
+
+    Only the activity in the event is requested. The store, media csv, streams and rollups are
+    updated for it alone, and the served DataFrame, photos, rollups, curves and map lines are
+    patched from what changed without reading any of the stores back.
+
+    Parameters:
+        athlete: AthleteData
+        event: dict, from webhook.parse_event
 
-# API requests, getting and formatting Activity data and Segment data from Strava API
-access_token = request_access_token(client_id, client_secret, refresh_token) # int
-all_activities, all_activities_list = get_activity_data(access_token) # DataFrame, List
-all_activities['start_date_formatted'] = pd.to_datetime(all_activities['start_date'], format='%Y-%m-%dT%H:%M:%SZ', utc=True) # Add column to df
-all_segments = get_segments(bounds, access_token) # DataFrame
-photos = get_activity_media(all_activities, access_token, 'activities_csv') # Dictionary
+    Returns:
+        none
+    """
+    activity_id = event['object_id']
+    activity, media_row = None, None
+    if event['aspect_type'] != 'delete':
+        access_token = get_athlete_access_token(athlete)
+        activity, media_row = get_activity_summary(activity_id, access_token)
+        if activity is not None and (activity.get('athlete') or {}).get('id', event['owner_id']) != event['owner_id']:
+            return
+    print(f"\nApplying Webhook Event: {event['aspect_type']} activity {activity_id}")
+
+    if activity is not None:
+        activity_store.upsert_activities(athlete.store_filename, [activity])
+    else:
+        activity_store.delete_activities(athlete.store_filename, [activity_id])
+        stream_store.delete_streams(athlete.streams_filename, [activity_id])
+    dataset = athlete.holder.get()
+    media = (media_row['photo'], media_row['name']) if media_row is not None else None
+    if dataset is None or dataset.photos.get(activity_id) != media:
+        save_activity_media_row(athlete.media_filename, activity_id, media_row)
+    changed_activities, _ = build_activity_frame([activity] if activity is not None else [])
+    _, rollup_deltas = rollup_store.update_rollups(athlete.store_filename, changed_activities, ids=[activity_id])
+
+    curve_types = {type for types in curves.CURVE_TYPES.values() for type in types}
+    if activity is not None and activity.get('type') in curve_types and not stream_store.has_fetched(athlete.streams_filename, activity_id):
+        try:
+            streams = get_activity_streams(activity_id, access_token)
+            stream_store.save_activity_streams(athlete.streams_filename, activity_id, streams, curves.activity_curves(activity['type'], streams))
+        except RateLimitDeferred: # fetched by a later sync
+            pass
+    elif activity is not None and 'type' in event['updates']: # curves depend on the activity type
+        streams = stream_store.load_streams(athlete.streams_filename, activity_id)
+        if streams:
+            stream_store.save_activity_streams(athlete.streams_filename, activity_id, streams, curves.activity_curves(activity['type'], streams))
+
+    if dataset is None: # nothing served yet, the first load reads the updated stores
+        return
+    removed_tracks = [(activity_id, dataset.polylines[position]) for position in np.flatnonzero(dataset.activities['id'].to_numpy() == activity_id)]
+    polyline = (activity.get('map') or {}).get('summary_polyline') or '' if activity is not None else ''
+    all_activities, polylines, sources = replace_activities(dataset.activities, dataset.polylines, [activity] if activity is not None else [], [activity_id])
+    added_ids = all_activities['id'].to_numpy()[sources < 0]
+    curve_matrices = {kind: matrix.rearrange(sources, stream_store.load_curve_matrix(athlete.streams_filename, kind, added_ids))
+                      for kind, matrix in dataset.curves.items()}
+    athlete.heatmap_tiles.begin_change()
+    changed_polylines = athlete.geometry.update_activity(activity_id, polyline)
+    if activity is not None:
+        athlete.routes.add(activity_id, polyline, changed_activities['sport_type'].astype(str).iloc[0]) # as sync_dataset reads it
+    else:
+        athlete.routes.remove(activity_id)
+    fingerprint = heatmap.update_fingerprint(dataset.fingerprint, removed_tracks, [(activity_id, polyline)])
+    invalidate_heatmap_tiles(athlete.heatmap_tiles, changed_polylines, fingerprint)
+    photos = dataset.photos
+    if photos.get(activity_id) != media:
+        photos = {id: photo for id, photo in photos.items() if id != activity_id}
+        if media is not None:
+            photos[activity_id] = media # where load_activity_media puts the appended row
+    dataset = Dataset(all_activities, polylines, photos, dataset.segments, athlete.geometry, curve_matrices, dataset.rollups.apply(rollup_deltas), fingerprint)
+    athlete.holder.swap(dataset)
+    schedule_snapshot(athlete)
+
+def apply_webhook_event(athletes, event):
+    """
+    Applies a push event to the athlete it belongs to. Athletes who have logged in are matched by
+    their stored tokens, anything else goes to the athlete configured in config.py.
+
+    Parameters:
+        athletes: DatasetCache of AthleteData
+        event: dict, from webhook.parse_event
+
+    Returns:
+        none
+    """
+    owner_id = event['owner_id']
+    athlete_id = owner_id if token_store.get_token(TOKEN_STORE_FILENAME, owner_id) is not None else None
+    if athlete_id is None and not REFRESH_TOKEN:
+        return
+
+    if event['object_type'] == 'athlete':
+        if event['updates'].get('authorized') == 'false' and athlete_id is not None: # the athlete revoked access
+            print(f'\nAthlete {athlete_id} Deauthorized')
+            token_store.delete_token(TOKEN_STORE_FILENAME, athlete_id)
+            athlete = athletes.evict(athlete_id) # stops their sync
+            with athlete.lock if athlete is not None else contextlib.nullcontext(): # a sync in progress finishes before its files are removed
+                shutil.rmtree(os.path.join(ATHLETE_DIRECTORY, str(athlete_id)), ignore_errors=True)
+        return
+
+    if athlete_id is not None:
+        mark_athlete_active(athlete_id) # their data keeps being synced for a while, as if they had visited
+    athlete = athletes.get(athlete_id) # loaded like a page request would
+    if athlete_id is None and activity_store.get_athlete_id(athlete.store_filename) not in (None, owner_id):
+        return
+    with athlete.lock:
+        apply_activity_event(athlete, event)
+
+def get_dashboard_stats(dataset, start_date, end_date):
+    """
+    Gets every stat shown on the dashboard cards, for the page and for /api/stats
+
+    Parameters:
+        dataset: Dataset
+        start_date: Timestamp
+        end_date: Timestamp
+
+    Returns:
+        stats: dict with lifetime, recent, sports, other_sport_types and curves
+    """
+    # Lifetime, most recent activity and per sport stats
+    dashboard_stats = stats.calculate_dashboard_stats(dataset.activities, start_date, end_date, dataset.rollups)
+    curve_stats = stats.calculate_curve_stats(dataset.activities, dataset.curves, start_date, end_date)
+    dashboard_stats['curves'] = {kind: curves.format_curve_card(kind, best) for kind, (best, _) in curve_stats.items()}
+    return dashboard_stats
+
+def load_athlete(athlete_id, start_sync=True):
+    """
+    Loads an athlete's dataset from their local store and starts keeping it in sync with Strava, or
+    without start_sync maps the snapshot the sync process wrote for them.
+    The configured athlete's data lives in the working directory, every other athlete gets their own.
+
+    Parameters:
+        athlete_id: int, or None for the athlete configured in config.py
+        start_sync: boolean
+
+    Returns:
+        athlete: AthleteData
+    """
+    if athlete_id is None:
+        athlete = AthleteData(None, '.', writer=start_sync)
+    else:
+        token = token_store.get_token(TOKEN_STORE_FILENAME, athlete_id)
+        athlete = AthleteData(athlete_id, os.path.join(ATHLETE_DIRECTORY, str(athlete_id)), token['athlete'] if token is not None else None, writer=start_sync)
+
+    # without start_sync only the snapshot is read, its writer owns every store and nothing is served until it writes one
+    cached_dataset = load_cached_dataset(athlete) if start_sync else load_snapshot(athlete)
+    if cached_dataset is not None:
+        athlete.holder.swap(cached_dataset)
+
+    if start_sync:
+        athlete.worker = SyncWorker(lambda: sync_dataset(athlete), athlete.holder, SYNC_INTERVAL_SECONDS, athlete.lock)
+        athlete.worker.start()
+    return athlete
+
+def get_athlete():
+    """
+    Gets the logged in athlete, or the configured athlete if nobody is logged in
+
+    Returns:
+        athlete: AthleteData
+    """
+    athlete_id = session.get('athlete_id')
+    if athlete_id is None and not REFRESH_TOKEN:
+        abort(401, description='Log in with Strava first')
+    athletes = current_app.extensions['athletes']
+    if athlete_id is not None and athlete_id not in athletes and token_store.get_token(TOKEN_STORE_FILENAME, athlete_id) is None:
+        session.pop('athlete_id', None) # they revoked access since logging in
+        abort(401, description='Log in with Strava first')
+    if athlete_id is not None:
+        mark_athlete_active(athlete_id)
+    return athletes.get(athlete_id)
+
+def mark_athlete_active(athlete_id):
+    """
+    Records in the token store that an athlete is active, at most every ACTIVE_MARK_SECONDS in each
+    process, so the sync process keeps syncing them
+
+    Parameters:
+        athlete_id: int
+
+    Returns:
+        none
+    """
+    now = time.time()
+    if now - active_marked_at.get(athlete_id, 0) >= ACTIVE_MARK_SECONDS:
+        active_marked_at[athlete_id] = now
+        token_store.mark_active(TOKEN_STORE_FILENAME, athlete_id, now)
+
+def get_request_bounds():
+    """
+    Gets the area in the bbox query string argument, or responds 400 if it is not a valid area
+
+    Returns:
+        box: tuple of (south, west, north, east), or None if no area was requested
+    """
+    try:
+        return parse_bounds(request.args.get('bbox'))
+    except ValueError as e:
+        abort(400, description=f'Invalid bbox: {e}')
+
+def get_dataset(athlete):
+    """
+    Gets the dataset currently being served for an athlete, or responds 503 until their first load has finished
+
+    Parameters:
+        athlete: AthleteData
 
-@app.route('/')
+    Returns:
+        dataset: Dataset
+    """
+    if athlete.worker is None and follow_snapshot(athlete) and athlete.athlete_id is not None: # another process syncs this athlete
+        current_app.extensions['athletes'].evict(athlete.athlete_id) # and removed their data after they revoked access
+        session.pop('athlete_id', None)
+        abort(401, description='Log in with Strava first')
+    dataset = athlete.holder.get()
+    if dataset is None:
+        abort(503, description='Activity data is still syncing, try again shortly')
+    return dataset
+
+def create_app(start_sync=True):
+    """
+    Creates the Flask app. Pages are served right away from cached data while background
+    workers refresh it from Strava.
+
+    Without start_sync the app only follows the snapshots written by the sync process, see
+    run_sync_process, and queues webhook events for it, so any number of web workers can serve it.
+
+    Parameters:
+        start_sync: boolean, sync athletes and apply webhook events in this process
+
+    Returns:
+        app: Flask
+    """
+    # Introduction
+    print("\nWelcome to the Strava API Test App")
+
+    app = Flask(__name__)
+    app.secret_key = SECRET_KEY
+    app.register_blueprint(bp)
+
+    # athletes are loaded on their first request and evicted when memory runs short
+    athletes = DatasetCache(lambda athlete_id: load_athlete(athlete_id, start_sync), DATASET_CACHE_MAX_BYTES)
+    if REFRESH_TOKEN and start_sync:
+        athletes.get(None) # the configured athlete starts syncing up front
+    app.extensions['athletes'] = athletes
+
+    # push events from Strava are applied in the background, one activity at a time
+    if WEBHOOK_VERIFY_TOKEN and start_sync:
+        app.extensions['webhook'] = WebhookWorker(lambda event: apply_webhook_event(athletes, event))
+        app.extensions['webhook'].start()
+
+    return app
+
+@bp.before_app_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.profile = metrics.start_profile()
+
+@bp.after_app_request
+def record_request_time(response):
+    elapsed = time.perf_counter() - g.request_start
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.HTTP_REQUEST_SECONDS.observe(elapsed, endpoint=endpoint, method=request.method, status=response.status_code)
+    if g.profile is not None:
+        path = metrics.finish_profile(g.profile, elapsed, f'{request.method} {endpoint}')
+        if path is not None:
+            print(f"\t- Slow request {request.method} {request.full_path} took {elapsed * 1000:.0f} ms, profile saved to {path}")
+    return response
+
+@bp.app_errorhandler(RateLimitExceeded)
+def rate_limit_exceeded(error):
+    # requests made while answering a page never wait for the rate limit window to reset
+    headers = {'Retry-After': str(math.ceil(error.retry_after))} if error.retry_after is not None else {}
+    return jsonify({'error': str(error)}), 503, headers
+
+@bp.route('/metrics')
+def get_metrics():
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@bp.route('/healthz')
+def healthz():
+    return jsonify({'status': 'ok'})
+
+@bp.route('/readyz')
+def readyz():
+    athlete = get_athlete()
+    dataset = athlete.holder.get()
+    worker = athlete.worker
+    status = {
+        'ready': dataset is not None,
+        'version': dataset.version if dataset is not None else None,
+        'loaded_at': dataset.loaded_at if dataset is not None else None,
+        'last_sync_error': worker.last_error if worker is not None else None
+    }
+    return jsonify(status), 200 if dataset is not None else 503
+
+@bp.route('/webhook', methods=['GET'])
+def webhook_handshake():
+    challenge = webhook.subscription_challenge(request.args, WEBHOOK_VERIFY_TOKEN)
+    if challenge is None:
+        abort(403)
+    return jsonify({'hub.challenge': challenge})
+
+@bp.route('/webhook', methods=['POST'])
+def receive_webhook_event():
+    if not WEBHOOK_VERIFY_TOKEN:
+        abort(404)
+    payload = request.get_json(silent=True)
+    event = webhook.parse_event(payload, WEBHOOK_SUBSCRIPTION_ID)
+    if event is None:
+        abort(400, description='Not a Strava push event')
+    if WEBHOOK_EVENT_LOG:
+        webhook.record_event(WEBHOOK_EVENT_LOG, payload)
+    # Strava expects an answer within two seconds, so events are only queued here
+    worker = current_app.extensions.get('webhook')
+    if worker is None: # applied by the sync process
+        return jsonify({'queued': event_store.append_event(EVENT_STORE_FILENAME, event)})
+    worker.put(event)
+    return jsonify({'queued': worker.pending()})
+
+@bp.route('/login')
+def login():
+    state = secrets.token_urlsafe(16)
+    session['oauth_state'] = state
+    return redirect(strava.authorize_url(CLIENT_ID, url_for('.exchange_token', _external=True), state))
+
+@bp.route('/exchange_token')
+def exchange_token():
+    # Strava redirects back here with a one time code once the athlete approves access
+    if request.args.get('state') is None or request.args.get('state') != session.pop('oauth_state', None):
+        abort(400, description='Login expired, try again')
+    if 'error' in request.args:
+        return redirect(url_for('.index'))
+    scopes = request.args.get('scope', '').split(',')
+    if 'activity:read_all' not in scopes and 'activity:read' not in scopes:
+        abort(403, description='Reading activities is needed to analyze them')
+
+    token = strava.exchange_authorization_code(CLIENT_ID, CLIENT_SECRET, request.args['code'])
+    athlete_id = int(token['athlete']['id'])
+    token_store.save_token(TOKEN_STORE_FILENAME, athlete_id, token)
+    session['athlete_id'] = athlete_id
+    session.pop('start_date', None)
+    session.pop('end_date', None)
+    return redirect(url_for('.index'))
+
+@bp.route('/logout')
+def logout():
+    athlete_id = session.get('athlete_id')
+    if athlete_id is not None: # stops syncing them, what was synced stays on disk for when they log in again
+        current_app.extensions['athletes'].evict(athlete_id)
+    for key in ('athlete_id', 'start_date', 'end_date'):
+        session.pop(key, None)
+    return redirect(url_for('.index'))
+
+@bp.route('/')
 def index():
+    if session.get('athlete_id') is None and not REFRESH_TOKEN:
+        return redirect(url_for('.login'))
+    athlete = get_athlete()
+    dataset = get_dataset(athlete)
+    all_activities = dataset.activities
 
     # Getting start end end date from web page
     start_date, end_date = get_start_end_dates(all_activities)
     session['start_date'] = start_date
     session['end_date'] = end_date
 
-    # Lifetime Stats
-    l1, l2, l3, l4, l5, l6, l7 = calculate_lifetime_stats(all_activities, start_date, end_date)
-
-    # Most recent activity stats
-    ra1, ra2, ra3, ra4 = calculate_recent_activity_stats(all_activities)
-
-    # Ride stats
-    r1, r2, r3, r4, r5, r6, r7, r8, r9 = calculate_activity_stats(all_activities, start_date, end_date, 'Ride')
-    c1, c2, c3, c4, c5, c6, c7, c8, c9 = calculate_activity_stats(all_activities, start_date, end_date, 'Ride', 'Ride', True)
-    m1, m2, m3, m4, m5, m6, m7, m8, m9 = calculate_activity_stats(all_activities, start_date, end_date, 'Ride', 'MountainBikeRide')
-    v1, v2, v3, v4, v5, v6, v7, v8, v9 = calculate_activity_stats(all_activities, start_date, end_date, 'VirtualRide')
-
-    # Run/Hike stats
-    or1, or2, or3, or4, or5, or6, or7, or8 = calculate_activity_stats(all_activities, start_date, end_date, 'Run')
-    vr1, vr2, vr3, vr4, vr5, vr6, vr7, vr8 = calculate_activity_stats(all_activities, start_date, end_date, 'VirtualRun')
-    h1, h2, h3, h4, h5, h6, h7 = calculate_activity_stats(all_activities, start_date, end_date, 'Hike')
-
-    # Other Stats
-    s1, s2, s3, s4, s5 = calculate_activity_stats(all_activities, start_date, end_date, 'Swim')
-    as1, as2, as3, as4, as5, as6, as7, as8 = calculate_activity_stats(all_activities, start_date, end_date, 'AlpineSki')
-    ns1, ns2, ns3, ns4, ns5, ns6, ns7, ns8 = calculate_activity_stats(all_activities, start_date, end_date, 'NordicSki')
-    other_sport_types = count_other_sport_types(all_activities)
-
-    ph = photos
-
-    return render_template('index.html',
-        start_date=start_date, end_date=end_date,
-        kudos_received=l1, heart_beats=l2, distance_travelled=l3, elevation_gained=l4, blood_pumped=l5, times_around_earth=l6, times_up_everest=l7,
-        date=ra1, name=ra2, type=ra3, distance=ra4, 
-        total_rides=r1, total_ride_distance=r2, total_ride_elevation=r3, max_ride_speed=r4, avg_ride_speed=r5, avg_ride_power=r6, avg_ride_distance=r7, avg_ride_elevation=r8, avg_ride_hr=r9, 
-        total_commutes=c1, total_commute_distance=c2,total_commute_elevation=c3, max_commute_speed=c4, avg_commute_speed=c5, avg_commute_power=c6, avg_commute_distance=c7, avg_commute_elevation=c8, avg_commute_hr=c9,
-        total_mtb=m1, total_mtb_distance=m2, total_mtb_elevation=m3, max_mtb_speed=m4, avg_mtb_speed=m5, avg_mtb_power=m6, avg_mtb_distance=m7, avg_mtb_elevation=m8, avg_mtb_hr=m9,
-        total_virtual_rides=v1, total_virtual_ride_distance=v2, total_virtual_ride_elevation=v3, max_virtual_ride_speed=v4, avg_virtual_ride_speed=v5, avg_virtual_ride_power=v6, avg_virtual_ride_distance=v7, avg_virtual_ride_elevation=v8, avg_virtual_ride_hr=v9,
-        total_outdoor_runs=or1, total_outdoor_run_distance=or2, total_outdoor_run_elevation=or3, avg_outdoor_run_speed=or4, avg_outdoor_run_power=or5, avg_outdoor_distance=or6, avg_outdoor_run_elevation=or7, avg_outdoor_run_hr=or8,
-        total_virtual_runs=vr1, total_virtual_run_distance=vr2, total_virtual_run_elevation=vr3, avg_virtual_run_speed=vr4, avg_virtual_run_power=vr5, avg_virtual_run_distance=vr6, avg_virtual_run_elevation=vr7, avg_virtual_run_hr=vr8,
-        total_hikes=h1, total_hike_distance=h2, total_hike_elevation=h3, avg_hike_speed=h4, avg_hike_distance=h5, avg_hike_elevation=h6, avg_hike_hr=h7,
-        total_swims=s1, total_swim_distance=s2, avg_swim_speed=s3, avg_swim_distance=s4, avg_swim_hr=s5,
-        total_alpine_skis=as1, total_alpine_ski_distance=as2, total_alpine_ski_elevation=as3, max_alpine_ski_speed=as4, avg_alpine_ski_speed=as5, avg_alpine_ski_distance=as6, avg_alpine_ski_elevation=as7, avg_alpine_ski_hr=as8,
-        total_nordic_skis=ns1, total_nordic_ski_distance=ns2, total_nordic_ski_elevation=ns3, max_nordic_ski_speed=ns4, avg_nordic_ski_speed=ns5, avg_nordic_ski_distance=ns6, avg_nordic_ski_elevation=ns7, avg_nordic_ski_hr=ns8,
-        other_sport_types=other_sport_types,
-        photos = ph)
-
-@app.route('/api/all_activities')
+    def build():
+        dashboard_stats = get_dashboard_stats(dataset, start_date, end_date)
+        with metrics.time_stage('render_template'):
+            html = render_template('index.html',
+                start_date=start_date, end_date=end_date,
+                photos=dataset.photos,
+                athlete=athlete.athlete,
+                **dashboard_stats)
+        return html.encode(), 'text/html'
+
+    return response_cache.respond((athlete.athlete_id, dataset.version, 'index', start_date, end_date), build)
+
+@bp.route('/api/stats')
+def get_stats():
+    athlete = get_athlete()
+    dataset = get_dataset(athlete)
+    start_date, end_date = get_map_date_range(dataset.activities)
+
+    # the page now shows this range, map requests without dates follow it like after rendering the index
+    session['start_date'] = start_date
+    session['end_date'] = end_date
+
+    def build():
+        payload = {
+            'start_date': start_date.strftime('%Y-%m-%d'),
+            'end_date': end_date.strftime('%Y-%m-%d'),
+            **get_dashboard_stats(dataset, start_date, end_date)
+        }
+        return dumps(payload), 'application/json'
+
+    return response_cache.respond((athlete.athlete_id, dataset.version, 'stats', start_date, end_date), build)
+
+@bp.route('/api/all_activities')
 def get_all_activities():
-    # Getting start and end date from index function
-    start_date_str = session.get('start_date')
-    end_date_str = session.get('end_date')
+    athlete = get_athlete()
+    dataset = get_dataset(athlete)
+
+    # Getting start and end date from query string or index function
+    start_date, end_date = get_map_date_range(dataset.activities)
+
+    def build():
+        # Full Strava activities are only kept in the activity store, read the date range from there
+        first, last = stats.date_range_positions(dataset.activities, start_date, end_date)
+        if first == last:
+            return dumps([]), 'application/json'
+        epochs = dataset.activities['start_epoch']
+        filtered_activities = activity_store.load_activities_between(athlete.store_filename, int(epochs.iloc[first]), int(epochs.iloc[last - 1]))
+        return dumps(filtered_activities), 'application/json'
+
+    return response_cache.respond((athlete.athlete_id, dataset.version, 'all_activities', start_date, end_date), build)
+
+@bp.route('/api/map_geometry')
+def get_map_geometry():
+    bbox = get_request_bounds()
+    bbox = snap_bounds(bbox) if bbox is not None else None # nearby views share a cache entry
+    athlete = get_athlete()
+    dataset = get_dataset(athlete)
+    start_date, end_date = get_map_date_range(dataset.activities)
+    level = zoom_level(request.args.get('zoom', default=GEOMETRY_ZOOM_LEVELS[-1], type=int))
+    return response_cache.respond((athlete.athlete_id, dataset.version, 'map_geometry', start_date, end_date, level, bbox),
+        lambda: (dumps(build_map_geometry(dataset, start_date, end_date, level, bbox)), 'application/json'))
+
+@bp.route('/api/curves')
+def get_curves():
+    athlete = get_athlete()
+    dataset = get_dataset(athlete)
+    start_date, end_date = get_map_date_range(dataset.activities)
+    kind = request.args.get('kind', 'power')
+    if kind not in curves.CURVE_TYPES:
+        abort(404)
+
+    def build():
+        best, activity_ids = stats.calculate_curve_stats(dataset.activities, {kind: dataset.curves[kind]}, start_date, end_date)[kind]
+        found = ~np.isnan(best)
+        payload = {
+            'kind': kind,
+            'durations': curves.CURVE_DURATIONS[found].tolist(),
+            'best': np.round(best[found].astype(np.float64), 2).tolist(),
+            'activity_ids': activity_ids[found].tolist()
+        }
+        return dumps(payload), 'application/json'
+
+    return response_cache.respond((athlete.athlete_id, dataset.version, 'curves', kind, start_date, end_date), build)
+
+@bp.route('/api/timeseries')
+def get_time_series():
+    athlete = get_athlete()
+    dataset = get_dataset(athlete)
+    start_date, end_date = get_map_date_range(dataset.activities)
+    period = request.args.get('period', 'week')
+    if period not in rollups.ROLLUP_PERIODS:
+        abort(404)
+    sport_types = tuple(request.args['sport_type'].split(',')) if request.args.get('sport_type') else None
+    commute = {'true': True, 'false': False}.get(request.args.get('commute'))
+    return response_cache.respond((athlete.athlete_id, dataset.version, 'timeseries', period, sport_types, commute, start_date, end_date),
+        lambda: (dumps(rollups.time_series(dataset.rollups, period, start_date, end_date, sport_types, commute)), 'application/json'))
+
+@bp.route('/api/segments')
+def get_area_segments():
+    athlete = get_athlete()
+    bbox = get_request_bounds() or tuple(bounds)
+    if request.args.get('refresh') == 'true': # explore the area now, later requests answer from the segment cache
+        access_token = get_athlete_access_token(athlete)
+        for part in split_antimeridian(bbox):
+            get_segments(part, access_token, athlete.segments, priority=HIGH_PRIORITY)
+    comparison = segment_explorer.compare_segments(athlete.segments.query(bbox))
+    records = comparison.astype(object).where(comparison.notna(), None).to_dict('records')
+    return Response(dumps({'bounds': bbox, 'segments': records}), mimetype='application/json')
+
+@bp.route('/api/routes')
+def get_routes():
+    athlete = get_athlete()
+    dataset = get_dataset(athlete)
+    min_attempts = max(1, request.args.get('min_attempts', default=2, type=int))
+    sport_type = request.args.get('sport_type') or None
+
+    def build():
+        route_table = routes.route_stats(athlete.routes, dataset.activities, min_attempts, sport_type)
+        return dumps(route_table.drop(columns='attempt_ids').astype(object).where(route_table.notna(), None).to_dict('records')), 'application/json'
+
+    return response_cache.respond((athlete.athlete_id, dataset.version, 'routes', min_attempts, sport_type), build)
+
+@bp.route('/api/routes/<int:route_id>')
+def get_route(route_id):
+    athlete = get_athlete()
+    dataset = get_dataset(athlete)
+
+    def build():
+        members = dataset.activities[athlete.routes.route_ids(dataset.activities['id'].tolist()) == route_id]
+        route_table = routes.route_stats(athlete.routes, members, min_attempts=1)
+        if len(route_table) == 0:
+            abort(404)
+        route = route_table.drop(columns='attempt_ids').astype(object).where(route_table.notna(), None).to_dict('records')[0]
+        attempts = dataset.activities[dataset.activities['id'].isin(route_table['attempt_ids'].iloc[0])]
+        route['attempts'] = [{
+            'id': int(id),
+            'date': date.strftime('%Y-%m-%d'),
+            'name': name,
+            'moving_time': int(moving_time),
+            'speed': round(float(speed) * 3.6, 2) # km/h
+        } for id, date, name, moving_time, speed in zip(
+            attempts['id'], attempts['start_date_formatted'], attempts['name'], attempts['moving_time'], attempts['average_speed'])]
+        return dumps(route), 'application/json'
+
+    return response_cache.respond((athlete.athlete_id, dataset.version, 'route', route_id), build)
+
+def build_map_geometry(dataset, start_date, end_date, level, bbox):
+    """
+    Builds the compact map payload of simplified lines and popup fields
 
-    # Convert start_date_str and end_date_str to datetime objects with timezone awareness if not already done
-    start_date = pd.to_datetime(start_date_str, format='%Y-%m-%dT%H:%M:%SZ', utc=True)
-    end_date = pd.to_datetime(end_date_str, format='%Y-%m-%dT%H:%M:%SZ', utc=True)
+    Parameters:
+        dataset: Dataset
+        start_date: Timestamp
+        end_date: Timestamp
+        level: int, precomputed zoom level
+        bbox: tuple of (south, west, north, east), or None for everywhere
 
-    # Creating a new list of date-filtered activities
-    filtered_activities = []
-    for activity in all_activities_list:
-        activity_date_str = activity['start_date']
-        activity_date = pd.to_datetime(activity_date_str, format='%Y-%m-%dT%H:%M:%SZ', utc=True)
+    Returns:
+        payload: dict
+    """
+    first, last = stats.date_range_positions(dataset.activities, start_date, end_date)
+    positions = np.arange(first, last)
+
+    # only activities whose track crosses the requested viewport
+    if bbox is not None:
+        positions = positions[dataset.activities['id'].iloc[first:last].isin(dataset.geometry.query_bounds(bbox)).to_numpy()]
+
+    # compact payload of simplified lines and popup fields, only for activities with a line
+    filtered_activities = dataset.activities.iloc[positions]
+    activities = []
+    for position, id, type, name, distance, speed, elevation in zip(
+            positions, filtered_activities['id'], filtered_activities['type'], filtered_activities['name'], filtered_activities['distance'],
+            filtered_activities['average_speed'], filtered_activities['total_elevation_gain']):
+        polyline = dataset.polylines[position]
+        if not polyline:
+            continue
+        line = dataset.geometry.get(id, level)
+        activities.append({
+            'id': int(id),
+            'type': type,
+            'name': name,
+            'distance': round(float(distance) / 1000, 2), # km
+            'speed': round(float(speed) * 3.6, 2), # km/h
+            'elevation': round(float(elevation), 1),
+            'line': line if line is not None else polyline # not simplified until the next sync
+        })
+
+    return {'level': level, 'levels': GEOMETRY_ZOOM_LEVELS, 'activities': activities}
+
+@bp.route('/tiles/heatmap/<int:zoom>/<int:x>/<int:y>.png')
+def get_heatmap_tile(zoom, x, y):
+    if not (0 <= zoom <= heatmap.HEATMAP_MAX_ZOOM and 0 <= x < 2 ** zoom and 0 <= y < 2 ** zoom):
+        abort(404)
+    athlete = get_athlete()
+    dataset = get_dataset(athlete)
+    geometry = dataset.geometry
+
+    def render():
+        south, west, north, east = heatmap.tile_bounds(zoom, x, y)
+        margin = (east - west) / heatmap.TILE_SIZE # one pixel, for lines drawn along the tile edge
+        ids = geometry.query_bounds((south - margin, west - margin, north + margin, east + margin))
+        return heatmap.render_tile(geometry.tracks(ids), zoom, x, y)
+
+    png = athlete.heatmap_tiles.get(dataset.fingerprint, zoom, x, y, render)
+    return Response(png, mimetype='image/png', headers={'Cache-Control': 'private, max-age=300'}) # tiles differ per athlete
+
+def run_sync_process(poll_seconds=SYNC_POLL_SECONDS):
+    """
+    Runs the one process that syncs athletes with Strava, applies webhook events and writes the
+    snapshots web workers serve. The configured athlete and up to SYNC_MAX_ATHLETES who used the
+    app or got a push event in the last ATHLETE_ACTIVE_DAYS are kept loaded and syncing, anyone
+    else is picked up on the next poll after they come back. Never returns.
 
-        if start_date <= activity_date <= end_date:
-            filtered_activities.append(activity)
+    Parameters:
+        poll_seconds: double, between checks for queued webhook events and active athletes
 
-    # filtered_activities is accessed by app.js. this data is used to populate the map
-    return jsonify(filtered_activities)
+    Returns:
+        none
+    """
+    athletes = DatasetCache(lambda athlete_id: load_athlete(athlete_id, start_sync=True), DATASET_CACHE_MAX_BYTES, SYNC_MAX_ATHLETES)
+    worker = WebhookWorker(lambda event: apply_webhook_event(athletes, event))
+    worker.start()
+    loaded_ids = set()
+    dropped_at = {} # athlete id -> when the cache evicted them for memory
+    while True:
+        now = time.time()
+        for athlete_id in loaded_ids - set(athletes.keys()):
+            dropped_at[athlete_id] = now
+        dropped_at = {athlete_id: at for athlete_id, at in dropped_at.items() if now - at < SYNC_INTERVAL_SECONDS}
+
+        configured_ids = [None] if REFRESH_TOKEN else []
+        athlete_ids = configured_ids + token_store.list_active_athlete_ids(TOKEN_STORE_FILENAME, now - ATHLETE_ACTIVE_DAYS * 24 * 60 * 60, SYNC_MAX_ATHLETES - len(configured_ids))
+        for athlete_id in set(athletes.keys()) - set(athlete_ids): # inactive for a while, revoked access, or their tokens were removed
+            athletes.evict(athlete_id)
+        loaded_ids = set(athletes.keys())
+        for athlete_id in reversed(athlete_ids): # least active first, so the most active are evicted last
+            if athlete_id not in loaded_ids and athlete_id not in dropped_at: # ones that did not fit are loaded again a sync interval later
+                athletes.get(athlete_id)
+                loaded_ids.add(athlete_id)
+
+        for event in event_store.take_events(EVENT_STORE_FILENAME):
+            worker.put(event)
+        time.sleep(poll_seconds)
+
+# syncs and serves in one process, as app.yaml deploys it. With STRAVA_SYNC=0 web workers only
+# follow the snapshots written by sync.py, see the README
+app = create_app(start_sync=os.environ.get('STRAVA_SYNC', '1') != '0')
 
 if __name__ == '__main__':
     app.run()
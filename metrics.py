@@ -0,0 +1,290 @@
+import cProfile
+import functools
+import io
+import math
+import os
+import pstats
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# opt-in profiling: a sampled fraction of requests is profiled and the profile kept if the request was slow
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_SLOW_SECONDS = float(os.environ.get('PROFILE_SLOW_SECONDS', '1'))
+PROFILE_DIRECTORY = os.environ.get('PROFILE_DIRECTORY', 'profiles')
+
+class Metric:
+    """
+    A Prometheus metric family, one series per combination of label values
+
+    Parameters:
+        name: string
+        help: string
+        labelnames: tuple of string
+    """
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._series = {} # label values -> series state
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            series = sorted(self._series.items())
+            lines.extend(self._render_series(series))
+        return lines
+
+class Counter(Metric):
+    """Monotonically increasing count"""
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        if not self.labelnames: # exported as 0 before the first increment
+            self._series[()] = 0
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def _render_series(self, series):
+        return [f'{self.name}{self._labels(key)} {_format(value)}' for key, value in series]
+
+class Gauge(Metric):
+    """Value that is set, e.g. the last reported rate limit usage"""
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._series[self._key(labels)] = value
+
+    def _render_series(self, series):
+        return [f'{self.name}{self._labels(key)} {_format(value)}' for key, value in series]
+
+class Histogram(Metric):
+    """
+    Cumulative histogram of observations, e.g. durations in seconds
+
+    Parameters:
+        name: string
+        help: string
+        labelnames: tuple of string
+        buckets: tuple of double, ascending upper bounds
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0, 0.0] # bucket counts, count, sum
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += 1
+            series[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_series(self, series):
+        lines = []
+        for key, (bucket_counts, count, total) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{self._labels(key, [("le", _format(bound))])} {cumulative}')
+            lines.append(f'{self.name}_bucket{self._labels(key, [("le", "+Inf")])} {count}')
+            lines.append(f'{self.name}_count{self._labels(key)} {count}')
+            lines.append(f'{self.name}_sum{self._labels(key)} {_format(total)}')
+        return lines
+
+class Registry:
+    """Every metric exported on /metrics"""
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        Renders every metric in the Prometheus text exposition format
+
+        Returns:
+            text: string
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # scrapes are not worth a line each
+        pass
+
+def serve(port, host='0.0.0.0'):
+    """
+    Exports every metric on /metrics from a background thread, for processes that serve no Flask
+    app, like sync.py, where the Strava requests and sync stages are measured
+
+    Parameters:
+        port: int
+        host: string
+
+    Returns:
+        server: ThreadingHTTPServer, stopped with shutdown()
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-exporter', daemon=True).start()
+    return server
+
+def _format(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram('dashboard_stage_duration_seconds', 'Time spent in each stage of building a response or syncing', ('stage',)))
+HTTP_REQUEST_SECONDS = REGISTRY.register(Histogram('http_request_duration_seconds', 'Time to answer requests to the dashboard', ('endpoint', 'method', 'status')))
+STRAVA_REQUEST_SECONDS = REGISTRY.register(Histogram('strava_api_request_duration_seconds', 'Latency of requests to the Strava API', ('endpoint', 'method', 'status')))
+STRAVA_RATE_LIMIT_USAGE = REGISTRY.register(Gauge('strava_api_rate_limit_usage', 'Strava rate limit usage last reported, per window', ('window',)))
+STRAVA_RATE_LIMIT = REGISTRY.register(Gauge('strava_api_rate_limit', 'Strava rate limit last reported, per window', ('window',)))
+WEBHOOK_EVENTS = REGISTRY.register(Counter('webhook_events_total', 'Strava push events applied, by result', ('object_type', 'aspect_type', 'result')))
+SYNC_FAILURES = REGISTRY.register(Counter('sync_failures_total', 'Background syncs that raised an error'))
+PROFILES_WRITTEN = REGISTRY.register(Counter('slow_request_profiles_total', 'Profiles written for slow requests'))
+
+def time_stage(stage):
+    """
+    Times a block of code as a stage
+
+    Parameters:
+        stage: string
+
+    Returns:
+        context manager
+    """
+    return STAGE_SECONDS.time(stage=stage)
+
+def timed_stage(stage):
+    """
+    Decorator timing every call of a function as a stage
+
+    Parameters:
+        stage: string
+
+    Returns:
+        decorator
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with STAGE_SECONDS.time(stage=stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def strava_endpoint(path):
+    """
+    Normalizes a Strava API path so requests for different ids share a series
+
+    Parameters:
+        path: string, e.g. '/api/v3/activities/123/streams'
+
+    Returns:
+        endpoint: string, e.g. '/activities/{id}/streams'
+    """
+    return re.sub(r'/\d+', '/{id}', path.replace('/api/v3', '', 1))
+
+def start_profile():
+    """
+    Starts profiling the current request if it is sampled
+
+    Returns:
+        profile: cProfile.Profile, or None if profiling is off or the request was not sampled
+    """
+    if PROFILE_SAMPLE_RATE <= 0 or random.random() >= PROFILE_SAMPLE_RATE:
+        return None
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError: # another profiler is already active on this thread
+        return None
+    return profile
+
+def finish_profile(profile, elapsed, name):
+    """
+    Stops a request profile and writes it out if the request was slow
+
+    A .prof file for pstats or snakeviz is written, with a text summary of the top functions by
+    cumulative time next to it.
+
+    Parameters:
+        profile: cProfile.Profile
+        elapsed: double, seconds the request took
+        name: string, used in the file name
+
+    Returns:
+        path: string, or None if the request was fast enough
+    """
+    profile.disable()
+    if elapsed < PROFILE_SLOW_SECONDS:
+        return None
+    os.makedirs(PROFILE_DIRECTORY, exist_ok=True)
+    path = os.path.join(PROFILE_DIRECTORY, f"{time.strftime('%Y%m%d-%H%M%S')}-{re.sub(r'[^A-Za-z0-9]+', '_', name).strip('_')}-{elapsed * 1000:.0f}ms")
+    profile.dump_stats(path + '.prof')
+    summary = io.StringIO()
+    pstats.Stats(profile, stream=summary).sort_stats('cumulative').print_stats(30)
+    with open(path + '.txt', 'w') as file:
+        file.write(summary.getvalue())
+    PROFILES_WRITTEN.inc()
+    return path + '.prof'
@@ -0,0 +1,57 @@
+"""
+Replays recorded Strava push events against a running dashboard, e.g. one started with
+STRAVA_BASE_URL pointing at fake_strava.py and STRAVA_WEBHOOK_VERIFY_TOKEN set
+
+Events received while STRAVA_WEBHOOK_EVENT_LOG is set are recorded one json payload per line,
+in the same format as webhook_events_example.jsonl.
+
+Usage:
+    python replay_webhook_events.py webhook_events_example.jsonl --url http://127.0.0.1:5000/webhook --verify-token secret
+"""
+import argparse
+import secrets
+import sys
+import time
+import requests
+from webhook import load_events
+
+def check_handshake(url, verify_token):
+    """
+    Makes the subscription validation request Strava makes, and checks the challenge is echoed
+
+    Parameters:
+        url: string
+        verify_token: string
+
+    Returns:
+        ok: boolean
+    """
+    challenge = secrets.token_urlsafe(8)
+    res = requests.get(url, params={'hub.mode': 'subscribe', 'hub.challenge': challenge, 'hub.verify_token': verify_token}, timeout=10)
+    return res.status_code == 200 and res.json().get('hub.challenge') == challenge
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded Strava push events')
+    parser.add_argument('events', help='json lines file of event payloads')
+    parser.add_argument('--url', default='http://127.0.0.1:5000/webhook')
+    parser.add_argument('--verify-token', help='check the subscription handshake first')
+    parser.add_argument('--delay', type=float, default=0.0, help='seconds between events')
+    args = parser.parse_args()
+
+    if args.verify_token:
+        print('\nChecking Subscription Handshake...')
+        if not check_handshake(args.url, args.verify_token):
+            print('\t- Handshake failed')
+            sys.exit(1)
+        print('\t- Handshake ok')
+
+    payloads = load_events(args.events)
+    print(f'\nReplaying {len(payloads)} Events...')
+    for payload in payloads:
+        res = requests.post(args.url, json=payload, timeout=10)
+        print(f"\t- {payload.get('aspect_type')} {payload.get('object_type')} {payload.get('object_id')}: {res.status_code}")
+        if args.delay:
+            time.sleep(args.delay)
+
+if __name__ == '__main__':
+    main()
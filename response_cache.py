@@ -0,0 +1,126 @@
+import gzip
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from flask import Response, request
+import metrics
+
+try:
+    import orjson
+except ImportError: # fall back to the standard library encoder
+    orjson = None
+
+try:
+    import brotli
+except ImportError: # serve gzip only
+    brotli = None
+
+@metrics.timed_stage('json_serialize')
+def dumps(data):
+    """
+    Serializes data to JSON bytes, with orjson when it is installed
+
+    Parameters:
+        data: list or dict
+
+    Returns:
+        body: bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(data, separators=(',', ':')).encode()
+
+class CachedBody:
+    """
+    A response body with its ETag and pre-compressed encodings
+
+    Parameters:
+        body: bytes
+        mimetype: string
+    """
+    def __init__(self, body, mimetype):
+        self.mimetype = mimetype
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.encodings = {'identity': body, 'gzip': gzip.compress(body, compresslevel=6)}
+        if brotli is not None:
+            self.encodings['br'] = brotli.compress(body, quality=5)
+        self.size = sum(len(encoded) for encoded in self.encodings.values())
+
+class ResponseCache:
+    """
+    Bounded least recently used cache of rendered response bodies
+
+    Keys should include the dataset version so a sync never serves stale bodies.
+
+    Parameters:
+        max_entries: int
+        max_bytes: int
+    """
+    def __init__(self, max_entries=128, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= previous.size
+            self._entries[key] = entry
+            self._size += entry.size
+            while len(self._entries) > self.max_entries or (self._size > self.max_bytes and len(self._entries) > 1):
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= evicted.size
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def respond(self, key, build):
+        """
+        Builds a response from the cache, answering If-None-Match with 304 and picking the best
+        encoding the client accepts
+
+        Parameters:
+            key: hashable
+            build: callable returning (body bytes, mimetype), called on a cache miss
+
+        Returns:
+            response: Response
+        """
+        entry = self.get(key)
+        if entry is None:
+            body, mimetype = build()
+            entry = self.put(key, CachedBody(body, mimetype))
+
+        if request.if_none_match.contains(entry.etag):
+            response = Response(status=304)
+        else:
+            encoding = next((encoding for encoding in ('br', 'gzip') if encoding in entry.encodings and request.accept_encodings[encoding]), 'identity')
+            response = Response(entry.encodings[encoding], mimetype=entry.mimetype)
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+        response.set_etag(entry.etag)
+        response.headers['Cache-Control'] = 'no-cache' # always revalidate, unchanged bodies cost a 304
+        response.vary.add('Accept-Encoding')
+        return response
@@ -0,0 +1,101 @@
+import sqlite3
+from contextlib import closing
+import numpy as np
+import pandas as pd
+from rollups import ROLLUP_FIELDS, activity_contributions, rollup_rows
+
+_CONTRIBUTION_COLUMNS = ['start_epoch', 'sport_type', 'commute', *ROLLUP_FIELDS[1:]]
+
+def _connect(filename):
+    """
+    Opens a connection to the rollup tables and creates them if needed
+
+    Parameters:
+        filename: string
+
+    Returns:
+        conn: sqlite3.Connection
+    """
+    conn = sqlite3.connect(filename, timeout=30)
+    conn.execute('CREATE TABLE IF NOT EXISTS rollups (period TEXT NOT NULL, period_start INTEGER NOT NULL, sport_type TEXT NOT NULL, commute INTEGER NOT NULL, '
+                 'count INTEGER NOT NULL, distance REAL NOT NULL, elevation REAL NOT NULL, moving_time REAL NOT NULL, heart_beats REAL NOT NULL, kudos REAL NOT NULL, '
+                 'PRIMARY KEY (period, period_start, sport_type, commute))')
+    # what every activity added to the rollups, so an edit or deletion can take exactly that back out
+    conn.execute('CREATE TABLE IF NOT EXISTS rolled_up (id INTEGER PRIMARY KEY, start_epoch INTEGER NOT NULL, sport_type TEXT NOT NULL, commute INTEGER NOT NULL, '
+                 'distance REAL NOT NULL, elevation REAL NOT NULL, moving_time REAL NOT NULL, heart_beats REAL NOT NULL, kudos REAL NOT NULL)')
+    return conn
+
+def _load_rolled_up(conn, ids):
+    if ids is None:
+        rows = conn.execute(f"SELECT id, {', '.join(_CONTRIBUTION_COLUMNS)} FROM rolled_up").fetchall()
+    else:
+        ids = [int(id) for id in ids]
+        rows = []
+        for i in range(0, len(ids), 500): # stay under sqlite's bound parameter limit
+            chunk = ids[i:i + 500]
+            rows.extend(conn.execute(f"SELECT id, {', '.join(_CONTRIBUTION_COLUMNS)} FROM rolled_up WHERE id IN ({', '.join('?' * len(chunk))})", chunk).fetchall())
+    rolled_up = pd.DataFrame(rows, columns=['id', *_CONTRIBUTION_COLUMNS]).set_index('id')
+    rolled_up['commute'] = rolled_up['commute'].astype(bool)
+    rolled_up.insert(3, 'count', 1)
+    return rolled_up
+
+def update_rollups(filename, data_frame, ids=None):
+    """
+    Brings the rollups up to date with activities by applying only what changed
+
+    Activities that are new, edited or gone are found by comparing them to what was rolled up
+    before, then the old contributions are subtracted and the new ones added to the rows of
+    the periods they fall in.
+
+    Parameters:
+        filename: string
+        data_frame: DataFrame of activities
+        ids: iterable of int, the only activities to check, any not in data_frame were deleted.
+            None checks the whole history.
+
+    Returns:
+        changed_count: int, activities added, edited or removed
+        deltas: DataFrame of rollup rows added to the rollups, negative where activities were taken out
+    """
+    current = activity_contributions(data_frame)
+    if ids is not None:
+        current = current[current.index.isin(list(ids))]
+    with closing(_connect(filename)) as conn, conn:
+        previous = _load_rolled_up(conn, ids)
+        common = previous.index.intersection(current.index)
+        unchanged = common[(previous.loc[common, _CONTRIBUTION_COLUMNS] == current.loc[common, _CONTRIBUTION_COLUMNS]).all(axis=1).to_numpy()]
+        removed = previous.drop(unchanged)
+        added = current.drop(unchanged)
+        if len(removed) == 0 and len(added) == 0:
+            return 0, pd.DataFrame(columns=['period', 'period_start', 'sport_type', 'commute', *ROLLUP_FIELDS])
+
+        deltas = pd.concat([rollup_rows(added), rollup_rows(removed, sign=-1)])
+        deltas = deltas.groupby(['period', 'period_start', 'sport_type', 'commute'], sort=False)[list(ROLLUP_FIELDS)].sum().reset_index()
+        conn.executemany(f"INSERT INTO rollups (period, period_start, sport_type, commute, {', '.join(ROLLUP_FIELDS)}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                         f"ON CONFLICT (period, period_start, sport_type, commute) DO UPDATE SET {', '.join(f'{field} = {field} + excluded.{field}' for field in ROLLUP_FIELDS)}",
+                         [(period, int(start), sport_type, int(commute), int(count), *map(float, values))
+                          for period, start, sport_type, commute, count, *values in deltas.itertuples(index=False)])
+        conn.execute('DELETE FROM rollups WHERE count <= 0')
+
+        conn.executemany('DELETE FROM rolled_up WHERE id = ?', [(int(id),) for id in removed.index])
+        conn.executemany(f"INSERT INTO rolled_up (id, {', '.join(_CONTRIBUTION_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         [(int(id), int(start_epoch), sport_type, int(commute), *map(float, values))
+                          for id, start_epoch, sport_type, commute, _, *values in added.itertuples()])
+    return len(removed.index.union(added.index)), deltas
+
+def load_rollups(filename):
+    """
+    Loads every rollup row
+
+    Parameters:
+        filename: string
+
+    Returns:
+        rollups: DataFrame with period, period_start, sport_type, commute and the rollup fields
+    """
+    with closing(_connect(filename)) as conn:
+        rows = conn.execute(f"SELECT period, period_start, sport_type, commute, {', '.join(ROLLUP_FIELDS)} FROM rollups ORDER BY period, period_start").fetchall()
+    rollups = pd.DataFrame(rows, columns=['period', 'period_start', 'sport_type', 'commute', *ROLLUP_FIELDS])
+    rollups['period_start'] = rollups['period_start'].astype(np.int64)
+    rollups['commute'] = rollups['commute'].astype(bool)
+    return rollups
@@ -0,0 +1,274 @@
+import numpy as np
+import pandas as pd
+
+ROLLUP_PERIODS = ('year', 'month', 'week') # largest first, ranges are covered with the largest periods that fit
+ROLLUP_FIELDS = ('count', 'distance', 'elevation', 'moving_time', 'heart_beats', 'kudos')
+ROLLUP_KEYS = ('sport_type', 'commute')
+ROLLUP_SOURCE_COLUMNS = {'distance': 'distance', 'elevation': 'total_elevation_gain', 'moving_time': 'moving_time', 'heart_beats': 'heart_beats', 'kudos': 'kudos_count'}
+
+_PERIOD_UNITS = {'year': 'Y', 'month': 'M'}
+_WEEK_SECONDS = 7 * 24 * 60 * 60
+_MONDAY_OFFSET = 4 * 24 * 60 * 60 # 1970-01-01 was a Thursday
+
+def period_starts(epochs, period):
+    """
+    Gets the start of the UTC week (from Monday), month or year each point in time falls in
+
+    Parameters:
+        epochs: ndarray of int, seconds since epoch
+        period: string, 'week', 'month' or 'year'
+
+    Returns:
+        starts: ndarray of int64, seconds since epoch
+    """
+    epochs = np.asarray(epochs, dtype=np.int64)
+    if period == 'week':
+        return (epochs + _MONDAY_OFFSET) // _WEEK_SECONDS * _WEEK_SECONDS - _MONDAY_OFFSET
+    unit = _PERIOD_UNITS[period]
+    return epochs.astype('datetime64[s]').astype(f'datetime64[{unit}]').astype('datetime64[s]').astype(np.int64)
+
+def next_period_starts(starts, period):
+    """
+    Gets the start of the period after each period start
+
+    Parameters:
+        starts: ndarray of int, period starts
+        period: string
+
+    Returns:
+        next_starts: ndarray of int64
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    if period == 'week':
+        return starts + _WEEK_SECONDS
+    unit = _PERIOD_UNITS[period]
+    return (starts.astype('datetime64[s]').astype(f'datetime64[{unit}]') + 1).astype('datetime64[s]').astype(np.int64)
+
+def _floor(epoch, period):
+    return int(period_starts([epoch], period)[0])
+
+def _ceil(epoch, period):
+    start = _floor(epoch, period)
+    return start if start == epoch else int(next_period_starts([start], period)[0])
+
+def cover_range(start, end, periods=ROLLUP_PERIODS):
+    """
+    Splits a time range into the fewest whole periods, largest first, and the leftover edges
+
+    Parameters:
+        start: int, seconds since epoch, inclusive
+        end: int, seconds since epoch, exclusive
+        periods: tuple of string, largest first
+
+    Returns:
+        spans: list of (period, first period start, end of the last period)
+        remainders: list of (start, end), too short for any period
+    """
+    if start >= end:
+        return [], []
+    if not periods:
+        return [], [(start, end)]
+    period = periods[0]
+    first = _ceil(start, period)
+    last = _floor(end, period)
+    if first >= last:
+        return cover_range(start, end, periods[1:])
+    left_spans, left_remainders = cover_range(start, first, periods[1:])
+    right_spans, right_remainders = cover_range(last, end, periods[1:])
+    return left_spans + [(period, first, last)] + right_spans, left_remainders + right_remainders
+
+def activity_contributions(data_frame):
+    """
+    Gets what each activity adds to the rollups
+
+    Parameters:
+        data_frame: DataFrame of activities
+
+    Returns:
+        contributions: DataFrame indexed by id, with start_epoch, sport_type, commute and the rollup fields
+    """
+    positions = np.arange(len(data_frame))
+    sport_types, commutes, values = _activity_rollup_values(data_frame, positions)
+    contributions = pd.DataFrame({
+        'start_epoch': data_frame['start_epoch'].to_numpy(dtype=np.int64),
+        'sport_type': sport_types,
+        'commute': commutes,
+        **{field: values[:, i] for i, field in enumerate(ROLLUP_FIELDS)}
+    }, index=pd.Index(data_frame['id'].to_numpy(dtype=np.int64), name='id'))
+    contributions['count'] = contributions['count'].astype(np.int64)
+    return contributions
+
+def _activity_rollup_values(data_frame, positions):
+    # keys and summed fields of the activities at some row positions, missing values count as 0
+    sport_types = data_frame['sport_type'].to_numpy(dtype=object)[positions]
+    sport_types[pd.isna(sport_types)] = ''
+    commutes = data_frame['commute'].to_numpy()[positions].astype(bool)
+    values = np.empty((len(positions), len(ROLLUP_FIELDS)))
+    values[:, 0] = 1
+    for i, column in enumerate(ROLLUP_SOURCE_COLUMNS.values(), start=1):
+        if column == 'heart_beats' and column not in data_frame:
+            values[:, i] = data_frame['average_heartrate'].to_numpy(dtype=np.float64)[positions] * data_frame['moving_time'].to_numpy()[positions]
+        else:
+            values[:, i] = data_frame[column].to_numpy(dtype=np.float64)[positions]
+    return sport_types, commutes, np.nan_to_num(values)
+
+def rollup_rows(contributions, sign=1):
+    """
+    Sums contributions into rollup rows for every period
+
+    Parameters:
+        contributions: DataFrame from activity_contributions
+        sign: int, -1 to get the rows that take the contributions back out
+
+    Returns:
+        rows: DataFrame with period, period_start, sport_type, commute and the rollup fields
+    """
+    frames = []
+    for period in ROLLUP_PERIODS:
+        grouped = contributions.assign(period=period, period_start=period_starts(contributions['start_epoch'], period)) \
+            .groupby(['period', 'period_start', *ROLLUP_KEYS], sort=False)[list(ROLLUP_FIELDS)].sum()
+        frames.append(grouped * sign)
+    return pd.concat(frames).reset_index()
+
+class RollupTable:
+    """
+    Rollup rows arranged for range queries. For every period, the rows are summed cumulatively
+    over period starts, so any run of whole periods is the difference of two cumulative rows.
+
+    Parameters:
+        rows: DataFrame of rollup rows, from rollup_store.load_rollups
+    """
+    def __init__(self, rows):
+        self.rows = rows
+        self.keys = sorted(set(zip(rows['sport_type'], rows['commute'])))
+        self.codes = {key: i for i, key in enumerate(self.keys)}
+        row_codes = np.array([self.codes[key] for key in zip(rows['sport_type'], rows['commute'])], dtype=np.int64)
+        values = rows[list(ROLLUP_FIELDS)].to_numpy(dtype=np.float64)
+        periods = rows['period'].to_numpy()
+        self._starts = {}
+        self._cumulative = {}
+        for period in ROLLUP_PERIODS:
+            selected = periods == period
+            starts, positions = np.unique(rows['period_start'].to_numpy()[selected], return_inverse=True)
+            sums = np.zeros((len(starts) + 1, len(self.keys), len(ROLLUP_FIELDS)))
+            np.add.at(sums, (positions + 1, row_codes[selected]), values[selected])
+            self._starts[period] = starts
+            self._cumulative[period] = np.cumsum(sums, axis=0)
+
+    @property
+    def nbytes(self):
+        return int(self.rows.memory_usage(deep=True).sum()) + sum(cumulative.nbytes for cumulative in self._cumulative.values())
+
+    def apply(self, deltas):
+        """
+        Gets the table with rollup rows changed, e.g. by one webhook event, without loading every
+        row from the rollup store again
+
+        Parameters:
+            deltas: DataFrame of rollup rows to add, from rollup_store.update_rollups
+
+        Returns:
+            rollups: RollupTable
+        """
+        if len(deltas) == 0:
+            return self
+        keys = ['period', 'period_start', *ROLLUP_KEYS]
+        rows = pd.concat([self.rows, deltas[self.rows.columns]], ignore_index=True) \
+            .groupby(keys, sort=False)[list(ROLLUP_FIELDS)].sum().reset_index()
+        rows = rows[rows['count'] > 0].sort_values(['period', 'period_start'], kind='stable').reset_index(drop=True) # as rollup_store.load_rollups orders them
+        return RollupTable(rows)
+
+    def span_sums(self, period, first, last):
+        """
+        Sums whole periods for every (sport_type, commute) in self.keys
+
+        Parameters:
+            period: string
+            first: int, start of the first period
+            last: int, end of the last period
+
+        Returns:
+            sums: ndarray of shape (keys, rollup fields)
+        """
+        i, j = np.searchsorted(self._starts[period], [first, last], side='left')
+        return self._cumulative[period][j] - self._cumulative[period][i]
+
+def range_totals(rollups, data_frame, start_date, end_date):
+    """
+    Totals activities within a date range, inclusive, by (sport_type, commute)
+
+    Whole years, months and weeks are read from the rollups, so only the activities in the
+    leftover days at either edge are summed from the activity rows.
+
+    Parameters:
+        rollups: RollupTable
+        data_frame: DataFrame sorted by start_epoch
+        start_date: Timestamp
+        end_date: Timestamp
+
+    Returns:
+        totals: DataFrame with sport_type, commute and the rollup fields, one row per pair with activities
+    """
+    start = int(np.ceil(start_date.timestamp()))
+    end = int(np.floor(end_date.timestamp())) + 1
+    spans, remainders = cover_range(start, end)
+
+    keys = list(rollups.keys)
+    sums = np.zeros((len(keys), len(ROLLUP_FIELDS)))
+    for period, first, last in spans:
+        sums += rollups.span_sums(period, first, last)
+
+    epochs = data_frame['start_epoch'].to_numpy()
+    positions = [np.arange(*np.searchsorted(epochs, [remainder_start, remainder_end], side='left')) for remainder_start, remainder_end in remainders]
+    sport_types, commutes, values = _activity_rollup_values(data_frame, np.concatenate(positions or [np.empty(0, dtype=np.int64)]))
+    codes = dict(rollups.codes)
+    for key, activity_values in zip(zip(sport_types, commutes), values):
+        if key not in codes: # synced after the rollups were loaded
+            codes[key] = len(keys)
+            keys.append(key)
+            sums = np.vstack([sums, np.zeros(len(ROLLUP_FIELDS))])
+        sums[codes[key]] += activity_values
+
+    found = sums[:, 0] > 0
+    totals = {'sport_type': [key[0] for key, row_found in zip(keys, found) if row_found], 'commute': [key[1] for key, row_found in zip(keys, found) if row_found]}
+    totals.update((field, sums[found, i]) for i, field in enumerate(ROLLUP_FIELDS))
+    return pd.DataFrame(totals)
+
+def time_series(rollups, period, start_date, end_date, sport_types=None, commute=None):
+    """
+    Gets one value of every rollup field per period, for charts. Periods at either end of the
+    date range are counted whole.
+
+    Parameters:
+        rollups: RollupTable
+        period: string, 'week', 'month' or 'year'
+        start_date: Timestamp
+        end_date: Timestamp
+        sport_types: list of string, or None for every sport type
+        commute: boolean, or None for both
+
+    Returns:
+        series: dict with period, starts (ISO dates) and a list of values per rollup field
+    """
+    first = _floor(int(np.ceil(start_date.timestamp())), period)
+    last = _floor(int(np.floor(end_date.timestamp())), period)
+    starts = [first]
+    while starts[-1] < last:
+        starts.append(int(next_period_starts([starts[-1]], period)[0]))
+
+    rows = rollups.rows
+    selected = (rows['period'] == period) & (rows['period_start'] >= first) & (rows['period_start'] <= last)
+    if sport_types is not None:
+        selected &= rows['sport_type'].isin(sport_types)
+    if commute is not None:
+        selected &= rows['commute'] == commute
+    sums = rows.loc[selected].groupby('period_start')[list(ROLLUP_FIELDS)].sum().reindex(starts, fill_value=0)
+
+    series = {
+        'period': period,
+        'starts': pd.to_datetime(starts, unit='s').strftime('%Y-%m-%d').tolist()
+    }
+    for field in ROLLUP_FIELDS:
+        values = sums[field].to_numpy(dtype=np.float64) # object columns when no rollups are stored yet
+        series[field] = values.astype(np.int64).tolist() if field == 'count' else np.round(values, 1).tolist()
+    return series
@@ -0,0 +1,526 @@
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+from geometry import decode_polyline
+
+EARTH_METERS_PER_DEGREE = 111320.0
+MIN_ROUTE_METERS = 500 # shorter tracks, and activities without one, are not matched to routes
+SHINGLE_SPACING_METERS = 50 # close enough together that a track never skips a geohash cell
+GEOHASH_BITS = 35 # geohash precision 7, cells about 150 m across, kept as integers instead of base32 strings
+PATH_SPACING_METERS = 100 # spacing of the points compared by the Frechet check
+MAX_PATH_POINTS = 100 # long tracks are compared with fewer, further apart points
+FRECHET_TOLERANCE_METERS = 200 # tracks of the same route stay this close, allowing for gps noise and polyline simplification
+MIN_SIMILARITY = 0.5 # estimated jaccard similarity of shingle sets worth a Frechet check
+
+# MinHash signatures are split into LSH bands, a pair of routes is a candidate if any band is identical.
+# With 16 bands of 4 rows, pairs with a similarity of 0.5 are found 64% of the time, 0.7 98% and 0.3 12%.
+LSH_BANDS = 16
+LSH_ROWS = 4
+_HASH_PRIME = (1 << 31) - 1
+_HASH_A, _HASH_B = np.random.default_rng(20240601).integers(1, _HASH_PRIME, size=(2, LSH_BANDS * LSH_ROWS, 1), dtype=np.int64)
+
+def project(points, latitude):
+    """
+    Projects (lat, lng) pairs to metres, accurate over the few kilometres two matching tracks are apart
+
+    Parameters:
+        points: ndarray of shape (n, 2)
+        latitude: double, where east-west distances are measured
+
+    Returns:
+        xy: ndarray of shape (n, 2), metres
+    """
+    return np.column_stack((points[:, 1] * np.cos(np.radians(latitude)), points[:, 0])) * EARTH_METERS_PER_DEGREE
+
+def resample_track(points, spacing, max_points=None):
+    """
+    Resamples a track to points evenly spaced along it
+
+    Parameters:
+        points: ndarray of shape (n, 2), (lat, lng) pairs
+        spacing: double, metres
+        max_points: int, the spacing is widened for tracks that would need more points
+
+    Returns:
+        resampled: ndarray of shape (m, 2), (lat, lng) pairs
+        length: double, metres
+    """
+    steps = np.hypot(*np.diff(project(points, points[:, 0].mean()), axis=0).T)
+    along = np.concatenate(([0.0], np.cumsum(steps)))
+    length = along[-1]
+    count = int(length // spacing) + 2
+    if max_points is not None:
+        count = min(count, max_points)
+    targets = np.linspace(0.0, length, count)
+    return np.column_stack((np.interp(targets, along, points[:, 0]), np.interp(targets, along, points[:, 1]))), length
+
+def geohash_cells(points, bits=GEOHASH_BITS):
+    """
+    Gets the geohash cell of each point as an integer, longitude and latitude bits interleaved
+
+    Parameters:
+        points: ndarray of shape (n, 2), (lat, lng) pairs
+        bits: int, odd numbers give longitude the extra bit, like geohash
+
+    Returns:
+        cells: ndarray of int64
+    """
+    lng_bits = (bits + 1) // 2
+    lat_bits = bits // 2
+    lat = np.clip(((points[:, 0] + 90) / 180 * (1 << lat_bits)).astype(np.int64), 0, (1 << lat_bits) - 1)
+    lng = np.clip(((points[:, 1] + 180) / 360 * (1 << lng_bits)).astype(np.int64), 0, (1 << lng_bits) - 1)
+    cells = np.zeros(len(points), dtype=np.int64)
+    for bit in range(lng_bits): # longitude takes the even bits from the top, latitude the odd ones
+        cells |= ((lng >> (lng_bits - 1 - bit)) & 1) << (bits - 1 - 2 * bit)
+        if bit < lat_bits:
+            cells |= ((lat >> (lat_bits - 1 - bit)) & 1) << (bits - 2 - 2 * bit)
+    return cells
+
+def track_shingles(points):
+    """
+    Gets the set of geohash cells a track passes through. Cells are compared rather than runs of
+    cells, since gps noise near a cell edge changes every run that includes the cell, and the
+    Frechet check tells the directions apart.
+
+    Parameters:
+        points: ndarray of shape (n, 2), (lat, lng) pairs
+
+    Returns:
+        shingles: ndarray of unique int64 below 2 ** 31
+    """
+    return np.unique(geohash_cells(resample_track(points, SHINGLE_SPACING_METERS)[0]) % _HASH_PRIME)
+
+def minhash_signature(shingles):
+    """
+    Computes the MinHash signature of a shingle set, one minimum per hash function
+
+    Parameters:
+        shingles: ndarray of int64 below 2 ** 31
+
+    Returns:
+        signature: ndarray of int64, LSH_BANDS * LSH_ROWS values
+    """
+    return ((_HASH_A * shingles[np.newaxis, :] + _HASH_B) % _HASH_PRIME).min(axis=1)
+
+def stable_hash(*values):
+    """
+    Hashes strings or bytes to a signed 64 bit integer that is the same in every process, unlike
+    hash(), so hashes kept in a snapshot still match after a restart
+
+    Parameters:
+        values: strings or bytes
+
+    Returns:
+        hash: int
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    for value in values:
+        digest.update(value.encode('utf-8') if isinstance(value, str) else value)
+        digest.update(b'\0')
+    return int.from_bytes(digest.digest(), 'little', signed=True)
+
+def band_keys(signature, sport_type):
+    """
+    Gets the LSH bucket of each band of a signature. The sport type is part of every key, so a run
+    and a ride along the same roads never share a bucket.
+
+    Parameters:
+        signature: ndarray from minhash_signature
+        sport_type: string
+
+    Returns:
+        keys: list of int
+    """
+    return [stable_hash(sport_type, bytes([band]), signature[band * LSH_ROWS:(band + 1) * LSH_ROWS].astype('<i8').tobytes()) for band in range(LSH_BANDS)]
+
+def frechet_within(a, b, tolerance):
+    """
+    Decides whether the discrete Frechet distance between two tracks is within a tolerance
+
+    Cells of the coupling grid reachable from the start are found one row at a time: a cell is
+    reached from the row above or diagonally, then reachability runs right along unbroken stretches
+    of cells within the tolerance.
+
+    Parameters:
+        a: ndarray of shape (n, 2), (lat, lng) pairs
+        b: ndarray of shape (m, 2), (lat, lng) pairs
+        tolerance: double, metres
+
+    Returns:
+        within: boolean
+    """
+    latitude = (a[:, 0].mean() + b[:, 0].mean()) / 2
+    a, b = project(a, latitude), project(b, latitude)
+    if np.hypot(*(a[0] - b[0])) > tolerance or np.hypot(*(a[-1] - b[-1])) > tolerance:
+        return False
+    free = np.hypot(a[:, np.newaxis, 0] - b[np.newaxis, :, 0], a[:, np.newaxis, 1] - b[np.newaxis, :, 1]) <= tolerance
+    columns = np.arange(len(b))
+    reached = np.logical_and.accumulate(free[0])
+    for row in free[1:]:
+        seeds = row & (reached | np.concatenate(([False], reached[:-1]))) # from above, or diagonally from above left
+        last_seed = np.maximum.accumulate(np.where(seeds, columns, -1))
+        last_gap = np.maximum.accumulate(np.where(row, -1, columns))
+        reached = row & (last_seed > last_gap)
+        if not reached.any():
+            return False
+    return bool(reached[-1])
+
+class MappedRoutes:
+    """
+    A route index restored from a snapshot, read from its memory maps in place so processes
+    serving the same snapshot share it
+
+    Parameters:
+        arrays: dict from RouteIndex.export
+        route_sport_types: list of string, aligned with arrays['route_list']
+    """
+    def __init__(self, arrays, route_sport_types):
+        self.arrays = arrays
+        self.route_sport_types = route_sport_types
+
+    def _lookup(self, sorted_ids, values, ids, missing):
+        # both id arrays are written sorted, so lookups are binary searches
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(sorted_ids) == 0:
+            return [missing] * len(ids)
+        positions = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+        return [values[position] if found else missing for position, found in zip(positions.tolist(), (sorted_ids[positions] == ids).tolist())]
+
+    def route_ids(self, activity_ids):
+        return np.array(self._lookup(self.arrays['activity_ids'], self.arrays['route_ids'], activity_ids, -1), dtype=np.int64)
+
+    def sport_types(self, route_ids):
+        return self._lookup(self.arrays['route_list'], self.route_sport_types, route_ids, None)
+
+class RouteIndex:
+    """
+    Groups activities that follow the same route, kept across syncs so each activity is matched once
+
+    Each activity's track is fingerprinted with a MinHash signature of the geohash cells it passes
+    through. Signature bands are hashed with the sport type into LSH buckets of route ids, so a new
+    activity is only compared with routes of its sport sharing a bucket, and each candidate is
+    confirmed with a discrete Frechet check against the track of the route's first activity. Route
+    ids are the id of one of the route's activities, the first one matched while it remains.
+    """
+    def __init__(self):
+        self._activities = {} # activity id -> (hash of sport type and polyline, route id, band keys)
+        self._routes = {} # route id -> (track compared with, its signature, set of member activity ids, sport type)
+        self._buckets = {} # band key -> {route id: member count}
+        self._mapped = None # MappedRoutes restored from a snapshot, used instead of the dicts until the next update
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        mapped = self._mapped
+        return len(mapped.arrays['route_list']) if mapped is not None else len(self._routes)
+
+    def update(self, activity_ids, polylines, sport_types):
+        """
+        Matches activities that are new or whose polyline or sport type changed, and drops removed
+        activities
+
+        Parameters:
+            activity_ids: iterable of int
+            polylines: iterable of string
+            sport_types: iterable of string
+
+        Returns:
+            processed_count: int
+        """
+        current = {int(id): (polyline, str(sport_type)) for id, polyline, sport_type in zip(activity_ids, polylines, sport_types)}
+        self._copy_mapped()
+        with self._lock:
+            for id in [id for id in self._activities if id not in current]:
+                self._remove(id)
+            processed_count = 0
+            for id, (polyline, sport_type) in current.items():
+                entry = self._activities.get(id)
+                if entry is not None and entry[0] == stable_hash(sport_type, polyline):
+                    continue
+                if entry is not None:
+                    self._remove(id)
+                self._add(id, polyline, sport_type)
+                processed_count += 1
+        return processed_count
+
+    def add(self, activity_id, polyline, sport_type):
+        """
+        Matches one activity, replacing its previous match. Only routes sharing an LSH bucket with
+        it are compared, so this does not grow with the number of activities.
+
+        Parameters:
+            activity_id: int
+            polyline: string
+            sport_type: string
+
+        Returns:
+            route_id: int, or None if the activity has no track long enough to match
+        """
+        self._copy_mapped()
+        with self._lock:
+            if int(activity_id) in self._activities:
+                self._remove(int(activity_id))
+            return self._add(int(activity_id), polyline, str(sport_type))
+
+    def remove(self, activity_id):
+        """
+        Removes one activity, and its route once no activities are left on it
+
+        Parameters:
+            activity_id: int
+
+        Returns:
+            none
+        """
+        self._copy_mapped()
+        with self._lock:
+            if int(activity_id) in self._activities:
+                self._remove(int(activity_id))
+
+    def route_ids(self, activity_ids):
+        """
+        Gets the route of each activity
+
+        Parameters:
+            activity_ids: iterable of int
+
+        Returns:
+            route_ids: ndarray of int64, -1 for activities without a route
+        """
+        activity_ids = list(activity_ids)
+        mapped = self._mapped
+        if mapped is not None:
+            return mapped.route_ids(activity_ids)
+        with self._lock:
+            entries = [self._activities.get(id) for id in activity_ids]
+        return np.array([entry[1] if entry is not None and entry[1] is not None else -1 for entry in entries], dtype=np.int64)
+
+    def sport_types(self, route_ids):
+        """
+        Gets the sport type of each route
+
+        Parameters:
+            route_ids: iterable of int
+
+        Returns:
+            sport_types: list of string, None for ids that are not a route
+        """
+        route_ids = list(route_ids)
+        mapped = self._mapped
+        if mapped is not None:
+            return mapped.sport_types(route_ids)
+        with self._lock:
+            return [self._routes[id][3] if id in self._routes else None for id in route_ids]
+
+    def export(self):
+        """
+        Gets the index as arrays, for writing a snapshot. Activities and routes are sorted by id.
+
+        Returns:
+            arrays: dict of name -> ndarray
+                activity_ids, polyline_hashes and route_ids (-1 without a route) of every activity matched
+                keys: shape (activities, LSH_BANDS), the band keys of each activity, zeros without a route
+                route_list, route_signatures and route_track_offsets of every route, into route_tracks
+                route_tracks: shape (points, 2), the tracks routes are compared with
+            route_sport_types: list of string, aligned with route_list
+        """
+        self._copy_mapped()
+        with self._lock:
+            activity_ids = sorted(self._activities)
+            route_list = sorted(self._routes)
+            entries = [self._activities[id] for id in activity_ids]
+            routes = [self._routes[id] for id in route_list]
+        keys = np.zeros((len(entries), LSH_BANDS), dtype=np.int64)
+        for position, entry in enumerate(entries):
+            if entry[2]:
+                keys[position] = entry[2]
+        track_offsets = np.zeros(len(routes) + 1, dtype=np.int64)
+        np.cumsum([len(route[0]) for route in routes], out=track_offsets[1:])
+        arrays = {
+            'activity_ids': np.array(activity_ids, dtype=np.int64),
+            'polyline_hashes': np.array([entry[0] for entry in entries], dtype=np.int64),
+            'route_ids': np.array([entry[1] if entry[1] is not None else -1 for entry in entries], dtype=np.int64),
+            'keys': keys,
+            'route_list': np.array(route_list, dtype=np.int64),
+            'route_signatures': np.array([route[1] for route in routes], dtype=np.int64).reshape(len(routes), LSH_BANDS * LSH_ROWS),
+            'route_track_offsets': track_offsets,
+            'route_tracks': np.concatenate([route[0] for route in routes]) if routes else np.zeros((0, 2))
+        }
+        return arrays, [route[3] for route in routes]
+
+    def restore(self, arrays, route_sport_types):
+        """
+        Replaces the index with one exported to a snapshot, read from the snapshot in place so
+        nothing is matched again
+
+        Parameters:
+            arrays: dict of name -> ndarray, from export
+            route_sport_types: list of string, from export
+
+        Returns:
+            none
+        """
+        with self._lock:
+            self._activities = {}
+            self._routes = {}
+            self._buckets = {}
+            self._mapped = MappedRoutes(arrays, route_sport_types)
+
+    def _copy_mapped(self):
+        # the dicts are updated in place, so an index restored from a snapshot is copied into them first
+        mapped = self._mapped
+        if mapped is None:
+            return
+        arrays = mapped.arrays
+        offsets = arrays['route_track_offsets'].tolist()
+        routes = {}
+        for position, route_id in enumerate(arrays['route_list'].tolist()):
+            routes[route_id] = (np.array(arrays['route_tracks'][offsets[position]:offsets[position + 1]]), np.array(arrays['route_signatures'][position]),
+                                set(), mapped.route_sport_types[position])
+        activities = {}
+        buckets = {}
+        for id, polyline_hash, route_id, keys in zip(arrays['activity_ids'].tolist(), arrays['polyline_hashes'].tolist(), arrays['route_ids'].tolist(),
+                                                     arrays['keys'].tolist()):
+            if route_id < 0:
+                activities[id] = (polyline_hash, None, ())
+                continue
+            activities[id] = (polyline_hash, route_id, keys)
+            routes[route_id][2].add(id)
+            for key in keys:
+                bucket = buckets.setdefault(key, {})
+                bucket[route_id] = bucket.get(route_id, 0) + 1
+
+        with self._lock:
+            self._activities = activities
+            self._routes = routes
+            self._buckets = buckets
+            self._mapped = None
+
+    def _add(self, id, polyline, sport_type):
+        polyline_hash = stable_hash(sport_type, polyline)
+        points = decode_polyline(polyline)
+        if len(points) < 2:
+            self._activities[id] = (polyline_hash, None, ())
+            return None
+        track, length = resample_track(points, PATH_SPACING_METERS, MAX_PATH_POINTS)
+        if length < MIN_ROUTE_METERS:
+            self._activities[id] = (polyline_hash, None, ())
+            return None
+        signature = minhash_signature(track_shingles(points))
+        keys = band_keys(signature, sport_type)
+
+        candidates = set()
+        for key in keys:
+            candidates.update(self._buckets.get(key, ()))
+        candidates = [candidate for candidate in candidates if self._routes[candidate][3] == sport_type] # in case of a key collision
+        route_id = None
+        for candidate in sorted(candidates, key=lambda candidate: -np.mean(self._routes[candidate][1] == signature)):
+            candidate_track, candidate_signature, _, _ = self._routes[candidate]
+            if np.mean(candidate_signature == signature) < MIN_SIMILARITY:
+                break
+            if frechet_within(track, candidate_track, max(FRECHET_TOLERANCE_METERS, length / MAX_PATH_POINTS)):
+                route_id = candidate
+                break
+        if route_id is None: # a route of its own
+            route_id = id
+            self._routes[route_id] = (track, signature, set(), sport_type)
+
+        self._routes[route_id][2].add(id)
+        self._activities[id] = (polyline_hash, route_id, keys)
+        for key in keys:
+            bucket = self._buckets.setdefault(key, {})
+            bucket[route_id] = bucket.get(route_id, 0) + 1
+        return route_id
+
+    def _remove(self, id):
+        _, route_id, keys = self._activities.pop(id)
+        if route_id is None:
+            return
+        for key in keys:
+            bucket = self._buckets[key]
+            bucket[route_id] -= 1
+            if bucket[route_id] == 0:
+                del bucket[route_id]
+                if not bucket:
+                    del self._buckets[key]
+
+        track, signature, members, sport_type = self._routes.pop(route_id)
+        members.discard(id)
+        if not members:
+            return
+        if id != route_id:
+            self._routes[route_id] = (track, signature, members, sport_type)
+            return
+        # the route is named after its activities, keep the track it is compared with but take another id
+        new_id = min(members)
+        self._routes[new_id] = (track, signature, members, sport_type)
+        for member in members:
+            polyline_hash, _, member_keys = self._activities[member]
+            self._activities[member] = (polyline_hash, new_id, member_keys)
+            for key in member_keys:
+                bucket = self._buckets[key]
+                bucket[new_id] = bucket.get(new_id, 0) + 1
+                bucket[route_id] -= 1
+                if bucket[route_id] == 0:
+                    del bucket[route_id]
+
+def route_stats(route_index, data_frame, min_attempts=2, sport_type=None):
+    """
+    Summarizes the activities on every route. Only activities of the route's sport type count as
+    attempts, e.g. one changed from a ride to a run since the index was last updated.
+
+    Parameters:
+        route_index: RouteIndex
+        data_frame: DataFrame sorted by start_epoch
+        min_attempts: int
+        sport_type: string, or None for routes of every sport type
+
+    Returns:
+        routes: DataFrame with one row per route, most attempted first, and an attempts column of
+            the route's activity ids. trend is the change in moving time per year, negative when
+            getting faster, from a least squares line once there are 3 attempts.
+    """
+    attempts = data_frame[['id', 'name', 'sport_type', 'distance', 'moving_time', 'start_epoch']].assign(route_id=route_index.route_ids(data_frame['id'].tolist()))
+    attempts = attempts[attempts['route_id'] >= 0]
+    route_list = attempts['route_id'].unique()
+    route_sport_types = pd.Series(route_index.sport_types(route_list.tolist()), index=route_list, dtype=object)
+    attempts = attempts[attempts['sport_type'].astype(str).to_numpy() == attempts['route_id'].map(route_sport_types).to_numpy()]
+    if sport_type is not None:
+        attempts = attempts[attempts['sport_type'].astype(str) == sport_type]
+
+    # attempts of each route are contiguous after a stable sort, still in start_epoch order
+    order = np.argsort(attempts['route_id'].to_numpy(), kind='stable')
+    route_ids = attempts['route_id'].to_numpy()[order]
+    ids = attempts['id'].to_numpy()[order]
+    names = attempts['name'].to_numpy(dtype=object)[order]
+    distance = attempts['distance'].to_numpy(dtype=np.float64)[order]
+    moving_times = attempts['moving_time'].to_numpy(dtype=np.float64)[order]
+    start_epochs = attempts['start_epoch'].to_numpy()[order]
+    dates = pd.to_datetime(start_epochs, unit='s').strftime('%Y-%m-%d')
+    starts = np.flatnonzero(np.concatenate(([True], route_ids[1:] != route_ids[:-1]))) if len(route_ids) > 0 else np.zeros(0, dtype=np.int64)
+    ends = np.append(starts[1:], len(route_ids))
+
+    rows = []
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        if end - start < min_attempts:
+            continue
+        route_id = int(route_ids[start])
+        moving_time = moving_times[start:end]
+        years = (start_epochs[start:end] - start_epochs[start]) / (365.25 * 24 * 60 * 60)
+        best = int(np.argmin(moving_time))
+        rows.append({
+            'id': route_id,
+            'name': names[end - 1], # most recent
+            'sport_type': route_sport_types[route_id],
+            'attempts': end - start,
+            'distance': round(float(np.median(distance[start:end])) / 1000, 2),
+            'best_time': int(moving_time[best]),
+            'best_activity_id': int(ids[start + best]),
+            'average_time': int(round(moving_time.mean())),
+            'trend': round(float(np.polyfit(years, moving_time, 1)[0]), 1) if end - start >= 3 and np.ptp(years) > 0 else None,
+            'first_date': dates[start],
+            'last_date': dates[end - 1],
+            'attempt_ids': ids[start:end].tolist()
+        })
+    columns = ['id', 'name', 'sport_type', 'attempts', 'distance', 'best_time', 'best_activity_id', 'average_time', 'trend', 'first_date', 'last_date', 'attempt_ids']
+    return pd.DataFrame(rows, columns=columns).sort_values(['attempts', 'id'], ascending=[False, True], ignore_index=True)
@@ -0,0 +1,202 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import segment_store
+from geometry import decode_polyline
+from spatial_index import GridIndex
+from strava_client import RateLimitDeferred
+
+EXPLORE_CAP = 10 # most segments /segments/explore returns for one area
+EXPLORE_MAX_DEPTH = 6 # quadtree levels below the requested area, 4096 cells at most
+SEGMENT_TTL = 7 * 24 * 60 * 60 # seconds before stored segment details and explored cells are fetched again
+
+def split_bounds(box):
+    """
+    Splits a box into its four quadrants
+
+    Parameters:
+        box: tuple of (south, west, north, east)
+
+    Returns:
+        quadrants: list of tuple
+    """
+    south, west, north, east = box
+    middle_lat = (south + north) / 2
+    middle_lng = (west + east) / 2
+    return [(south, west, middle_lat, middle_lng), (south, middle_lng, middle_lat, east),
+            (middle_lat, west, north, middle_lng), (middle_lat, middle_lng, north, east)]
+
+def segment_bounds(segment):
+    """
+    Gets the bounding box of a segment from its polyline, or its start and end points
+
+    Parameters:
+        segment: dict, explore result or segment detail
+
+    Returns:
+        box: tuple of (south, west, north, east)
+    """
+    polyline = (segment.get('map') or {}).get('polyline') or segment.get('points')
+    points = decode_polyline(polyline) if polyline else np.empty((0, 2))
+    if len(points) == 0:
+        points = np.array([segment['start_latlng'], segment['end_latlng']], dtype=np.float64)
+    return (float(points[:, 0].min()), float(points[:, 1].min()), float(points[:, 0].max()), float(points[:, 1].max()))
+
+class SegmentCache:
+    """
+    Segment details stored on disk with a time to live, and indexed by bounding box in memory
+
+    Parameters:
+        filename: string
+        ttl: int, seconds
+    """
+    def __init__(self, filename, ttl=SEGMENT_TTL):
+        self.filename = filename
+        self.ttl = ttl
+        self.index = GridIndex(cell_size=0.01)
+        self._segments = {} # id -> detail
+        self._fetched_at = {} # id -> seconds since epoch
+        self._lock = threading.Lock()
+        for segment, box, fetched_at in segment_store.load_segments(filename):
+            self._add(segment, box, fetched_at)
+
+    def __len__(self):
+        return len(self._segments)
+
+    def _add(self, segment, box, fetched_at):
+        self._segments[segment['id']] = segment
+        self._fetched_at[segment['id']] = fetched_at
+        self.index.insert(segment['id'], box)
+
+    def is_fresh(self, segment_id):
+        return time.time() - self._fetched_at.get(segment_id, 0) < self.ttl
+
+    def get(self, segment_id):
+        return self._segments.get(segment_id)
+
+    def put(self, segments):
+        """
+        Stores segment details and indexes them
+
+        Parameters:
+            segments: list of dict
+
+        Returns:
+            none
+        """
+        boxed = [(segment, segment_bounds(segment)) for segment in segments]
+        fetched_at = segment_store.upsert_segments(self.filename, boxed)
+        with self._lock:
+            for segment, box in boxed:
+                self._add(segment, box, fetched_at)
+
+    def query(self, box):
+        """
+        Finds stored segments whose bounding box intersects an area
+
+        Parameters:
+            box: tuple of (south, west, north, east)
+
+        Returns:
+            segments: list of dict
+        """
+        return [self._segments[id] for id in sorted(self.index.query(box))]
+
+    def explore(self, get, box, activity_type='riding', cap=EXPLORE_CAP, max_depth=EXPLORE_MAX_DEPTH, concurrency=8):
+        """
+        Finds the segments in an area with a quadtree of /segments/explore requests
+
+        A cell that returns the cap may be hiding more segments, so only those cells are split and
+        explored again. Each level of the quadtree is requested concurrently, and cells explored
+        within the time to live are answered from disk.
+
+        Parameters:
+            get: callable taking (path, params) and returning the response json
+            box: tuple of (south, west, north, east)
+            activity_type: string, 'riding' or 'running'
+            cap: int
+            max_depth: int
+            concurrency: int
+
+        Returns:
+            segment_ids: set of int
+            request_count: int, cells requested from Strava rather than disk
+        """
+        def explore_cell(cell):
+            key = f'{activity_type}:' + ','.join(f'{value:.6f}' for value in cell)
+            segments = segment_store.get_explored_cell(self.filename, key, self.ttl)
+            if segments is not None:
+                return segments, False
+            segments = get('/segments/explore', {'bounds': ','.join(str(value) for value in cell), 'activity_type': activity_type})['segments']
+            segment_store.set_explored_cell(self.filename, key, segments)
+            return segments, True
+
+        segment_ids = set()
+        request_count = 0
+        cells = [(tuple(float(value) for value in box), 0)]
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while cells:
+                futures = [(cell, depth, executor.submit(explore_cell, cell)) for cell, depth in cells]
+                cells = []
+                for cell, depth, future in futures:
+                    try:
+                        segments, requested = future.result()
+                    except RateLimitDeferred: # explored again on a later call
+                        continue
+                    request_count += requested
+                    segment_ids.update(segment['id'] for segment in segments)
+                    if len(segments) >= cap and depth < max_depth:
+                        cells.extend((quadrant, depth + 1) for quadrant in split_bounds(cell))
+        return segment_ids, request_count
+
+    def fetch_details(self, get, segment_ids, concurrency=8):
+        """
+        Fetches the details of segments that are not stored or have expired, concurrently
+
+        Parameters:
+            get: callable taking (path, params) and returning the response json
+            segment_ids: iterable of int
+            concurrency: int
+
+        Returns:
+            fetched_count: int
+        """
+        stale_ids = [id for id in segment_ids if not self.is_fresh(id)]
+        details = []
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for future in [executor.submit(get, f'/segments/{id}', None) for id in stale_ids]:
+                try:
+                    details.append(future.result())
+                except RateLimitDeferred: # fetched on a later call
+                    continue
+        if details:
+            self.put(details)
+        return len(details)
+
+def compare_segments(segments):
+    """
+    Compares the athlete's PR on each segment to the overall best, from stored segment details
+
+    Parameters:
+        segments: list of dict, segment details
+
+    Returns:
+        comparison: DataFrame with id, name, average_grade, distance, pr_elapsed_time, pr_speed (km/h), kom and overall
+    """
+    columns = ['id', 'name', 'average_grade', 'distance', 'pr_elapsed_time', 'pr_speed', 'kom', 'overall']
+    if not segments:
+        return pd.DataFrame(columns=columns)
+    comparison = pd.DataFrame({
+        'id': [segment['id'] for segment in segments],
+        'name': [segment['name'] for segment in segments],
+        'average_grade': [segment.get('average_grade') for segment in segments],
+        'distance': [segment.get('distance') for segment in segments],
+        'pr_elapsed_time': [(segment.get('athlete_segment_stats') or {}).get('pr_elapsed_time') for segment in segments],
+        'kom': [(segment.get('xoms') or {}).get('kom') for segment in segments],
+        'overall': [(segment.get('xoms') or {}).get('overall') for segment in segments]
+    })
+    comparison['pr_elapsed_time'] = comparison['pr_elapsed_time'].astype(float)
+    comparison['pr_speed'] = comparison['distance'] / comparison['pr_elapsed_time'] * 3.6
+    return comparison[columns]
@@ -0,0 +1,81 @@
+import json
+import sqlite3
+import time
+from contextlib import closing
+
+def _connect(filename):
+    """
+    Opens a connection to the segment store and creates the schema if needed
+
+    Parameters:
+        filename: string
+
+    Returns:
+        conn: sqlite3.Connection
+    """
+    conn = sqlite3.connect(filename, timeout=30)
+    conn.execute('CREATE TABLE IF NOT EXISTS segments (id INTEGER PRIMARY KEY, fetched_at INTEGER NOT NULL, south REAL, west REAL, north REAL, east REAL, data TEXT NOT NULL)')
+    conn.execute('CREATE TABLE IF NOT EXISTS explored_cells (cell TEXT PRIMARY KEY, fetched_at INTEGER NOT NULL, segments TEXT NOT NULL)')
+    return conn
+
+def load_segments(filename):
+    """
+    Loads every stored segment detail
+
+    Parameters:
+        filename: string
+
+    Returns:
+        segments: list of (segment detail dict, bounding box, fetched_at)
+    """
+    with closing(_connect(filename)) as conn:
+        rows = conn.execute('SELECT data, south, west, north, east, fetched_at FROM segments').fetchall()
+    return [(json.loads(row[0]), tuple(row[1:5]), row[5]) for row in rows]
+
+def upsert_segments(filename, segments):
+    """
+    Inserts or overwrites segment details
+
+    Parameters:
+        filename: string
+        segments: list of (segment detail dict, bounding box)
+
+    Returns:
+        fetched_at: int
+    """
+    fetched_at = int(time.time())
+    rows = [(segment['id'], fetched_at, *box, json.dumps(segment)) for segment, box in segments]
+    with closing(_connect(filename)) as conn, conn:
+        conn.executemany('INSERT OR REPLACE INTO segments (id, fetched_at, south, west, north, east, data) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+    return fetched_at
+
+def get_explored_cell(filename, cell, max_age):
+    """
+    Gets the segments an explore request for a cell returned, if it was made recently enough
+
+    Parameters:
+        filename: string
+        cell: string
+        max_age: int, seconds
+
+    Returns:
+        segments: list of dict, or None if the cell has not been explored within max_age
+    """
+    with closing(_connect(filename)) as conn:
+        row = conn.execute('SELECT segments FROM explored_cells WHERE cell = ? AND fetched_at >= ?', (cell, int(time.time()) - max_age)).fetchone()
+    return json.loads(row[0]) if row is not None else None
+
+def set_explored_cell(filename, cell, segments):
+    """
+    Records the segments an explore request for a cell returned
+
+    Parameters:
+        filename: string
+        cell: string
+        segments: list of dict
+
+    Returns:
+        none
+    """
+    with closing(_connect(filename)) as conn, conn:
+        conn.execute('INSERT OR REPLACE INTO explored_cells (cell, fetched_at, segments) VALUES (?, ?, ?)', (cell, int(time.time()), json.dumps(segments)))
@@ -0,0 +1,271 @@
+import json
+import os
+import secrets
+import shutil
+import time
+import numpy as np
+import pandas as pd
+from activity_model import PolylineStore
+from curves import CurveMatrix
+from spatial_index import pack_grid
+
+POINTER_FILENAME = 'CURRENT'
+MANIFEST_FILENAME = 'manifest.json'
+SNAPSHOT_FORMAT = 4
+KEEP_VERSIONS = 2 # older versions are deleted, processes still mapping one keep their pages until they move on
+LOAD_ATTEMPTS = 3 # versions tried when the one being loaded is deleted by a newer writer
+
+class Snapshot:
+    """
+    A loaded snapshot. Numeric columns, polylines, simplified lines, curves, track bounds with their
+    grid index and the route index are read-only memory maps, so every process loading the same version shares their pages through
+    the OS page cache instead of holding its own copy.
+
+    Attributes:
+        version: string, name of the version directory
+        activities: DataFrame sorted by start_epoch
+        polylines: PolylineStore, aligned with the activities rows
+        curves: dict of curve kind -> CurveMatrix
+        rollups: DataFrame of rollup rows
+        boxes: ndarray of shape (activities, 4), track bounding boxes, nan for activities without a track
+        lines: dict of zoom level -> PolylineStore of simplified encoded lines, empty where not simplified yet
+        grid: dict of name -> ndarray, spatial_index.pack_grid over the track bounds
+        routes: dict of name -> ndarray, from RouteIndex.export
+        route_sport_types: list of string, the sport type of each route
+        fingerprint: string, heatmap.tracks_fingerprint of the tracks
+    """
+    def __init__(self, version, activities, polylines, curves, rollups, boxes, lines, grid, routes, route_sport_types, fingerprint):
+        self.version = version
+        self.activities = activities
+        self.polylines = polylines
+        self.curves = curves
+        self.rollups = rollups
+        self.boxes = boxes
+        self.lines = lines
+        self.grid = grid
+        self.routes = routes
+        self.route_sport_types = route_sport_types
+        self.fingerprint = fingerprint
+
+def current_version(directory):
+    """
+    Reads the pointer to the version being served, cheap enough to check on every request
+
+    Parameters:
+        directory: string
+
+    Returns:
+        version: string, or None if no snapshot has been written
+    """
+    try:
+        with open(os.path.join(directory, POINTER_FILENAME)) as file:
+            return file.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def _save(path, array):
+    np.save(path, np.ascontiguousarray(array), allow_pickle=False)
+
+def _load(path):
+    # a plain ndarray view of the read-only map, so results computed from it are not memmaps
+    return np.asarray(np.load(path, mmap_mode='r', allow_pickle=False))
+
+def _write_strings(path, values):
+    # Arrow style: one utf-8 buffer and the offsets of every value in it, with a mask if any value is missing
+    missing = np.array([value is None or value is pd.NA or (isinstance(value, float) and np.isnan(value)) for value in values], dtype=bool)
+    encoded = [b'' if is_missing else str(value).encode('utf-8') for value, is_missing in zip(values, missing)]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    _save(path + '.data.npy', np.frombuffer(b''.join(encoded), dtype=np.uint8))
+    _save(path + '.offsets.npy', offsets)
+    if missing.any():
+        _save(path + '.missing.npy', missing)
+    return bool(missing.any())
+
+def _read_strings(path, nullable):
+    buffer = memoryview(_load(path + '.data.npy'))
+    offsets = _load(path + '.offsets.npy').tolist()
+    values = [str(buffer[start:end], 'utf-8') for start, end in zip(offsets[:-1], offsets[1:])]
+    if nullable:
+        for position in np.flatnonzero(_load(path + '.missing.npy')):
+            values[position] = None
+    return values
+
+def _read_polylines(path):
+    # ascii lines written by _write_strings, served from the map without decoding them
+    return PolylineStore.from_buffer(memoryview(_load(path + '.data.npy')), _load(path + '.offsets.npy'))
+
+def _write_frame(directory, prefix, data_frame):
+    """
+    Writes every column of a DataFrame to its own .npy file
+
+    Parameters:
+        directory: string
+        prefix: string, file name prefix of the frame's columns
+        data_frame: DataFrame
+
+    Returns:
+        columns: list of dict describing each column for the manifest
+    """
+    columns = []
+    for position, name in enumerate(data_frame.columns):
+        series = data_frame[name]
+        path = os.path.join(directory, f'{prefix}.{position}')
+        column = {'name': name}
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            column['kind'] = 'category'
+            column['categories'] = series.cat.categories.tolist()
+            _save(path + '.npy', series.cat.codes.to_numpy())
+        elif isinstance(series.dtype, pd.DatetimeTZDtype):
+            column['kind'] = 'datetime'
+            column['unit'] = series.dtype.unit
+            column['tz'] = str(series.dtype.tz)
+            _save(path + '.npy', series.to_numpy().view(np.int64) if series.dtype.unit == 'ns' else series.dt.tz_localize(None).to_numpy().view(np.int64))
+        elif series.dtype.kind in 'biuf':
+            column['kind'] = 'numeric'
+            _save(path + '.npy', series.to_numpy())
+        else:
+            column['kind'] = 'string'
+            column['dtype'] = str(series.dtype)
+            column['nullable'] = _write_strings(path, series.tolist())
+        columns.append(column)
+    return columns
+
+def _read_frame(directory, prefix, columns):
+    """
+    Maps the columns written by _write_frame back into a DataFrame, without copying numeric columns
+
+    Parameters:
+        directory: string
+        prefix: string
+        columns: list of dict, from the manifest
+
+    Returns:
+        data_frame: DataFrame
+    """
+    data = {}
+    for position, column in enumerate(columns):
+        path = os.path.join(directory, f'{prefix}.{position}')
+        if column['kind'] == 'category':
+            data[column['name']] = pd.Categorical.from_codes(_load(path + '.npy'), categories=column['categories'])
+        elif column['kind'] == 'datetime':
+            data[column['name']] = pd.DatetimeIndex(_load(path + '.npy').view(f"datetime64[{column['unit']}]"), copy=False).tz_localize(column['tz'])
+        elif column['kind'] == 'numeric':
+            data[column['name']] = _load(path + '.npy')
+        else:
+            data[column['name']] = pd.Series(_read_strings(path, column['nullable']), dtype=column['dtype'])
+    return pd.DataFrame(data, copy=False)
+
+def write_snapshot(directory, data_frame, polylines, curves, rollups, geometry, route_index, fingerprint):
+    """
+    Writes an immutable snapshot of a dataset as a new version, then points CURRENT at it
+
+    The version is written into a temporary directory and renamed into place, and CURRENT is
+    replaced atomically, so readers only ever see a complete version.
+
+    Parameters:
+        directory: string
+        data_frame: DataFrame of activities
+        polylines: PolylineStore, aligned with the DataFrame rows
+        curves: dict of curve kind -> CurveMatrix, rows only for activities with a curve
+        rollups: DataFrame of rollup rows
+        geometry: GeometryCache, track bounds, indexed in a packed grid, and simplified lines are exported for the activities
+        route_index: RouteIndex, exported so processes loading the snapshot do not match routes again
+        fingerprint: string, heatmap.tracks_fingerprint of the tracks
+
+    Returns:
+        version: string
+    """
+    os.makedirs(directory, exist_ok=True)
+    now = time.time()
+    version = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}.{int(now % 1 * 1e6):06d}-{secrets.token_hex(4)}" # sorts in write order, even within a second
+    staging = os.path.join(directory, f'.{version}.tmp')
+    os.makedirs(staging)
+
+    activity_ids = data_frame['id'].to_numpy()
+    boxes, lines = geometry.export(activity_ids)
+    grid = pack_grid(boxes)
+    route_arrays, route_sport_types = route_index.export()
+    manifest = {
+        'format': SNAPSHOT_FORMAT,
+        'created_at': time.time(),
+        'rows': len(data_frame),
+        'activities': _write_frame(staging, 'activities', data_frame),
+        'rollups': _write_frame(staging, 'rollups', rollups),
+        'curves': sorted(curves),
+        'grid': sorted(grid),
+        'routes': sorted(route_arrays),
+        'fingerprint': fingerprint
+    }
+    _write_strings(os.path.join(staging, 'polylines'), list(polylines))
+    for kind, matrix in curves.items():
+        _save(os.path.join(staging, f'curves.{kind}.positions.npy'), matrix.positions)
+        _save(os.path.join(staging, f'curves.{kind}.values.npy'), matrix.values)
+    _save(os.path.join(staging, 'boxes.npy'), boxes)
+    for name, array in grid.items():
+        _save(os.path.join(staging, f'grid.{name}.npy'), array)
+    for name, array in route_arrays.items():
+        _save(os.path.join(staging, f'routes.{name}.npy'), array)
+    _write_strings(os.path.join(staging, 'routes.sport_types'), route_sport_types)
+    manifest['lines'] = [[level, _write_strings(os.path.join(staging, f'lines.{level}'), level_lines)] for level, level_lines in sorted(lines.items())]
+    with open(os.path.join(staging, MANIFEST_FILENAME), 'w') as file:
+        json.dump(manifest, file)
+    os.rename(staging, os.path.join(directory, version))
+
+    pointer = os.path.join(directory, f'.{POINTER_FILENAME}.{version}.tmp')
+    with open(pointer, 'w') as file:
+        file.write(version)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(pointer, os.path.join(directory, POINTER_FILENAME))
+    _remove_old_versions(directory, version)
+    return version
+
+def _remove_old_versions(directory, current):
+    versions = sorted(name for name in os.listdir(directory) if not name.startswith('.') and name != POINTER_FILENAME and name != current)
+    for name in versions[:max(0, len(versions) - (KEEP_VERSIONS - 1))]:
+        shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+def load_snapshot(directory, version=None):
+    """
+    Maps a snapshot read-only
+
+    A version can be deleted by a newer writer while it is being loaded, since only KEEP_VERSIONS
+    are kept, in which case the version CURRENT points at is loaded instead.
+
+    Parameters:
+        directory: string
+        version: string, or None for the version CURRENT points at
+
+    Returns:
+        snapshot: Snapshot, or None if there is none or it was written in another format
+    """
+    for _ in range(LOAD_ATTEMPTS):
+        version = version or current_version(directory)
+        if version is None:
+            return None
+        try:
+            return _load_version(directory, version)
+        except FileNotFoundError: # removed by a newer writer since CURRENT was read
+            version = None
+    return None
+
+def _load_version(directory, version):
+    path = os.path.join(directory, version)
+    with open(os.path.join(path, MANIFEST_FILENAME)) as file:
+        manifest = json.load(file)
+    if manifest.get('format') != SNAPSHOT_FORMAT:
+        return None
+    return Snapshot(
+        version,
+        _read_frame(path, 'activities', manifest['activities']),
+        _read_polylines(os.path.join(path, 'polylines')),
+        {kind: CurveMatrix(_load(os.path.join(path, f'curves.{kind}.positions.npy')), _load(os.path.join(path, f'curves.{kind}.values.npy')))
+         for kind in manifest['curves']},
+        _read_frame(path, 'rollups', manifest['rollups']),
+        _load(os.path.join(path, 'boxes.npy')),
+        {level: _read_polylines(os.path.join(path, f'lines.{level}')) for level, _ in manifest['lines']},
+        {name: _load(os.path.join(path, f'grid.{name}.npy')) for name in manifest['grid']},
+        {name: _load(os.path.join(path, f'routes.{name}.npy')) for name in manifest['routes']},
+        _read_strings(os.path.join(path, 'routes.sport_types'), False),
+        manifest['fingerprint'])
@@ -0,0 +1,265 @@
+import math
+import threading
+import numpy as np
+
+GRID_CELL_SIZE = 0.05 # degrees
+_CELL_KEY_OFFSET = 1 << 30 # packed cell keys hold rows and columns of any cell size down to about 1e-6 degrees
+_CELL_KEY_SPAN = 1 << 31
+
+class GridIndex:
+    """
+    Uniform grid spatial index over bounding boxes, updated incrementally as items change
+
+    Boxes use the same (south, west, north, east) order as the bounds passed to /segments/explore.
+    Boxes spanning more than max_cells grid cells are kept in a short list that every query checks.
+
+    Parameters:
+        cell_size: double, degrees
+        max_cells: int
+    """
+    def __init__(self, cell_size=GRID_CELL_SIZE, max_cells=400):
+        self.cell_size = cell_size
+        self.max_cells = max_cells
+        self._cells = {} # (row, column) -> set of ids
+        self._boxes = {} # id -> box
+        self._oversized = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._boxes)
+
+    def __contains__(self, id):
+        return id in self._boxes
+
+    def _cell_range(self, box):
+        south, west, north, east = box
+        rows = range(math.floor(south / self.cell_size), math.floor(north / self.cell_size) + 1)
+        columns = range(math.floor(west / self.cell_size), math.floor(east / self.cell_size) + 1)
+        return rows, columns
+
+    def insert(self, id, box):
+        """
+        Adds an item, replacing its previous box if it was already indexed
+
+        Parameters:
+            id: hashable
+            box: tuple of (south, west, north, east)
+
+        Returns:
+            none
+        """
+        with self._lock:
+            self._remove(id)
+            box = tuple(float(value) for value in box)
+            self._boxes[id] = box
+            rows, columns = self._cell_range(box)
+            if len(rows) * len(columns) > self.max_cells:
+                self._oversized.add(id)
+                return
+            for row in rows:
+                for column in columns:
+                    self._cells.setdefault((row, column), set()).add(id)
+
+    def remove(self, id):
+        """
+        Removes an item if it is indexed
+
+        Parameters:
+            id: hashable
+
+        Returns:
+            none
+        """
+        with self._lock:
+            self._remove(id)
+
+    def _remove(self, id):
+        box = self._boxes.pop(id, None)
+        if box is None:
+            return
+        if id in self._oversized:
+            self._oversized.discard(id)
+            return
+        rows, columns = self._cell_range(box)
+        for row in rows:
+            for column in columns:
+                cell = self._cells.get((row, column))
+                if cell is not None:
+                    cell.discard(id)
+                    if not cell:
+                        del self._cells[(row, column)]
+
+    def query(self, box):
+        """
+        Finds every item whose box intersects the query box
+
+        Parameters:
+            box: tuple or list of (south, west, north, east), west greater than east if it crosses the antimeridian
+
+        Returns:
+            ids: set
+        """
+        parts = split_antimeridian(tuple(float(value) for value in box))
+        if len(parts) > 1:
+            return set().union(*(self.query(part) for part in parts))
+        south, west, north, east = parts[0]
+        rows, columns = self._cell_range((south, west, north, east))
+        with self._lock:
+            if len(rows) * len(columns) > len(self._cells): # large query, cheaper to scan occupied cells
+                candidates = set().union(*(ids for (row, column), ids in self._cells.items() if row in rows and column in columns))
+            else:
+                candidates = set()
+                for row in rows:
+                    for column in columns:
+                        candidates.update(self._cells.get((row, column), ()))
+            candidates.update(self._oversized)
+            return {id for id in candidates if _intersects(self._boxes[id], (south, west, north, east))}
+
+class PackedGridIndex:
+    """
+    Read-only GridIndex over an array of boxes, packed by pack_grid into sorted arrays, so it can be
+    written to a snapshot and queried from its memory maps without building any sets
+
+    Parameters:
+        arrays: dict from pack_grid
+        boxes: ndarray of shape (n, 4), the boxes the grid was packed from, nan for items without one
+    """
+    def __init__(self, arrays, boxes):
+        self.cell_size = float(arrays['cell_size'][0])
+        self.cell_keys = arrays['cell_keys']
+        self.cell_offsets = arrays['cell_offsets']
+        self.positions = arrays['positions']
+        self.oversized = arrays['oversized']
+        self.boxes = boxes
+
+    def query(self, box):
+        """
+        Finds every item whose box intersects the query box
+
+        Parameters:
+            box: tuple or list of (south, west, north, east), west greater than east if it crosses the antimeridian
+
+        Returns:
+            positions: ndarray of int, rows of the boxes array
+        """
+        parts = split_antimeridian(tuple(float(value) for value in box))
+        if len(parts) > 1:
+            return np.union1d(*(self.query(part) for part in parts))
+        south, west, north, east = parts[0]
+        first_row, last_row = math.floor(south / self.cell_size), math.floor(north / self.cell_size)
+        first_column, last_column = math.floor(west / self.cell_size), math.floor(east / self.cell_size)
+        if (last_row - first_row + 1) * (last_column - first_column + 1) > len(self.cell_keys): # large query, cheaper to scan occupied cells
+            rows, columns = _cell_rows_columns(self.cell_keys)
+            cells = np.flatnonzero((first_row <= rows) & (rows <= last_row) & (first_column <= columns) & (columns <= last_column))
+        else:
+            keys = _cell_keys(*np.meshgrid(np.arange(first_row, last_row + 1), np.arange(first_column, last_column + 1), indexing='ij')).ravel()
+            cells = np.minimum(np.searchsorted(self.cell_keys, keys), max(len(self.cell_keys) - 1, 0))
+            cells = cells[self.cell_keys[cells] == keys] if len(self.cell_keys) > 0 else cells[:0]
+        candidates = np.unique(np.concatenate([self.positions[start:end] for start, end in zip(self.cell_offsets[cells].tolist(), self.cell_offsets[cells + 1].tolist())]
+                                              + [self.oversized]).astype(np.int64))
+        boxes = self.boxes[candidates]
+        return candidates[(boxes[:, 0] <= north) & (south <= boxes[:, 2]) & (boxes[:, 1] <= east) & (west <= boxes[:, 3])]
+
+def _cell_keys(rows, columns):
+    # one sortable int64 per (row, column), rows and columns offset so both are non-negative
+    return (rows.astype(np.int64) + _CELL_KEY_OFFSET) * _CELL_KEY_SPAN + (columns.astype(np.int64) + _CELL_KEY_OFFSET)
+
+def _cell_rows_columns(keys):
+    return keys // _CELL_KEY_SPAN - _CELL_KEY_OFFSET, keys % _CELL_KEY_SPAN - _CELL_KEY_OFFSET
+
+def pack_grid(boxes, cell_size=GRID_CELL_SIZE, max_cells=400):
+    """
+    Packs a grid over an array of boxes into sorted arrays for PackedGridIndex: the key of every
+    occupied cell, and the rows of the boxes in each cell, with oversized boxes listed separately
+    as GridIndex does
+
+    Parameters:
+        boxes: ndarray of shape (n, 4), (south, west, north, east), nan for items without a box
+        cell_size: double, degrees
+        max_cells: int
+
+    Returns:
+        arrays: dict of name -> ndarray
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    valid = np.flatnonzero(~np.isnan(boxes[:, 0]))
+    first_rows, first_columns = np.floor(boxes[valid, 0] / cell_size).astype(np.int64), np.floor(boxes[valid, 1] / cell_size).astype(np.int64)
+    heights = np.floor(boxes[valid, 2] / cell_size).astype(np.int64) - first_rows + 1
+    widths = np.floor(boxes[valid, 3] / cell_size).astype(np.int64) - first_columns + 1
+    counts = heights * widths
+    packed = counts <= max_cells
+    oversized = valid[~packed]
+    valid, first_rows, first_columns, widths, counts = valid[packed], first_rows[packed], first_columns[packed], widths[packed], counts[packed]
+
+    # one entry per (box, cell) it covers
+    owners = np.repeat(np.arange(len(valid)), counts)
+    cell_numbers = np.arange(len(owners)) - np.repeat(np.cumsum(counts) - counts, counts)
+    keys = _cell_keys(first_rows[owners] + cell_numbers // widths[owners], first_columns[owners] + cell_numbers % widths[owners])
+    order = np.argsort(keys, kind='stable')
+    cell_keys, starts = np.unique(keys[order], return_index=True)
+    return {
+        'cell_size': np.array([cell_size]),
+        'cell_keys': cell_keys,
+        'cell_offsets': np.append(starts, len(order)).astype(np.int64),
+        'positions': valid[owners[order]].astype(np.int32),
+        'oversized': oversized.astype(np.int32)
+    }
+
+def _intersects(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+def split_antimeridian(box):
+    """
+    Splits a box crossing the antimeridian into the parts on either side of it
+
+    Parameters:
+        box: tuple of (south, west, north, east), west greater than east if it crosses the antimeridian
+
+    Returns:
+        boxes: list of tuple, one or two boxes with west no greater than east
+    """
+    south, west, north, east = box
+    if west <= east:
+        return [box]
+    return [(south, west, north, 180.0), (south, -180.0, north, east)]
+
+def snap_bounds(box, cell_size=GRID_CELL_SIZE):
+    """
+    Grows a box outwards to grid cell edges, so nearby views share a box, e.g. in a cache key
+
+    Parameters:
+        box: tuple of (south, west, north, east)
+        cell_size: double, degrees
+
+    Returns:
+        box: tuple of double
+    """
+    south, west, north, east = box
+    def edge(value, round_to):
+        return round(round_to(value / cell_size) * cell_size, 9) # without float error, so equal edges make equal keys
+    return (max(-90.0, edge(south, math.floor)), max(-180.0, edge(west, math.floor)), min(90.0, edge(north, math.ceil)), min(180.0, edge(east, math.ceil)))
+
+def parse_bounds(value):
+    """
+    Parses a 'south,west,north,east' query string value
+
+    Parameters:
+        value: string, west greater than east if the area crosses the antimeridian
+
+    Returns:
+        box: tuple of double, or None if the value is missing
+
+    Raises:
+        ValueError: if the value is malformed, not finite or outside the range of latitudes and longitudes
+    """
+    if not value:
+        return None
+    box = tuple(float(coord) for coord in value.split(','))
+    if len(box) != 4:
+        raise ValueError('bbox needs 4 values, south,west,north,east')
+    south, west, north, east = box
+    if not all(math.isfinite(coord) for coord in box):
+        raise ValueError('bbox values must be finite')
+    if not (-90 <= south <= north <= 90) or not (-180 <= west <= 180 and -180 <= east <= 180):
+        raise ValueError('bbox latitudes must be within -90 to 90 with south below north, longitudes within -180 to 180')
+    return box
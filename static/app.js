@@ -1,58 +1,166 @@
-// getting activity data from python script app.py
-fetch('/api/all_activities')
-  .then(response => response.json())
-  .then(data => map(data))
-  .catch(error => {
-    console.error('Error fetching data:', error);
-  });
+// initializing leaflet map, activity lines in view are drawn into a layer that is refilled when the map moves
+var activityMap = L.map('map').setView([51.044922, -114.073746], 10);
+L.tileLayer('https://tile.openstreetmap.org/{z}/{x}/{y}.png', {
+    maxZoom: 19,
+    attribution: '© OpenStreetMap'
+}).addTo(activityMap);
+var activityLayer = L.layerGroup().addTo(activityMap);
+var heatmapLayer = L.tileLayer('/tiles/heatmap/{z}/{x}/{y}.png', {
+    maxNativeZoom: 16,
+    maxZoom: 19,
+    opacity: 0.9
+});
+L.control.layers(null, {'Activities': activityLayer, 'Heatmap': heatmapLayer}).addTo(activityMap);
+var loadedLevel = null;
+var loadedBounds = null;
+var geometryLevels = null;
+var latestRequest = 0;
+var latestStatsRequest = 0;
+var dateQuery = null; // set once a range is picked on the page, until then map requests use the range the page was rendered with
+
+// latitudes clamped and longitudes wrapped into range, west is greater than east when the view crosses the antimeridian
+function bboxQuery(bounds){
+  var west = -180;
+  var east = 180;
+  if(bounds.getEast() - bounds.getWest() < 360){
+    west = L.Util.wrapNum(bounds.getWest(), [-180, 180], true);
+    east = L.Util.wrapNum(bounds.getEast(), [-180, 180], true);
+  }
+  return [Math.max(-90, bounds.getSouth()), west, Math.min(90, bounds.getNorth()), east].join(',');
+}
+
+// getting simplified activity lines for the current zoom and viewport from python script main.py
+function loadActivities(){
+  var request = ++latestRequest;
+  var bounds = activityMap.getBounds().pad(0.5); // load a margin around the view so small pans need no request
+  var bbox = bboxQuery(bounds);
+  var url = '/api/map_geometry?zoom=' + activityMap.getZoom() + '&bbox=' + bbox;
+  if(dateQuery != null){
+    url += '&' + dateQuery;
+  }
+  fetch(url)
+    .then(response => response.json())
+    .then(data => {
+      if(request != latestRequest){ // a newer request was made while this one was in flight
+        return;
+      }
+      loadedLevel = data.level;
+      loadedBounds = bounds;
+      geometryLevels = data.levels;
+      map(data.activities);
+    })
+    .catch(error => {
+      console.error('Error fetching data:', error);
+    });
+}
 
-// initializing populating map by leaflet
+// matches zoom_level in geometry.py
+function zoomLevel(zoom){
+  var levels = geometryLevels.filter(level => level <= zoom);
+  return levels.length > 0 ? levels[levels.length - 1] : geometryLevels[0];
+}
+
+function lineColor(type){
+  if(type == 'Ride'){
+    return '#00b159'
+  } else if(type == 'Run') {
+    return '#d11141'
+  } else if(type == 'AlpineSki'){
+    return '#00aedb'
+  } else if(type == 'NordicSki') {
+    return '#00aedb'
+  } else if(type == 'Hike') {
+    return '#f37735'
+  }
+  return '#ffc425'
+}
+
+// populating map with activity lines
 function map(data){
-    var map = L.map('map').setView([51.044922, -114.073746], 10);
-    L.tileLayer('https://tile.openstreetmap.org/{z}/{x}/{y}.png', {
-        maxZoom: 19,
-        attribution: '© OpenStreetMap'
-    }).addTo(map);
+    activityLayer.clearLayers();
 
     for(var x = 0; x < data.length; x++){
-      var coordinates = L.Polyline.fromEncoded(data[x].map.summary_polyline).getLatLngs()
-      var line_color
-      var name = data[x].name
-      var type = data[x].type
-      var dist = data[x].distance / 1000
-      var speed = data[x].average_speed * 3.6
-      var elevation = data[x].total_elevation_gain
-
-      if(type == 'Ride'){
-        line_color = '#00b159'
-      } else if(type == 'Run') {
-        line_color = '#d11141'
-      } else if(type == 'AlpineSki'){
-        line_color = '#00aedb'
-      } else if(type == 'NordicSki') {
-        line_color = '#00aedb'
-      } else if(type == 'Hike') {
-        line_color = '#f37735'
-      } else {
-        line_color = '#ffc425'
-      }
-     
+      var coordinates = L.Polyline.fromEncoded(data[x].line).getLatLngs()
       var activity = L.polyline(
         coordinates,
         {
-          color: line_color,
+          color: lineColor(data[x].type),
           weight: 3,
           opacity: 1,
           lineJoin: 'round'
         }
-      ).addTo(map)
-
-      activity.bindPopup(name + "<br>" + type + "<br>" + (Math.round(dist * 100)/100) + " km <br>" + (Math.round(speed * 100)/100) + " km/h <br>"
-        + elevation + " m");
+      ).addTo(activityLayer)
 
+      activity.bindPopup(data[x].name + "<br>" + data[x].type + "<br>" + data[x].distance + " km <br>" + data[x].speed + " km/h <br>"
+        + data[x].elevation + " m");
     }
 }
 
+activityMap.on('moveend', function(){
+  if(geometryLevels == null || !activityMap.hasLayer(activityLayer)){
+    return;
+  }
+  if(zoomLevel(activityMap.getZoom()) != loadedLevel || !loadedBounds.contains(activityMap.getBounds())){
+    loadActivities();
+  }
+});
+
+activityMap.on('overlayadd', function(event){
+  if(event.layer === activityLayer){
+    loadActivities();
+  }
+});
+
+loadActivities();
+
+// reading a stat such as 'sports.ride.total_count' out of the /api/stats document
+function statValue(data, path){
+  return path.split('.').reduce((value, key) => value == null ? value : value[key], data);
+}
+
+// getting the stats for the picked date range from main.py and updating the cards and map in place
+function loadStats(query){
+  var request = ++latestStatsRequest;
+  dateQuery = query;
+  fetch('/api/stats?' + query)
+    .then(response => response.json())
+    .then(data => {
+      if(request != latestStatsRequest){
+        return;
+      }
+      document.querySelectorAll('[data-stat]').forEach(element => {
+        element.textContent = statValue(data, element.dataset.stat);
+      });
+      document.querySelectorAll('[data-stat-html]').forEach(element => {
+        element.innerHTML = statValue(data, element.dataset.statHtml);
+      });
+      document.querySelectorAll('[data-curve]').forEach(element => {
+        element.replaceChildren(...data.curves[element.dataset.curve].map(([label, value]) => {
+          var line = document.createElement('p');
+          line.textContent = label + ': ' + value;
+          return line;
+        }));
+      });
+      history.replaceState(null, '', '/?' + query);
+    })
+    .catch(error => {
+      console.error('Error fetching stats:', error);
+    });
+  if(activityMap.hasLayer(activityLayer)){
+    loadActivities();
+  }
+}
+
+// the form still reloads the page without javascript
+var dateForm = document.getElementById('date-range-form');
+dateForm.addEventListener('submit', function(event){
+  event.preventDefault();
+  loadStats(new URLSearchParams(new FormData(dateForm)).toString());
+});
+$('#reportrange').on('apply.daterangepicker', function(){
+  dateForm.requestSubmit();
+});
+
 // accordian JS
 var acc = document.getElementsByClassName("accordion");
 var i;
@@ -0,0 +1,316 @@
+import math
+import numpy as np
+import pytz
+from curves import merge_curves
+from rollups import range_totals
+from metrics import timed_stage
+
+# dashboard cards: key -> (type, sport_type, commute)
+SPORT_CARDS = {
+    'ride': ('Ride', 'Ride', False),
+    'commute': ('Ride', 'Ride', True),
+    'mtb': ('Ride', 'MountainBikeRide', False),
+    'virtual_ride': ('VirtualRide', 'VirtualRide', False),
+    'outdoor_run': ('Run', 'Run', False),
+    'virtual_run': ('VirtualRun', 'VirtualRun', False),
+    'hike': ('Hike', 'Hike', False),
+    'swim': ('Swim', 'Swim', False),
+    'alpine_ski': ('AlpineSki', 'AlpineSki', False),
+    'nordic_ski': ('NordicSki', 'NordicSki', False)
+}
+
+STANDARD_SPORT_TYPES = ['Ride', 'MountainBikeRide', 'VirtualRide', 'Run', 'VirtualRun', 'Hike', 'Swim', 'AlpineSki', 'NordicSki']
+
+NO_ELEVATION_TYPES = ['AlpineSki', 'VirtualRide'] # descending or virtual climbing is not counted as elevation gained
+
+def format_speed(avg_speed):
+    """
+    Formats speed in min/distance from decimal to min:sec form
+
+    Parameters:
+        avg_speed: double
+
+    Returns:
+        avg_speed_formatted: string
+    """
+    integer_part = int(avg_speed)
+    decimal_part = avg_speed - integer_part
+    seconds = int(decimal_part * 60)
+    avg_speed_formatted = f"{integer_part}:{seconds}"
+    return avg_speed_formatted
+
+def aggregate_sport_metrics(filtered_activities):
+    """
+    Computes every per sport card reduction in one grouped pass
+
+    Parameters:
+        filtered_activities: DataFrame
+
+    Returns:
+        sport_metrics: DataFrame indexed by (sport_type, commute)
+    """
+    # float32 columns are summed in float64, matching the totals kept in rollups
+    summed = filtered_activities.assign(distance_sum=filtered_activities['distance'].astype(np.float64),
+                                        elevation_sum=filtered_activities['total_elevation_gain'].astype(np.float64))
+    return summed.groupby(['sport_type', 'commute'], observed=True).agg(
+        total_count=('distance', 'size'),
+        total_distance=('distance_sum', 'sum'),
+        total_elevation=('elevation_sum', 'sum'),
+        max_speed=('max_speed', 'max'),
+        avg_speed=('average_speed', 'mean'),
+        avg_power=('average_watts', 'mean'),
+        avg_distance=('distance', 'mean'),
+        avg_elevation=('total_elevation_gain', 'mean'),
+        avg_hr=('average_heartrate', 'mean')
+    )
+
+def format_sport_stats(type, sport_metrics):
+    """
+    Converts raw aggregates for one card into the values displayed for its activity type
+
+    Parameters:
+        type: string
+        sport_metrics: Series or dict of raw aggregates, or None if there are no activities
+
+    Returns:
+        stats: dict, ordered as displayed
+    """
+    def value(name):
+        return np.nan_to_num(sport_metrics[name]) if sport_metrics is not None else 0.0 # converting any nan values to 0
+
+    total_count = int(value('total_count'))
+    total_distance = value('total_distance') / 1000 # conversion to km
+    total_elevation = value('total_elevation')
+    max_speed_kmh = value('max_speed') * 3.6 # conversion to km/h
+    avg_speed_kmh = value('avg_speed') * 3.6 # conversion to km/h
+    avg_speed_minkm = np.nan_to_num((1 / 0.06) / value('avg_speed')) if value('avg_speed') else 0.0 # conversion to min/km
+    avg_speed_min100m = np.nan_to_num((1 / 0.6) / value('avg_speed')) if value('avg_speed') else 0.0 # conversion to min/100m
+    avg_power = value('avg_power')
+    avg_distance = value('avg_distance') / 1000 # conversion to km
+    avg_elevation = value('avg_elevation')
+    avg_hr = value('avg_hr')
+
+    if (type == 'Ride') or (type == 'VirtualRide'):
+        fields = ['total_count', 'total_distance', 'total_elevation', 'max_speed', 'avg_speed', 'avg_power', 'avg_distance', 'avg_elevation', 'avg_hr']
+        avg_speed = round(float(avg_speed_kmh), 1)
+    elif (type == 'Run') or (type == 'VirtualRun'):
+        fields = ['total_count', 'total_distance', 'total_elevation', 'avg_speed', 'avg_power', 'avg_distance', 'avg_elevation', 'avg_hr']
+        avg_speed = format_speed(avg_speed_minkm)
+    elif type == 'Hike':
+        fields = ['total_count', 'total_distance', 'total_elevation', 'avg_speed', 'avg_distance', 'avg_elevation', 'avg_hr']
+        avg_speed = format_speed(avg_speed_minkm)
+    elif type == 'Swim':
+        fields = ['total_count', 'total_distance', 'avg_speed', 'avg_distance', 'avg_hr']
+        avg_speed = format_speed(avg_speed_min100m)
+    elif (type == 'AlpineSki') or (type == 'NordicSki'):
+        fields = ['total_count', 'total_distance', 'total_elevation', 'max_speed', 'avg_speed', 'avg_distance', 'avg_elevation', 'avg_hr']
+        avg_speed = round(float(avg_speed_kmh), 1)
+    else:
+        return None
+
+    values = {
+        'total_count': total_count,
+        'total_distance': round(float(total_distance), 1),
+        'total_elevation': round(float(total_elevation), 1),
+        'max_speed': round(float(max_speed_kmh), 1),
+        'avg_speed': avg_speed,
+        'avg_power': round(float(avg_power), 1),
+        'avg_distance': round(float(avg_distance), 1),
+        'avg_elevation': round(float(avg_elevation), 1),
+        'avg_hr': round(float(avg_hr), 1)
+    }
+    return {field: values[field] for field in fields}
+
+@timed_stage('calculate_lifetime_totals')
+def calculate_lifetime_totals(filtered_activities):
+    """
+    Calculates basic cumulative stats from already date-filtered activities
+
+    Parameters:
+        filtered_activities: DataFrame
+
+    Returns:
+        lifetime: dict
+    """
+    kudos_received = int(filtered_activities['kudos_count'].sum())
+    if 'heart_beats' in filtered_activities:
+        heart_beats = filtered_activities['heart_beats'].sum()
+    else:
+        heart_beats = (filtered_activities['average_heartrate'].astype(np.float64) * filtered_activities['moving_time']).sum()
+    # float32 columns are summed in float64, like the rollups, so both paths show the same totals
+    distance_travelled = filtered_activities['distance'].astype(np.float64).sum() / 1000
+    counts_elevation = filtered_activities['type'].isin(NO_ELEVATION_TYPES) == False
+    elevation_gained = filtered_activities['total_elevation_gain'].astype(np.float64).where(counts_elevation).sum()
+    return format_lifetime_totals(kudos_received, heart_beats, distance_travelled, elevation_gained)
+
+@timed_stage('calculate_rollup_lifetime_totals')
+def calculate_rollup_lifetime_totals(totals):
+    """
+    Calculates basic cumulative stats from rollup totals
+
+    Parameters:
+        totals: DataFrame with a row per (sport_type, commute), from rollups.range_totals
+
+    Returns:
+        lifetime: dict
+    """
+    kudos_received = int(totals['kudos'].sum())
+    heart_beats = totals['heart_beats'].sum()
+    distance_travelled = totals['distance'].sum() / 1000
+    elevation_gained = totals['elevation'][totals['sport_type'].isin(NO_ELEVATION_TYPES) == False].sum()
+    return format_lifetime_totals(kudos_received, heart_beats, distance_travelled, elevation_gained)
+
+def format_lifetime_totals(kudos_received, heart_beats, distance_travelled, elevation_gained):
+    """
+    Converts lifetime sums into the values displayed on the dashboard
+
+    Parameters:
+        kudos_received: int
+        heart_beats: double
+        distance_travelled: double, km
+        elevation_gained: double, m
+
+    Returns:
+        lifetime: dict
+    """
+    times_around_earth = distance_travelled / 40075 # circumference of earth
+    blood_pumped = heart_beats * 0.07 # average volume of blood pumped per beat
+    times_up_everest = elevation_gained / 8848 # height of Mt Everest
+
+    return {
+        'kudos_received': kudos_received,
+        'heart_beats': '{:,}'.format(round(heart_beats)),
+        'distance_travelled': '{:,}'.format(round(distance_travelled)),
+        'elevation_gained': '{:,}'.format(round(elevation_gained)),
+        'blood_pumped': '{:,}'.format(round(blood_pumped)),
+        'times_around_earth': round(float(times_around_earth), 2),
+        'times_up_everest': round(float(times_up_everest), 1)
+    }
+
+@timed_stage('calculate_recent_activity_stats')
+def calculate_recent_activity_stats(data_frame):
+    """
+    Calculates basic stats from most recent activity
+
+    Parameters:
+        data_frame: DataFrame sorted by start_epoch
+
+    Returns:
+        recent: dict, with placeholder values if there are no activities yet
+    """
+    if len(data_frame) == 0:
+        return {'date': 'No activities yet', 'name': '-', 'type': '-', 'distance': 0.0}
+    most_recent = data_frame.iloc[-1]
+    date_formatted = most_recent['start_date_formatted']
+    mt_timezone = pytz.timezone('US/Mountain')
+    date_mt = date_formatted.astimezone(mt_timezone)
+    date_formatted = date_mt.strftime("%B %d, %Y at %I:%M%p")
+
+    return {
+        'date': date_formatted,
+        'name': most_recent['name'],
+        'type': most_recent['type'],
+        'distance': round(float(most_recent['distance']) / 1000, 1)
+    }
+
+def count_other_sport_types(data_frame):
+    """
+    Prints string of other activites not inlcuded in the sport cards
+
+    Parameters:
+        data_frame: DataFrame
+
+    Returns:
+        formatted_other_sport_types: string
+    """
+    filtered_activities = data_frame[(data_frame['sport_type'].isin(STANDARD_SPORT_TYPES) == False)]
+    sport_type_counts = filtered_activities['sport_type'].value_counts()
+    sport_type_counts = sport_type_counts[sport_type_counts > 0].to_dict() # categorical counts include unused sport types
+    formatted_other_sport_types = '<br><br>'.join([f"{key}: {value}" for key, value in sport_type_counts.items()])
+    return formatted_other_sport_types
+
+def date_range_positions(data_frame, start_date, end_date):
+    """
+    Binary searches the start_epoch column for the rows that started within the date range, inclusive
+
+    Parameters:
+        data_frame: DataFrame sorted by start_epoch
+        start_date: Timestamp
+        end_date: Timestamp
+
+    Returns:
+        first: int
+        last: int, one past the last row in range
+    """
+    epochs = data_frame['start_epoch'].to_numpy()
+    first = np.searchsorted(epochs, math.ceil(start_date.timestamp()), side='left')
+    last = np.searchsorted(epochs, math.floor(end_date.timestamp()), side='right')
+    return int(first), int(max(first, last))
+
+def filter_date_range(data_frame, start_date, end_date):
+    """
+    Selects activities that started within the date range, inclusive
+
+    Parameters:
+        data_frame: DataFrame sorted by start_epoch
+        start_date: Timestamp
+        end_date: Timestamp
+
+    Returns:
+        filtered_activities: DataFrame
+    """
+    first, last = date_range_positions(data_frame, start_date, end_date)
+    return data_frame.iloc[first:last]
+
+@timed_stage('calculate_dashboard_stats')
+def calculate_dashboard_stats(data_frame, start_date, end_date, rollups=None):
+    """
+    Calculates every stat on the dashboard, filtering by date once and grouping by
+    (sport_type, commute) once
+
+    Parameters:
+        data_frame: DataFrame
+        start_date: Timestamp
+        end_date: Timestamp
+        rollups: RollupTable, lifetime totals are summed from it when given
+
+    Returns:
+        stats: dict with lifetime, recent, sports and other_sport_types
+    """
+    filtered_activities = filter_date_range(data_frame, start_date, end_date)
+    sport_metrics = aggregate_sport_metrics(filtered_activities)
+
+    sports = {}
+    for key, (type, sport_type, commute) in SPORT_CARDS.items():
+        group = sport_metrics.loc[(sport_type, commute)] if (sport_type, commute) in sport_metrics.index else None
+        sports[key] = format_sport_stats(type, group)
+
+    return {
+        'lifetime': calculate_lifetime_totals(filtered_activities) if rollups is None else
+            calculate_rollup_lifetime_totals(range_totals(rollups, data_frame, start_date, end_date)),
+        'recent': calculate_recent_activity_stats(data_frame),
+        'sports': sports,
+        'other_sport_types': count_other_sport_types(data_frame)
+    }
+
+@timed_stage('calculate_curve_stats')
+def calculate_curve_stats(data_frame, curve_matrices, start_date, end_date):
+    """
+    Merges the cached best effort curves of every activity within the date range
+
+    Parameters:
+        data_frame: DataFrame sorted by start_epoch
+        curve_matrices: dict of curve kind -> CurveMatrix, positions are data_frame rows
+        start_date: Timestamp
+        end_date: Timestamp
+
+    Returns:
+        curves: dict of curve kind -> (best values, activity ids)
+    """
+    first, last = date_range_positions(data_frame, start_date, end_date)
+    activity_ids = data_frame['id'].to_numpy()
+    merged = {}
+    for kind, matrix in curve_matrices.items():
+        positions, values = matrix.rows(first, last)
+        merged[kind] = merge_curves(values, activity_ids[positions])
+    return merged
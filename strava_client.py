@@ -0,0 +1,253 @@
+import os
+import random
+import threading
+import time
+from urllib.parse import urlencode, urlparse
+import requests
+from requests.adapters import HTTPAdapter
+import metrics
+
+STRAVA_BASE_URL = os.environ.get('STRAVA_BASE_URL', 'https://www.strava.com')
+
+HIGH_PRIORITY = 'high' # activity list and tokens, needed for the dashboard to work at all
+LOW_PRIORITY = 'low' # media, segment detail and other extras that can wait for the next sync
+
+class RateLimitExceeded(Exception):
+    """
+    Raised when a request cannot be made without exceeding the Strava rate limit
+
+    Parameters:
+        message: string
+        retry_after: double, seconds until the request can be made again, or None if unknown
+    """
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class RateLimitDeferred(RateLimitExceeded):
+    """Raised when work is skipped to save the remaining rate limit budget, instead of waiting for it to reset"""
+
+class StravaClient:
+    """
+    Shared HTTP client for the Strava API
+
+    Reuses pooled keep-alive connections, applies timeouts, retries connection errors, 429s and
+    5xx responses with jittered exponential backoff, and tracks the 15 minute and daily rate limit
+    budget reported in the X-RateLimit-Limit and X-RateLimit-Usage headers.
+
+    Parameters:
+        base_url: string
+        pool_size: int
+        timeout: tuple of (connect, read) seconds
+        max_retries: int
+        backoff_base: double, seconds
+        backoff_max: double, seconds
+        low_priority_reserve: double, fraction of each budget kept for high priority requests
+    """
+    def __init__(self, base_url=STRAVA_BASE_URL, pool_size=16, timeout=(5, 30), max_retries=5, backoff_base=1.0, backoff_max=60.0, low_priority_reserve=0.2):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.low_priority_reserve = low_priority_reserve
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._lock = threading.Lock()
+        self.limits = None # (15 minute, daily)
+        self.usage = None # (15 minute, daily)
+        self._usage_window = None # (15 minute window, day) the usage was reported in
+
+    def get(self, path, access_token, params=None, priority=HIGH_PRIORITY, wait=False):
+        """
+        Get request to a Strava API v3 endpoint
+
+        Parameters:
+            path: string, e.g. '/athlete/activities'
+            access_token: string
+            params: dict
+            priority: HIGH_PRIORITY or LOW_PRIORITY
+            wait: boolean, wait for the 15 minute window to reset when the rate limit is reached instead
+                of raising RateLimitDeferred, only for background syncs since it can take 15 minutes
+
+        Returns:
+            response json: list or dict
+        """
+        header = {'Authorization': 'Bearer ' + access_token}
+        return self._request('GET', self.base_url + '/api/v3' + path, priority, wait, headers=header, params=params)
+
+    def request_access_token(self, client_id, client_secret, refresh_token):
+        """
+        Post request to refresh and get new API access token
+
+        Parameters:
+            client_id: string
+            client_secret: string
+            refresh_token: string
+
+        Returns:
+            token response json: dict
+        """
+        payload = {
+            'client_id': client_id,
+            'client_secret': client_secret,
+            'refresh_token': refresh_token,
+            'grant_type': 'refresh_token',
+            'f': 'json'
+        }
+        return self._request('POST', self.base_url + '/oauth/token', HIGH_PRIORITY, False, data=payload, verify=False)
+
+    def authorize_url(self, client_id, redirect_uri, state, scope='read,activity:read_all'):
+        """
+        Builds the Strava OAuth page url an athlete is sent to when logging in
+
+        Parameters:
+            client_id: string
+            redirect_uri: string
+            state: string, checked again when Strava redirects back
+            scope: string
+
+        Returns:
+            url: string
+        """
+        params = {
+            'client_id': client_id,
+            'redirect_uri': redirect_uri,
+            'response_type': 'code',
+            'approval_prompt': 'auto',
+            'scope': scope,
+            'state': state
+        }
+        return self.base_url + '/oauth/authorize?' + urlencode(params)
+
+    def exchange_authorization_code(self, client_id, client_secret, code):
+        """
+        Post request exchanging the code from the OAuth redirect for the athlete's tokens
+
+        Parameters:
+            client_id: string
+            client_secret: string
+            code: string
+
+        Returns:
+            token response json: dict, including the athlete summary
+        """
+        payload = {
+            'client_id': client_id,
+            'client_secret': client_secret,
+            'code': code,
+            'grant_type': 'authorization_code',
+            'f': 'json'
+        }
+        return self._request('POST', self.base_url + '/oauth/token', HIGH_PRIORITY, False, data=payload, verify=False)
+
+    def remaining_budget(self):
+        """
+        Fraction of the tighter of the 15 minute and daily rate limits still available
+
+        Returns:
+            remaining: double between 0 and 1, or 1 if no limits have been reported yet
+        """
+        with self._lock:
+            usage = self._current_usage()
+            if self.limits is None:
+                return 1.0
+            return min((max(limit - used, 0) / limit for limit, used in zip(self.limits, usage) if limit > 0), default=1.0)
+
+    def _current_usage(self):
+        # usage reported in a previous window has since been reset by Strava
+        if self.usage is None:
+            return (0, 0)
+        window = _rate_limit_window()
+        short_usage = self.usage[0] if window[0] == self._usage_window[0] else 0
+        daily_usage = self.usage[1] if window[1] == self._usage_window[1] else 0
+        return (short_usage, daily_usage)
+
+    def _update_rate_limits(self, headers):
+        # read limits apply to GET requests and are tighter than the overall limits when present
+        limit = headers.get('X-ReadRateLimit-Limit') or headers.get('X-RateLimit-Limit')
+        usage = headers.get('X-ReadRateLimit-Usage') or headers.get('X-RateLimit-Usage')
+        if not limit or not usage:
+            return
+        try:
+            limits = tuple(int(value) for value in limit.split(','))[:2]
+            usages = tuple(int(value) for value in usage.split(','))[:2]
+        except ValueError:
+            return
+        with self._lock:
+            self.limits = limits
+            self.usage = usages
+            self._usage_window = _rate_limit_window()
+        for window, window_limit, window_usage in zip(('15min', 'daily'), limits, usages):
+            metrics.STRAVA_RATE_LIMIT.set(window_limit, window=window)
+            metrics.STRAVA_RATE_LIMIT_USAGE.set(window_usage, window=window)
+
+    def _wait_for_budget(self, priority, wait):
+        # defer low priority work once the reserve is reached, throttle or defer everything at the limit
+        remaining = self.remaining_budget()
+        if priority == LOW_PRIORITY and remaining <= self.low_priority_reserve:
+            raise RateLimitDeferred(f'{remaining:.0%} of rate limit remaining, deferring low priority request')
+        if remaining <= 0:
+            with self._lock:
+                daily_exhausted = self.limits is not None and self._current_usage()[1] >= self.limits[1]
+            if daily_exhausted:
+                raise RateLimitExceeded('Daily rate limit exhausted')
+            delay = _seconds_until_window_reset() + random.uniform(0, 5)
+            if not wait:
+                raise RateLimitDeferred('Rate limit reached, deferring request until the 15 minute window resets', retry_after=delay)
+            print(f'\t- Rate limit reached, waiting {round(delay)}s')
+            time.sleep(delay)
+
+    def _backoff(self, attempt):
+        # full jitter exponential backoff
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _request(self, method, url, priority, wait, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        endpoint = metrics.strava_endpoint(urlparse(url).path)
+        for attempt in range(self.max_retries + 1):
+            self._wait_for_budget(priority, wait)
+            start = time.perf_counter()
+            try:
+                res = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                metrics.STRAVA_REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint, method=method, status='error')
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self._backoff(attempt))
+                continue
+
+            metrics.STRAVA_REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint, method=method, status=res.status_code)
+            self._update_rate_limits(res.headers)
+            if res.status_code == 429 or res.status_code >= 500:
+                if attempt == self.max_retries:
+                    res.raise_for_status()
+                if res.status_code == 429:
+                    retry_after = res.headers.get('Retry-After')
+                    delay = float(retry_after) if retry_after else _seconds_until_window_reset()
+                    if priority == LOW_PRIORITY or not wait:
+                        raise RateLimitDeferred('Rate limited, deferring request', retry_after=delay)
+                    time.sleep(delay + random.uniform(0, 5))
+                else:
+                    time.sleep(self._backoff(attempt))
+                continue
+
+            res.raise_for_status()
+            return res.json()
+
+def _rate_limit_window():
+    """
+    Gets the current 15 minute window and UTC day, which is when Strava resets usage
+
+    Returns:
+        window: tuple of int
+    """
+    now = int(time.time())
+    return (now // 900, now // 86400)
+
+def _seconds_until_window_reset():
+    return 900 - time.time() % 900
@@ -0,0 +1,175 @@
+import sqlite3
+import time
+import zlib
+import numpy as np
+from contextlib import closing
+from curves import CURVE_DURATIONS, CURVE_VERSION, CurveMatrix
+
+STREAM_DTYPES = { # stream type -> dtype stored on disk
+    'time': 'int32',
+    'watts': 'float32',
+    'heartrate': 'float32',
+    'velocity_smooth': 'float32',
+    'distance': 'float32'
+}
+
+def _connect(filename):
+    """
+    Opens a connection to the stream store and creates the schema if needed
+
+    Each stream is stored as its own zlib compressed column, so reading one stream type never
+    decompresses the others.
+
+    Parameters:
+        filename: string
+
+    Returns:
+        conn: sqlite3.Connection
+    """
+    conn = sqlite3.connect(filename, timeout=30)
+    conn.execute('CREATE TABLE IF NOT EXISTS fetched (activity_id INTEGER PRIMARY KEY, fetched_at INTEGER NOT NULL)')
+    conn.execute('CREATE TABLE IF NOT EXISTS streams (activity_id INTEGER NOT NULL, stream_type TEXT NOT NULL, data BLOB NOT NULL, PRIMARY KEY (activity_id, stream_type))')
+    conn.execute('CREATE TABLE IF NOT EXISTS curves (activity_id INTEGER NOT NULL, kind TEXT NOT NULL, data BLOB NOT NULL, PRIMARY KEY (activity_id, kind))')
+    return conn
+
+def save_activity_streams(filename, activity_id, streams, curves):
+    """
+    Stores an activity's streams and the curves calculated from them. Activities without streams
+    are recorded too, so they are not requested again.
+
+    Parameters:
+        filename: string
+        activity_id: int
+        streams: dict of stream type -> ndarray
+        curves: dict of curve kind -> ndarray of float32
+
+    Returns:
+        none
+    """
+    stream_rows = [(activity_id, stream_type, zlib.compress(np.asarray(values, dtype=STREAM_DTYPES[stream_type]).tobytes()))
+                   for stream_type, values in streams.items() if stream_type in STREAM_DTYPES]
+    curve_rows = [(activity_id, kind, np.asarray(curve, dtype=np.float32).tobytes()) for kind, curve in curves.items()]
+    with closing(_connect(filename)) as conn, conn:
+        conn.execute('DELETE FROM streams WHERE activity_id = ?', (activity_id,))
+        conn.execute('DELETE FROM curves WHERE activity_id = ?', (activity_id,))
+        conn.executemany('INSERT INTO streams (activity_id, stream_type, data) VALUES (?, ?, ?)', stream_rows)
+        conn.executemany('INSERT INTO curves (activity_id, kind, data) VALUES (?, ?, ?)', curve_rows)
+        conn.execute('INSERT OR REPLACE INTO fetched (activity_id, fetched_at) VALUES (?, ?)', (activity_id, int(time.time())))
+
+def load_streams(filename, activity_id, stream_types=None):
+    """
+    Loads an activity's streams
+
+    Parameters:
+        filename: string
+        activity_id: int
+        stream_types: list of string, or None for all
+
+    Returns:
+        streams: dict of stream type -> ndarray
+    """
+    with closing(_connect(filename)) as conn:
+        rows = conn.execute('SELECT stream_type, data FROM streams WHERE activity_id = ?', (activity_id,)).fetchall()
+    return {stream_type: np.frombuffer(zlib.decompress(data), dtype=STREAM_DTYPES[stream_type])
+            for stream_type, data in rows if stream_types is None or stream_type in stream_types}
+
+def get_fetched_ids(filename):
+    """
+    Gets the ids of every activity whose streams have been requested
+
+    Parameters:
+        filename: string
+
+    Returns:
+        ids: set of int
+    """
+    with closing(_connect(filename)) as conn:
+        return {row[0] for row in conn.execute('SELECT activity_id FROM fetched')}
+
+def has_fetched(filename, activity_id):
+    """
+    Checks whether an activity's streams have been requested
+
+    Parameters:
+        filename: string
+        activity_id: int
+
+    Returns:
+        fetched: boolean
+    """
+    with closing(_connect(filename)) as conn:
+        return conn.execute('SELECT 1 FROM fetched WHERE activity_id = ?', (activity_id,)).fetchone() is not None
+
+def recalculate_curves(filename, activity_types, calculate):
+    """
+    Calculates the cached curves again from the stored streams, once after curves.CURVE_VERSION
+    changes. The store's sqlite user_version records the version its curves were calculated with.
+
+    Parameters:
+        filename: string
+        activity_types: dict of activity id -> activity type
+        calculate: callable taking an activity type and streams, returning a dict of curve kind -> ndarray
+
+    Returns:
+        recalculated_count: int, activities whose curves were calculated again
+    """
+    with closing(_connect(filename)) as conn:
+        if conn.execute('PRAGMA user_version').fetchone()[0] >= CURVE_VERSION:
+            return 0
+        ids = [row[0] for row in conn.execute('SELECT DISTINCT activity_id FROM streams')]
+    recalculated_count = 0
+    for activity_id in ids:
+        activity_type = activity_types.get(activity_id)
+        curve_rows = [(activity_id, kind, np.asarray(curve, dtype=np.float32).tobytes())
+                      for kind, curve in (calculate(activity_type, load_streams(filename, activity_id)) if activity_type is not None else {}).items()]
+        with closing(_connect(filename)) as conn, conn:
+            conn.execute('DELETE FROM curves WHERE activity_id = ?', (activity_id,))
+            conn.executemany('INSERT INTO curves (activity_id, kind, data) VALUES (?, ?, ?)', curve_rows)
+        recalculated_count += 1
+    with closing(_connect(filename)) as conn:
+        conn.execute(f'PRAGMA user_version = {int(CURVE_VERSION)}')
+    return recalculated_count
+
+def load_curve_matrix(filename, kind, activity_ids):
+    """
+    Loads the cached curves of one kind for a list of activities
+
+    Parameters:
+        filename: string
+        kind: string
+        activity_ids: ndarray of int
+
+    Returns:
+        curves: CurveMatrix, positions into activity_ids, only for activities with a curve
+    """
+    row_positions = {int(id): position for position, id in enumerate(activity_ids)}
+    found = {}
+    with closing(_connect(filename)) as conn:
+        if len(row_positions) <= 500: # a few activities, e.g. one from a webhook event, are looked up by key
+            ids = list(row_positions)
+            rows = conn.execute(f"SELECT activity_id, data FROM curves WHERE kind = ? AND activity_id IN ({', '.join('?' * len(ids))})", [kind, *ids])
+        else:
+            rows = conn.execute('SELECT activity_id, data FROM curves WHERE kind = ?', (kind,))
+        for activity_id, data in rows:
+            position = row_positions.get(activity_id)
+            if position is not None and len(data) == 4 * len(CURVE_DURATIONS): # skip curves from other durations
+                found[position] = data
+    positions = np.array(sorted(found), dtype=np.int64)
+    values = np.frombuffer(b''.join(found[position] for position in positions.tolist()), dtype=np.float32).reshape(len(positions), len(CURVE_DURATIONS))
+    return CurveMatrix(positions, values)
+
+def delete_streams(filename, ids):
+    """
+    Removes the streams and curves of activities, e.g. ones deleted on Strava
+
+    Parameters:
+        filename: string
+        ids: iterable of int
+
+    Returns:
+        none
+    """
+    rows = [(id,) for id in ids]
+    with closing(_connect(filename)) as conn, conn:
+        for table in ('fetched', 'streams', 'curves'):
+            conn.executemany(f'DELETE FROM {table} WHERE activity_id = ?', rows)
@@ -0,0 +1,33 @@
+"""
+Runs the one process that syncs athletes with Strava, applies webhook events and writes the
+snapshots every web worker serving main.app with STRAVA_SYNC=0 follows. Strava request latency,
+rate limit usage and sync stages are measured here, so they are exported on this process's own
+/metrics, see --metrics-port.
+
+Only needed when serving with more than one web worker, a single process serving main.app with
+the default STRAVA_SYNC=1 syncs by itself.
+
+Usage:
+    python sync.py
+    STRAVA_SYNC=0 gunicorn --workers 4 main:app
+"""
+import argparse
+import os
+os.environ['STRAVA_SYNC'] = '0' # importing main creates its app, which must not sync alongside this process
+import metrics
+from main import run_sync_process, SYNC_POLL_SECONDS
+
+SYNC_METRICS_PORT = int(os.environ.get('STRAVA_SYNC_METRICS_PORT', '9102'))
+
+def main():
+    parser = argparse.ArgumentParser(description='Sync athletes with Strava and write the snapshots web workers serve')
+    parser.add_argument('--poll', type=float, default=SYNC_POLL_SECONDS, help='seconds between checks for webhook events and new athletes')
+    parser.add_argument('--metrics-port', type=int, default=SYNC_METRICS_PORT, help='port /metrics is exported on, 0 to not export')
+    args = parser.parse_args()
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+        print(f'\nExporting Metrics on Port {args.metrics_port}')
+    run_sync_process(args.poll)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+import threading
+import traceback
+import metrics
+
+class SyncWorker(threading.Thread):
+    """
+    Background thread that rebuilds the dataset on an interval and swaps it into a DatasetHolder
+
+    Parameters:
+        sync_function: callable returning a Dataset
+        holder: DatasetHolder
+        interval: double, seconds between syncs
+        lock: threading.Lock held through each sync and swap, so other updates to the same data wait
+    """
+    def __init__(self, sync_function, holder, interval, lock=None):
+        super().__init__(name='strava-sync', daemon=True)
+        self.sync_function = sync_function
+        self.holder = holder
+        self.interval = interval
+        self.lock = lock or threading.Lock()
+        self.last_error = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                with self.lock:
+                    self.holder.swap(self.sync_function())
+                self.last_error = None
+            except Exception as e: # keep serving the previous dataset and try again next interval
+                self.last_error = repr(e)
+                metrics.SYNC_FAILURES.inc()
+                print('\nSync Failed:')
+                traceback.print_exc()
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
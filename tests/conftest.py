@@ -0,0 +1,25 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # the app's modules live at the repository root
+os.environ.setdefault('STRAVA_SYNC', '0') # importing main must not start syncing the configured athlete
+
+import fake_strava
+
+@pytest.fixture
+def fake():
+    """
+    Fake Strava API serving 60 generated activities for athlete 1, with rate limits tests do not reach by accident
+    """
+    with fake_strava.FakeStrava(fake_strava.generate_activities(60), fake_strava.generate_segments(5), rate_limits=(1000, 10000)) as server:
+        yield server
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """
+    Records the delays the Strava client sleeps for instead of sleeping
+    """
+    slept = []
+    monkeypatch.setattr('strava_client.time.sleep', slept.append)
+    return slept
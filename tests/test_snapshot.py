@@ -0,0 +1,81 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import heatmap
+import rollup_store
+import snapshot
+from activity_model import build_activity_frame
+from curves import CURVE_DURATIONS, CurveMatrix
+from fake_strava import generate_activities
+from geometry import GeometryCache
+from routes import RouteIndex
+
+@pytest.fixture
+def dataset(tmp_path):
+    """
+    Everything write_snapshot takes, built from generated activities the way a sync builds it
+    """
+    data_frame, polylines = build_activity_frame(generate_activities(120, seed=7))
+    geometry = GeometryCache()
+    geometry.update(data_frame['id'], polylines)
+    route_index = RouteIndex()
+    route_index.update(data_frame['id'], polylines, data_frame['sport_type'].astype(str))
+    store_filename = str(tmp_path / 'activities.db')
+    rollup_store.update_rollups(store_filename, data_frame)
+    positions = np.array([2, 30, 31, 100], dtype=np.int64)
+    values = np.random.default_rng(0).random((len(positions), len(CURVE_DURATIONS))).astype(np.float32)
+    values[1, -5:] = np.nan # shorter than the longest durations
+    curve_matrices = {'power': CurveMatrix(positions, values), 'pace': CurveMatrix(np.zeros(0, dtype=np.int64), np.zeros((0, len(CURVE_DURATIONS)), dtype=np.float32))}
+    return {
+        'data_frame': data_frame,
+        'polylines': polylines,
+        'curves': curve_matrices,
+        'rollups': rollup_store.load_rollups(store_filename),
+        'geometry': geometry,
+        'route_index': route_index,
+        'fingerprint': heatmap.tracks_fingerprint(data_frame['id'], polylines)
+    }
+
+def test_round_trip(tmp_path, dataset):
+    directory = str(tmp_path / 'snapshot')
+    assert snapshot.load_snapshot(directory) is None
+    version = snapshot.write_snapshot(directory, **dataset)
+    loaded = snapshot.load_snapshot(directory)
+    assert loaded.version == version == snapshot.current_version(directory)
+    pd.testing.assert_frame_equal(loaded.activities, dataset['data_frame'])
+    assert list(loaded.polylines) == list(dataset['polylines'])
+    pd.testing.assert_frame_equal(loaded.rollups, dataset['rollups'])
+    assert loaded.fingerprint == dataset['fingerprint']
+    assert sorted(loaded.curves) == ['pace', 'power']
+    for kind, matrix in dataset['curves'].items():
+        assert np.array_equal(loaded.curves[kind].positions, matrix.positions)
+        assert np.array_equal(loaded.curves[kind].values, matrix.values, equal_nan=True)
+
+def test_restored_geometry_and_routes_match(tmp_path, dataset):
+    directory = str(tmp_path / 'snapshot')
+    snapshot.write_snapshot(directory, **dataset)
+    loaded = snapshot.load_snapshot(directory)
+    geometry = GeometryCache()
+    geometry.restore(loaded.activities['id'], loaded.polylines, loaded.boxes, loaded.lines, loaded.grid)
+    for bounds in ([-90, -180, 90, 180], [51.036047, -114.150184, 51.054738, -114.111313], [0, 0, 1, 1]):
+        assert geometry.query_bounds(bounds) == dataset['geometry'].query_bounds(bounds)
+    ids = dataset['data_frame']['id'].tolist()
+    assert all(geometry.get(id, 12) == dataset['geometry'].get(id, 12) for id in ids)
+
+    route_index = RouteIndex()
+    route_index.restore(loaded.routes, loaded.route_sport_types)
+    assert np.array_equal(route_index.route_ids(ids), dataset['route_index'].route_ids(ids))
+
+def test_keeps_recent_versions(tmp_path, dataset):
+    directory = str(tmp_path / 'snapshot')
+    versions = [snapshot.write_snapshot(directory, **dataset) for _ in range(snapshot.KEEP_VERSIONS + 2)]
+    kept = sorted(name for name in os.listdir(directory) if name != snapshot.POINTER_FILENAME)
+    assert kept == sorted(versions[-snapshot.KEEP_VERSIONS:])
+    assert snapshot.current_version(directory) == versions[-1]
+    assert snapshot.load_snapshot(directory, versions[-2]).version == versions[-2]
+
+def test_falls_back_to_current_when_a_version_is_removed(tmp_path, dataset):
+    directory = str(tmp_path / 'snapshot')
+    versions = [snapshot.write_snapshot(directory, **dataset) for _ in range(snapshot.KEEP_VERSIONS + 1)]
+    assert snapshot.load_snapshot(directory, versions[0]).version == versions[-1] # deleted by a newer writer while being loaded
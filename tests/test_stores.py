@@ -0,0 +1,118 @@
+import time
+import numpy as np
+import pandas as pd
+import activity_store
+import event_store
+import rollup_store
+import token_store
+from activity_model import build_activity_frame, replace_activities
+from fake_strava import generate_activities
+from rollups import RollupTable
+
+def test_activity_store_upserts_and_orders_by_start_time(tmp_path):
+    filename = str(tmp_path / 'activities.db')
+    activities = generate_activities(20) # newest first
+    activity_store.upsert_activities(filename, activities)
+    assert [activity['id'] for activity in activity_store.iter_activities(filename)] == [activity['id'] for activity in reversed(activities)]
+    assert activity_store.get_athlete_id(filename) == 1
+
+    edited = dict(activities[0], name='Edited')
+    activity_store.upsert_activities(filename, [edited])
+    stored = list(activity_store.iter_activities(filename))
+    assert len(stored) == 20
+    assert stored[-1]['name'] == 'Edited'
+
+def test_activity_store_deletes_and_finds_activities_after_a_time(tmp_path):
+    filename = str(tmp_path / 'activities.db')
+    activities = generate_activities(10)
+    activity_store.upsert_activities(filename, activities)
+    activity_store.delete_activities(filename, [activities[0]['id']])
+    assert activities[0]['id'] not in {activity['id'] for activity in activity_store.iter_activities(filename)}
+
+    after = activity_store.start_date_to_epoch(activities[3]['start_date'])
+    assert set(activity_store.get_activity_ids_after(filename, after)) == {activity['id'] for activity in activities[1:3]}
+
+def test_activity_store_keeps_the_high_water_mark(tmp_path):
+    filename = str(tmp_path / 'activities.db')
+    assert activity_store.get_high_water_mark(filename) is None
+    activity_store.set_high_water_mark(filename, 1700000000)
+    assert activity_store.get_high_water_mark(filename) == 1700000000
+
+def test_event_store_takes_events_in_arrival_order(tmp_path):
+    filename = str(tmp_path / 'events.db')
+    assert [event_store.append_event(filename, {'object_id': id}) for id in range(5)] == [1, 2, 3, 4, 5]
+    assert [event['object_id'] for event in event_store.take_events(filename, limit=3)] == [0, 1, 2]
+    assert [event['object_id'] for event in event_store.take_events(filename)] == [3, 4]
+    assert event_store.take_events(filename) == []
+
+def test_token_store_lists_recently_active_athletes(tmp_path):
+    filename = str(tmp_path / 'tokens.db')
+    now = time.time()
+    for athlete_id in (1, 2, 3):
+        token_store.save_token(filename, athlete_id, {'access_token': f'a{athlete_id}', 'refresh_token': f'r{athlete_id}', 'expires_at': now + 3600})
+    token_store.mark_active(filename, 1, now - 100)
+    token_store.mark_active(filename, 2, now - 10)
+    token_store.mark_active(filename, 3, now - 10000)
+    token_store.mark_active(filename, 4, now) # no tokens stored
+    assert token_store.list_active_athlete_ids(filename, now - 1000, 10) == [2, 1]
+    assert token_store.list_active_athlete_ids(filename, now - 1000, 1) == [2]
+
+    token_store.delete_token(filename, 2)
+    assert token_store.list_active_athlete_ids(filename, now - 1000, 10) == [1]
+
+def test_token_store_refreshes_tokens_about_to_expire(tmp_path):
+    filename = str(tmp_path / 'tokens.db')
+    refreshed = []
+    def refresh(refresh_token):
+        refreshed.append(refresh_token)
+        return {'access_token': 'new', 'refresh_token': 'rotated', 'expires_at': time.time() + 21600}
+
+    assert token_store.get_access_token(filename, 1, refresh) is None
+    token_store.save_token(filename, 1, {'access_token': 'old', 'refresh_token': 'r1', 'expires_at': time.time() + 7200})
+    assert token_store.get_access_token(filename, 1, refresh) == 'old'
+    assert refreshed == []
+
+    token_store.save_token(filename, 1, {'access_token': 'old', 'refresh_token': 'r1', 'expires_at': time.time() + 60})
+    assert token_store.get_access_token(filename, 1, refresh) == 'new'
+    assert token_store.get_access_token(filename, 1, refresh) == 'new'
+    assert refreshed == ['r1']
+    assert token_store.get_token(filename, 1)['refresh_token'] == 'rotated'
+
+def test_replace_activities_matches_a_rebuild():
+    activities = generate_activities(200, seed=3)
+    data_frame, polylines = build_activity_frame(activities)
+    removed = [activities[5]['id'], activities[150]['id']]
+    edited = [dict(activities[20], name='Edited', sport_type='Hike'), dict(activities[199], distance=1.0)]
+    added = [dict(activities[0], id=2000000000, start_date='2030-01-01T00:00:00Z', start_date_local='2030-01-01T00:00:00Z')]
+
+    replaced, replaced_polylines, sources = replace_activities(data_frame, polylines, edited + added, removed)
+    remaining = {activity['id']: activity for activity in activities if activity['id'] not in removed}
+    remaining.update({activity['id']: activity for activity in edited + added})
+    rebuilt, rebuilt_polylines = build_activity_frame(remaining.values())
+    pd.testing.assert_frame_equal(replaced, rebuilt)
+    assert list(replaced_polylines) == list(rebuilt_polylines)
+    assert set(replaced['id'].to_numpy()[sources < 0].tolist()) == {activity['id'] for activity in edited + added}
+    kept = sources >= 0
+    assert np.array_equal(data_frame['id'].to_numpy()[sources[kept]], replaced['id'].to_numpy()[kept])
+
+def test_rollup_deltas_match_reloading_the_rollups(tmp_path):
+    filename = str(tmp_path / 'activities.db')
+    activities = generate_activities(300, seed=5)
+    data_frame, _ = build_activity_frame(activities)
+    changed_count, _ = rollup_store.update_rollups(filename, data_frame)
+    assert changed_count == 300
+    table = RollupTable(rollup_store.load_rollups(filename))
+
+    edited = dict(activities[10], moving_time=activities[10]['moving_time'] + 600, sport_type='Walk')
+    changed, _ = build_activity_frame([edited])
+    changed_count, deltas = rollup_store.update_rollups(filename, changed, ids=[edited['id']])
+    assert changed_count == 1
+    removed, _ = build_activity_frame([])
+    _, removed_deltas = rollup_store.update_rollups(filename, removed, ids=[activities[20]['id']])
+
+    patched = table.apply(deltas).apply(removed_deltas)
+    reloaded = rollup_store.load_rollups(filename)
+    key = ['period', 'period_start', 'sport_type', 'commute']
+    pd.testing.assert_frame_equal(patched.rows.sort_values(key).reset_index(drop=True), reloaded.sort_values(key).reset_index(drop=True), check_dtype=False)
+    _, no_deltas = rollup_store.update_rollups(filename, changed, ids=[edited['id']])
+    assert table.apply(no_deltas) is table
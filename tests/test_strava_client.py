@@ -0,0 +1,94 @@
+import pytest
+import requests
+from strava_client import StravaClient, LOW_PRIORITY, RateLimitDeferred, RateLimitExceeded
+
+ACCESS_TOKEN = 'fake-access-token-1'
+
+def request_count(fake, path='/api/v3/athlete'):
+    return sum(1 for _, logged_path, _ in fake.request_log if logged_path == path)
+
+def test_retries_server_errors_with_backoff(fake, sleeps):
+    client = StravaClient(fake.url, max_retries=3, backoff_base=1.0, backoff_max=4.0)
+    fake.fail_next(500, count=2)
+    assert client.get('/athlete', ACCESS_TOKEN)['id'] == 1
+    assert request_count(fake) == 3
+    assert len(sleeps) == 2
+    assert 0 <= sleeps[0] <= 1.0 and 0 <= sleeps[1] <= 2.0
+
+def test_gives_up_after_max_retries(fake, sleeps):
+    client = StravaClient(fake.url, max_retries=2, backoff_base=0.0)
+    fake.fail_next(503, count=5)
+    with pytest.raises(requests.HTTPError):
+        client.get('/athlete', ACCESS_TOKEN)
+    assert request_count(fake) == 3
+
+def test_backoff_is_capped():
+    client = StravaClient('http://127.0.0.1', backoff_base=1.0, backoff_max=8.0)
+    assert all(0 <= client._backoff(attempt) <= min(8.0, 2 ** attempt) for attempt in range(10) for _ in range(20))
+
+def test_retries_connection_errors(sleeps):
+    client = StravaClient('http://127.0.0.1:1', max_retries=2, timeout=(0.5, 0.5))
+    with pytest.raises(requests.ConnectionError):
+        client.get('/athlete', ACCESS_TOKEN)
+    assert len(sleeps) == 2
+
+def test_429_defers_low_priority_requests(fake, sleeps):
+    client = StravaClient(fake.url)
+    fake.fail_next(429, headers={'Retry-After': '30'})
+    with pytest.raises(RateLimitDeferred) as raised:
+        client.get('/athlete', ACCESS_TOKEN, priority=LOW_PRIORITY)
+    assert raised.value.retry_after == 30
+    assert request_count(fake) == 1
+    assert sleeps == []
+
+def test_429_defers_requests_that_cannot_wait(fake, sleeps):
+    client = StravaClient(fake.url)
+    fake.fail_next(429, headers={'Retry-After': '30'})
+    with pytest.raises(RateLimitDeferred):
+        client.get('/athlete', ACCESS_TOKEN)
+    assert sleeps == []
+
+def test_429_waits_for_retry_after_when_allowed(fake, sleeps):
+    client = StravaClient(fake.url)
+    fake.fail_next(429, headers={'Retry-After': '30'})
+    assert client.get('/athlete', ACCESS_TOKEN, wait=True)['id'] == 1
+    assert request_count(fake) == 2
+    assert len(sleeps) == 1 and 30 <= sleeps[0] <= 35
+
+def test_tracks_reported_rate_limit_usage(fake):
+    client = StravaClient(fake.url)
+    assert client.remaining_budget() == 1.0
+    client.get('/athlete', ACCESS_TOKEN)
+    assert client.limits == (1000, 10000)
+    assert client.remaining_budget() == pytest.approx(0.999)
+
+def test_defers_low_priority_requests_to_save_the_reserve(fake):
+    fake.rate_limits = (10, 1000)
+    client = StravaClient(fake.url, low_priority_reserve=0.2)
+    for _ in range(8):
+        client.get('/athlete', ACCESS_TOKEN)
+    with pytest.raises(RateLimitDeferred):
+        client.get('/athlete', ACCESS_TOKEN, priority=LOW_PRIORITY)
+    assert request_count(fake) == 8 # deferred before anything was sent
+    client.get('/athlete', ACCESS_TOKEN) # high priority requests still use the reserve
+    assert request_count(fake) == 9
+
+def test_defers_every_request_at_the_15_minute_limit(fake, sleeps):
+    fake.rate_limits = (3, 1000)
+    client = StravaClient(fake.url)
+    for _ in range(3):
+        client.get('/athlete', ACCESS_TOKEN)
+    with pytest.raises(RateLimitDeferred) as raised:
+        client.get('/athlete', ACCESS_TOKEN)
+    assert 0 < raised.value.retry_after <= 905
+    assert request_count(fake) == 3
+    assert sleeps == []
+
+def test_raises_when_the_daily_limit_is_exhausted(fake):
+    fake.rate_limits = (1000, 3)
+    client = StravaClient(fake.url)
+    for _ in range(3):
+        client.get('/athlete', ACCESS_TOKEN)
+    with pytest.raises(RateLimitExceeded) as raised:
+        client.get('/athlete', ACCESS_TOKEN, wait=True)
+    assert not isinstance(raised.value, RateLimitDeferred) # waiting for the 15 minute window would not help
@@ -0,0 +1,133 @@
+import numpy as np
+import pandas as pd
+import pytest
+import webhook
+from fake_strava import FakeStrava, generate_activities, generate_segments
+
+VALID_EVENT = {'object_type': 'activity', 'object_id': 1000000005, 'aspect_type': 'update', 'owner_id': 1, 'subscription_id': 7,
+               'event_time': 1700000000, 'updates': {'title': 'Renamed'}}
+
+def test_parses_valid_events():
+    assert webhook.parse_event(VALID_EVENT) == {'object_type': 'activity', 'object_id': 1000000005, 'aspect_type': 'update', 'owner_id': 1,
+                                                'event_time': 1700000000, 'updates': {'title': 'Renamed'}}
+    assert webhook.parse_event(dict(VALID_EVENT, object_id='1000000005', updates=None))['updates'] == {}
+
+@pytest.mark.parametrize('payload', [
+    None,
+    [],
+    dict(VALID_EVENT, object_type='route'),
+    dict(VALID_EVENT, aspect_type='archive'),
+    {key: value for key, value in VALID_EVENT.items() if key != 'owner_id'},
+    dict(VALID_EVENT, object_id='not a number')
+])
+def test_rejects_invalid_events(payload):
+    assert webhook.parse_event(payload) is None
+
+def test_rejects_events_from_other_subscriptions():
+    assert webhook.parse_event(VALID_EVENT, subscription_id=7) is not None
+    assert webhook.parse_event(VALID_EVENT, subscription_id='7') is not None
+    assert webhook.parse_event(VALID_EVENT, subscription_id=8) is None
+
+def test_answers_the_subscription_challenge():
+    args = {'hub.mode': 'subscribe', 'hub.verify_token': 'secret', 'hub.challenge': 'abc'}
+    assert webhook.subscription_challenge(args, 'secret') == 'abc'
+    assert webhook.subscription_challenge(args, 'other') is None
+    assert webhook.subscription_challenge(args, '') is None
+    assert webhook.subscription_challenge(dict(args, **{'hub.mode': 'unsubscribe'}), 'secret') is None
+
+def test_worker_applies_events_in_order():
+    applied = []
+    def apply_event(event):
+        if event['object_id'] == 5:
+            raise RuntimeError('Strava is down') # left for the next sync
+        applied.append(event['object_id'])
+    worker = webhook.WebhookWorker(apply_event)
+    worker.start()
+    for id in range(20):
+        worker.put(webhook.parse_event(dict(VALID_EVENT, object_id=id)))
+    worker.wait()
+    assert applied == [id for id in range(20) if id != 5]
+    assert worker.pending() == 0
+    assert worker.applied_count == 19 and worker.last_error is None
+    worker.stop()
+    worker.join(5)
+    assert not worker.is_alive()
+
+def test_records_and_loads_events(tmp_path):
+    filename = str(tmp_path / 'events.jsonl')
+    webhook.record_event(filename, VALID_EVENT)
+    webhook.record_event(filename, dict(VALID_EVENT, aspect_type='delete'))
+    assert webhook.load_events(filename) == [VALID_EVENT, dict(VALID_EVENT, aspect_type='delete')]
+
+@pytest.fixture
+def synced(tmp_path, monkeypatch):
+    """
+    The configured athlete synced from a fake Strava API, with main pointed at it and its files in a temporary directory
+    """
+    main = pytest.importorskip('main') # needs the local, untracked config.py
+    import activity_model
+    from athlete_data import AthleteData
+    from strava_client import StravaClient
+    activities = list(generate_activities(40, seed=11))
+    with FakeStrava(activities, generate_segments(5), rate_limits=(100000, 1000000)) as server:
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(main, 'strava', StravaClient(server.url))
+        monkeypatch.setattr(main, 'configured_token', {})
+        monkeypatch.setattr(main, 'SNAPSHOT_DEBOUNCE_SECONDS', 3600.0) # written by the test instead
+        athlete = AthleteData(None, '.')
+        athlete.holder.swap(main.sync_dataset(athlete))
+        yield main, athlete, server, activity_model
+        if athlete.snapshot_timer is not None:
+            athlete.snapshot_timer.cancel()
+        athlete.close()
+
+def assert_matches_store(main, athlete, activity_model):
+    import activity_store
+    import heatmap
+    dataset = athlete.holder.get()
+    rebuilt, polylines = activity_model.build_activity_frame(activity_store.iter_activities(athlete.store_filename))
+    pd.testing.assert_frame_equal(dataset.activities, rebuilt)
+    assert list(dataset.polylines) == list(polylines)
+    assert dataset.fingerprint == heatmap.tracks_fingerprint(rebuilt['id'], polylines)
+    for kind, matrix in main.load_curves(athlete.streams_filename, rebuilt).items():
+        assert np.array_equal(dataset.curves[kind].positions, matrix.positions)
+        assert np.array_equal(dataset.curves[kind].values, matrix.values, equal_nan=True)
+    assert dataset.photos == main.load_activity_media(athlete.media_filename)
+    key = ['period', 'period_start', 'sport_type', 'commute']
+    pd.testing.assert_frame_equal(dataset.rollups.rows.sort_values(key).reset_index(drop=True),
+                                  main.rollups.RollupTable(main.rollup_store.load_rollups(athlete.store_filename)).rows.sort_values(key).reset_index(drop=True),
+                                  check_dtype=False)
+
+def event(aspect_type, object_id, updates=None):
+    return webhook.parse_event({'object_type': 'activity', 'aspect_type': aspect_type, 'object_id': object_id, 'owner_id': 1, 'updates': updates or {}})
+
+def test_applies_activity_events_like_a_full_sync(synced):
+    main, athlete, server, activity_model = synced
+    activities = server.activities
+    token_requests = sum(1 for _, path, _ in server.request_log if path == '/oauth/token')
+
+    deleted = activities.pop(3)
+    main.apply_activity_event(athlete, event('delete', deleted['id']))
+    assert deleted['id'] not in athlete.holder.get().activities['id'].tolist()
+    assert_matches_store(main, athlete, activity_model)
+
+    activities.insert(3, deleted)
+    main.apply_activity_event(athlete, event('create', deleted['id']))
+    assert deleted['id'] in athlete.holder.get().activities['id'].tolist()
+    assert_matches_store(main, athlete, activity_model)
+
+    photographed = next(activity for activity in activities if activity.get('total_photo_count'))
+    activities[activities.index(photographed)] = dict(photographed, name='Renamed', sport_type='Hike', total_photo_count=0)
+    main.apply_activity_event(athlete, event('update', photographed['id'], {'title': 'Renamed'}))
+    dataset = athlete.holder.get()
+    assert dataset.activities.loc[dataset.activities['id'] == photographed['id'], 'name'].tolist() == ['Renamed']
+    assert photographed['id'] not in dataset.photos
+    assert_matches_store(main, athlete, activity_model)
+
+    assert sum(1 for _, path, _ in server.request_log if path == '/oauth/token') == token_requests # the configured athlete's token is reused
+
+def test_ignores_activities_of_other_athletes(synced):
+    main, athlete, server, activity_model = synced
+    dataset = athlete.holder.get()
+    main.apply_activity_event(athlete, dict(event('update', server.activities[0]['id']), owner_id=2))
+    assert athlete.holder.get() is dataset
@@ -0,0 +1,145 @@
+import json
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+TOKEN_REFRESH_MARGIN = 10 * 60 # seconds before expiry an access token is refreshed
+
+_refresh_locks = {} # athlete id -> lock, so concurrent requests refresh a token only once
+_refresh_locks_lock = threading.Lock()
+
+def _connect(filename):
+    """
+    Opens a connection to the token store and creates the schema if needed
+
+    Parameters:
+        filename: string
+
+    Returns:
+        conn: sqlite3.Connection
+    """
+    conn = sqlite3.connect(filename, timeout=30)
+    conn.execute('CREATE TABLE IF NOT EXISTS tokens (athlete_id INTEGER PRIMARY KEY, access_token TEXT NOT NULL, refresh_token TEXT NOT NULL, expires_at INTEGER NOT NULL, athlete TEXT)')
+    conn.execute('CREATE TABLE IF NOT EXISTS activity (athlete_id INTEGER PRIMARY KEY, active_at INTEGER NOT NULL)') # when each athlete last used the app or got a push event
+    return conn
+
+def save_token(filename, athlete_id, token):
+    """
+    Stores the tokens from a Strava token response, keeping the stored athlete summary if the response has none
+
+    Parameters:
+        filename: string
+        athlete_id: int
+        token: dict, Strava token response json
+
+    Returns:
+        none
+    """
+    athlete = json.dumps(token['athlete']) if token.get('athlete') else None
+    with closing(_connect(filename)) as conn, conn:
+        conn.execute('''INSERT INTO tokens (athlete_id, access_token, refresh_token, expires_at, athlete) VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT (athlete_id) DO UPDATE SET access_token = excluded.access_token, refresh_token = excluded.refresh_token,
+                        expires_at = excluded.expires_at, athlete = COALESCE(excluded.athlete, athlete)''',
+                     (athlete_id, token['access_token'], token['refresh_token'], int(token['expires_at']), athlete))
+
+def get_token(filename, athlete_id):
+    """
+    Gets the stored tokens of an athlete
+
+    Parameters:
+        filename: string
+        athlete_id: int
+
+    Returns:
+        token: dict with access_token, refresh_token, expires_at and athlete, or None if the athlete never logged in
+    """
+    with closing(_connect(filename)) as conn:
+        row = conn.execute('SELECT access_token, refresh_token, expires_at, athlete FROM tokens WHERE athlete_id = ?', (athlete_id,)).fetchone()
+    if row is None:
+        return None
+    return {'access_token': row[0], 'refresh_token': row[1], 'expires_at': row[2], 'athlete': json.loads(row[3]) if row[3] else None}
+
+def list_athlete_ids(filename):
+    """
+    Gets every athlete with stored tokens
+
+    Parameters:
+        filename: string
+
+    Returns:
+        athlete_ids: list of int
+    """
+    with closing(_connect(filename)) as conn:
+        return [row[0] for row in conn.execute('SELECT athlete_id FROM tokens ORDER BY athlete_id')]
+
+def mark_active(filename, athlete_id, active_at=None):
+    """
+    Records that an athlete just used the app or got a push event
+
+    Parameters:
+        filename: string
+        athlete_id: int
+        active_at: double, seconds since epoch, now if None
+
+    Returns:
+        none
+    """
+    with closing(_connect(filename)) as conn, conn:
+        conn.execute('INSERT OR REPLACE INTO activity (athlete_id, active_at) VALUES (?, ?)', (athlete_id, int(active_at if active_at is not None else time.time())))
+
+def list_active_athlete_ids(filename, since, limit):
+    """
+    Gets the athletes with stored tokens who were active since a point in time, most recently active first
+
+    Parameters:
+        filename: string
+        since: double, seconds since epoch
+        limit: int
+
+    Returns:
+        athlete_ids: list of int
+    """
+    with closing(_connect(filename)) as conn:
+        return [row[0] for row in conn.execute('SELECT tokens.athlete_id FROM tokens JOIN activity ON activity.athlete_id = tokens.athlete_id '
+                                               'WHERE activity.active_at >= ? ORDER BY activity.active_at DESC LIMIT ?', (int(since), limit))]
+
+def delete_token(filename, athlete_id):
+    """
+    Removes the stored tokens of an athlete, e.g. after access was revoked
+
+    Parameters:
+        filename: string
+        athlete_id: int
+
+    Returns:
+        none
+    """
+    with closing(_connect(filename)) as conn, conn:
+        conn.execute('DELETE FROM tokens WHERE athlete_id = ?', (athlete_id,))
+        conn.execute('DELETE FROM activity WHERE athlete_id = ?', (athlete_id,))
+
+def get_access_token(filename, athlete_id, refresh, margin=TOKEN_REFRESH_MARGIN):
+    """
+    Gets a usable access token for an athlete, refreshing it first if it expires within the margin
+
+    Parameters:
+        filename: string
+        athlete_id: int
+        refresh: callable taking a refresh token and returning the Strava token response json
+        margin: int, seconds
+
+    Returns:
+        access_token: string, or None if the athlete never logged in
+    """
+    with _refresh_locks_lock:
+        lock = _refresh_locks.setdefault(athlete_id, threading.Lock())
+    with lock:
+        token = get_token(filename, athlete_id)
+        if token is None:
+            return None
+        if token['expires_at'] - time.time() > margin:
+            return token['access_token']
+        refreshed = refresh(token['refresh_token'])
+        save_token(filename, athlete_id, refreshed) # Strava may rotate the refresh token too
+        return refreshed['access_token']
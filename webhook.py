@@ -0,0 +1,130 @@
+import json
+import queue
+import threading
+import traceback
+import metrics
+
+EVENT_OBJECT_TYPES = ('activity', 'athlete')
+EVENT_ASPECT_TYPES = ('create', 'update', 'delete')
+
+def subscription_challenge(args, verify_token):
+    """
+    Answers the handshake Strava makes when a push subscription is created
+
+    Parameters:
+        args: mapping of query string parameters
+        verify_token: string, chosen when creating the subscription
+
+    Returns:
+        challenge: string to echo back, or None if the request is not a valid handshake
+    """
+    if args.get('hub.mode') != 'subscribe' or not verify_token or args.get('hub.verify_token') != verify_token:
+        return None
+    return args.get('hub.challenge')
+
+def parse_event(payload, subscription_id=None):
+    """
+    Validates a push event from Strava
+
+    Parameters:
+        payload: dict, the posted json
+        subscription_id: int, events from any other subscription are rejected when given
+
+    Returns:
+        event: dict with object_type, object_id, aspect_type, owner_id, event_time and updates,
+            or None if the payload is not a valid event
+    """
+    if not isinstance(payload, dict) or payload.get('object_type') not in EVENT_OBJECT_TYPES or payload.get('aspect_type') not in EVENT_ASPECT_TYPES:
+        return None
+    try:
+        event = {
+            'object_type': payload['object_type'],
+            'object_id': int(payload['object_id']),
+            'aspect_type': payload['aspect_type'],
+            'owner_id': int(payload['owner_id']),
+            'event_time': int(payload.get('event_time') or 0),
+            'updates': dict(payload.get('updates') or {})
+        }
+    except (KeyError, TypeError, ValueError):
+        return None
+    if subscription_id is not None and str(payload.get('subscription_id')) != str(subscription_id):
+        return None
+    return event
+
+def record_event(filename, payload):
+    """
+    Appends a raw event payload to a json lines file, so it can be replayed later
+
+    Parameters:
+        filename: string
+        payload: dict
+
+    Returns:
+        none
+    """
+    with open(filename, 'a') as file:
+        file.write(json.dumps(payload) + '\n')
+
+def load_events(filename):
+    """
+    Loads recorded event payloads
+
+    Parameters:
+        filename: string
+
+    Returns:
+        payloads: list of dict
+    """
+    with open(filename) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+class WebhookWorker(threading.Thread):
+    """
+    Background thread applying queued push events one at a time, in the order they arrived
+
+    Strava expects an answer within two seconds, so events are only queued while answering and
+    fetching the activity happens here.
+
+    Parameters:
+        apply_event: callable taking an event dict
+    """
+    def __init__(self, apply_event):
+        super().__init__(name='strava-webhook', daemon=True)
+        self.apply_event = apply_event
+        self.applied_count = 0
+        self.last_error = None
+        self._queue = queue.Queue()
+
+    def put(self, event):
+        self._queue.put(event)
+
+    def pending(self):
+        return self._queue.unfinished_tasks
+
+    def wait(self):
+        """
+        Blocks until every queued event has been applied, e.g. after replaying events
+        """
+        self._queue.join()
+
+    def run(self):
+        while True:
+            event = self._queue.get()
+            if event is None:
+                self._queue.task_done()
+                return
+            try:
+                self.apply_event(event)
+                self.applied_count += 1
+                self.last_error = None
+                metrics.WEBHOOK_EVENTS.inc(object_type=event['object_type'], aspect_type=event['aspect_type'], result='applied')
+            except Exception as e: # the next sync picks up whatever this event changed
+                self.last_error = repr(e)
+                metrics.WEBHOOK_EVENTS.inc(object_type=event['object_type'], aspect_type=event['aspect_type'], result='failed')
+                print(f"\nWebhook Event Failed: {event['aspect_type']} {event['object_type']} {event['object_id']}")
+                traceback.print_exc()
+            finally:
+                self._queue.task_done()
+
+    def stop(self):
+        self._queue.put(None)